@@ -38,6 +38,10 @@ urlpatterns = [
     path('rag/init/', ijunavi_views.rag_init, name='rag_init'),
     path('rag/progress/', ijunavi_views.rag_progress, name='rag_progress'),
     path('rag/recommend/', ijunavi_views.rag_recommend, name='rag_recommend'),
+    path('rag/stream/', ijunavi_views.rag_stream, name='rag_stream'),
+    path('rag/jobs/', ijunavi_views.rag_job_enqueue, name='rag_job_enqueue'),
+    path('rag/jobs/<uuid:job_id>/', ijunavi_views.rag_job_status, name='rag_job_status'),
+    path('rag/metrics/', ijunavi_views.rag_metrics, name='rag_metrics'),
 ]
 
 if settings.DEBUG:
@@ -1,3 +1,12 @@
 from django.contrib import admin
 
+from .models import RecommendationJob
+
 # Register your models here.
+
+
+@admin.register(RecommendationJob)
+class RecommendationJobAdmin(admin.ModelAdmin):
+    list_display = ("id", "status", "user", "attempts", "created_at", "finished_at")
+    list_filter = ("status",)
+    readonly_fields = ("created_at", "started_at", "finished_at")
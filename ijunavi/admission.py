@@ -0,0 +1,165 @@
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+import numpy as np
+
+# LLMを呼ぶ処理の同時実行数の制限（アドミッション制御）。
+# limit 件まで同時に実行し、超えた分は max_queue 件まで順番待ちにする（スレッドと async の呼び出しで同じ列に並ぶ）。
+# 列がいっぱい、または max_wait 秒待っても順番が来なければ Busy を投げ、呼び出し側は「混雑中」を返す。
+
+
+class Busy(Exception):
+    """混雑のため受け付けられない。retry_after 秒後に再試行してほしい"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"混雑しています（{retry_after}秒後に再試行）")
+        self.retry_after = retry_after
+
+    @property
+    def message(self) -> str:
+        return f"ただいま混み合っています。{self.retry_after}秒ほどしてから、もう一度お試しください。"
+
+
+class _Waiter:
+    def __init__(self, loop=None):
+        self.granted = False
+        self.loop = loop
+        self.future = loop.create_future() if loop is not None else None
+        self.event = threading.Event() if loop is None else None
+
+    def wake(self) -> None:
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self) -> None:
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class AdmissionController:
+    def __init__(self, limit: int = 8, max_queue: int = 32, max_wait: float = 30.0):
+        self.limit = max(1, limit)
+        self.max_queue = max(0, max_queue)
+        self.max_wait = max_wait
+
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.queue_waits = deque(maxlen=1000)  # 直近の待ち時間（秒）
+        self.service_seconds = None  # 1件の実行時間の指数移動平均（Retry-After の見積もり用）
+
+        self._lock = threading.Lock()
+        self._active = 0
+        self._waiters = deque()
+
+    @contextmanager
+    def slot(self):
+        """順番が来るまで待ってから実行する（スレッド用）。as で待った秒数を受け取れる"""
+        waited = self._acquire(None)
+        wait_seconds = 0.0
+        if waited is not None:
+            waiter, started = waited
+            waiter.event.wait(self.max_wait)
+            wait_seconds = self._finish_wait(waiter, started)
+        started = time.perf_counter()
+        try:
+            yield wait_seconds
+        finally:
+            self._release(time.perf_counter() - started)
+
+    @asynccontextmanager
+    async def aslot(self):
+        """slot の async 版。待っている間もイベントループは止めない"""
+        waited = self._acquire(asyncio.get_running_loop())
+        wait_seconds = 0.0
+        if waited is not None:
+            waiter, started = waited
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter.future), self.max_wait)
+            except asyncio.TimeoutError:
+                pass
+            except asyncio.CancelledError:
+                self._finish_wait(waiter, started, cancelled=True)
+                raise
+            wait_seconds = self._finish_wait(waiter, started)
+        started = time.perf_counter()
+        try:
+            yield wait_seconds
+        finally:
+            self._release(time.perf_counter() - started)
+
+    def _acquire(self, loop):
+        """空きがあれば None（すぐ実行できる）。無ければ列に並んで (待機者, 並んだ時刻)。列がいっぱいなら Busy"""
+        with self._lock:
+            if self._active < self.limit and not self._waiters:
+                self._active += 1
+                self.admitted += 1
+                self.queue_waits.append(0.0)
+                return None
+            if len(self._waiters) >= self.max_queue:
+                self.rejected += 1
+                raise Busy(self._retry_after_locked())
+            waiter = _Waiter(loop)
+            self._waiters.append(waiter)
+            return waiter, time.perf_counter()
+
+    def _finish_wait(self, waiter, started, cancelled=False) -> float:
+        """待ち終わった後の処理。順番が来ていれば待った秒数、来ていなければ（時間切れ）Busy"""
+        with self._lock:
+            if not waiter.granted:
+                # 時間切れ（またはキャンセル）。まだ列にいるので抜ける
+                self._waiters.remove(waiter)
+                if cancelled:
+                    return 0.0
+                self.timeouts += 1
+                raise Busy(self._retry_after_locked())
+            self.admitted += 1
+            wait_seconds = time.perf_counter() - started
+            self.queue_waits.append(wait_seconds)
+        if cancelled:
+            # 順番を受け取った直後にキャンセルされたので、次の人に回す
+            self._release(None)
+        return wait_seconds
+
+    def _release(self, seconds) -> None:
+        with self._lock:
+            if seconds is not None:
+                self.service_seconds = seconds if self.service_seconds is None else 0.8 * self.service_seconds + 0.2 * seconds
+            if self._waiters:
+                # 実行枠はそのまま列の先頭に渡す
+                waiter = self._waiters.popleft()
+                waiter.granted = True
+                waiter.wake()
+            else:
+                self._active -= 1
+
+    def _retry_after_locked(self) -> int:
+        """列の長さと平均の実行時間から、空くまでのおおよその秒数（1〜60秒）"""
+        per_job = self.service_seconds or 5.0
+        return int(min(60, max(1, math.ceil((len(self._waiters) + 1) / self.limit * per_job))))
+
+    def stats(self) -> dict:
+        with self._lock:
+            waits = np.asarray(self.queue_waits, dtype=np.float64) * 1000
+            return {
+                "limit": self.limit,
+                "active": self._active,
+                "queued": len(self._waiters),
+                "max_queue": self.max_queue,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+                "service_seconds": round(self.service_seconds, 3) if self.service_seconds is not None else None,
+                "queue_wait_ms": {
+                    "count": int(len(waits)),
+                    "p50": round(float(np.percentile(waits, 50)), 1) if len(waits) else None,
+                    "p95": round(float(np.percentile(waits, 95)), 1) if len(waits) else None,
+                    "max": round(float(waits.max()), 1) if len(waits) else None,
+                },
+            }
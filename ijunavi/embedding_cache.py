@@ -0,0 +1,168 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from .timing import span
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    埋め込みクライアントの前段に置くディスクキャッシュ。
+    (モデル名, sha256(テキスト)) をキーに SQLite へベクトルを保存し、
+    同じテキストは2回目以降APIを呼ばずに返す。
+    件数が max_entries を超えたら最終利用時刻が古いものから削除する（LRU）。
+    """
+
+    # SQLite のプレースホルダ数上限を超えないように分割して検索する
+    LOOKUP_BATCH = 500
+
+    def __init__(self, inner: Embeddings, model: str, path: Path, max_entries: int = 50000):
+        self.inner = inner
+        self.model = model
+        self.path = Path(path)
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings(last_used)")
+        self._conn.commit()
+
+    # --- Embeddings インターフェース ---
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        hashes = [text_hash(t) for t in texts]
+        found = self._lookup(hashes)
+
+        # 未キャッシュのテキストだけ（重複を除いて）APIに送る
+        missing = {}
+        for h, t in zip(hashes, texts):
+            if h not in found and h not in missing:
+                missing[h] = t
+
+        miss_count = sum(1 for h in hashes if h not in found)
+        with self._lock:
+            self.hits += len(texts) - miss_count
+            self.misses += miss_count
+
+        if missing:
+            # キャッシュから読んだときと同じ値になるように float32 に丸めて返す
+            vectors = self.inner.embed_documents(list(missing.values()))
+            vectors = [np.asarray(v, dtype=np.float32).tolist() for v in vectors]
+            new_items = dict(zip(missing.keys(), vectors))
+            self._store(new_items)
+            found.update(new_items)
+
+        return [list(found[h]) for h in hashes]
+
+    def embed_query(self, text: str) -> list[float]:
+        with span("embed_query"):
+            h = text_hash(text)
+            found = self._lookup([h])
+            if h in found:
+                with self._lock:
+                    self.hits += 1
+                return list(found[h])
+
+            with self._lock:
+                self.misses += 1
+            vector = np.asarray(self.inner.embed_query(text), dtype=np.float32).tolist()
+            self._store({h: vector})
+            return vector
+
+    # --- 統計 ---
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+                "entries": entries,
+                "max_entries": self.max_entries,
+            }
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    # --- SQLite 操作 ---
+    def _lookup(self, hashes: list[str]) -> dict:
+        found = {}
+        unique = list(dict.fromkeys(hashes))
+        now = time.time()
+        with self._lock:
+            for i in range(0, len(unique), self.LOOKUP_BATCH):
+                part = unique[i:i + self.LOOKUP_BATCH]
+                marks = ",".join("?" * len(part))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({marks})",
+                    [self.model, *part],
+                ).fetchall()
+                for h, blob in rows:
+                    found[h] = np.frombuffer(blob, dtype=np.float32).tolist()
+
+            if found:
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                    [(now, self.model, h) for h in found],
+                )
+                self._conn.commit()
+        return found
+
+    def _store(self, items: dict) -> None:
+        now = time.time()
+        rows = [
+            (self.model, h, np.asarray(v, dtype=np.float32).tobytes(), now)
+            for h, v in items.items()
+        ]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, vector, last_used) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self._evict_locked()
+            self._conn.commit()
+
+    def _evict_locked(self) -> None:
+        count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        overflow = count - self.max_entries
+        if overflow <= 0:
+            return
+        self._conn.execute(
+            """
+            DELETE FROM embeddings WHERE rowid IN (
+                SELECT rowid FROM embeddings ORDER BY last_used ASC LIMIT ?
+            )
+            """,
+            (overflow,),
+        )
+        self.evictions += overflow
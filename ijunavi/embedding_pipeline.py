@@ -0,0 +1,298 @@
+import queue
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from typing import Iterable, Iterator
+
+import openai
+import tiktoken
+from langchain_core.embeddings import Embeddings
+
+from .numpy_store import NumpyVectorStore
+
+# text-embedding-3-* と同じトークナイザ
+_ENCODING = None
+_ENCODING_LOCK = threading.Lock()
+
+
+def token_counts(texts: list[str]) -> list[int]:
+    """
+    テキストごとのトークン数。tiktoken のエンコーディングが取得できない環境では
+    文字数で見積もる（日本語は概ね1文字1トークン以下なので多めに見積もる側になる）。
+    """
+    global _ENCODING
+    with _ENCODING_LOCK:
+        if _ENCODING is None:
+            try:
+                _ENCODING = tiktoken.get_encoding("cl100k_base")
+            except Exception as e:
+                print(f"RAG: tiktoken を読み込めないため文字数でトークン数を見積もります: {e}")
+                _ENCODING = False
+    if _ENCODING is False:
+        return [len(t) for t in texts]
+    return [len(ids) for ids in _ENCODING.encode_ordinary_batch(list(texts))]
+
+
+def count_tokens(texts: list[str]) -> int:
+    """レート制限・チャンク分割用のトークン数の合計"""
+    return sum(token_counts(texts))
+
+
+class RateLimiter:
+    """
+    1分あたりのリクエスト数(RPM)とトークン数(TPM)のトークンバケット。
+    acquire() は両方の予算が空くまでブロックする。
+    """
+
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = max(1, rpm)
+        self.tpm = max(1, tpm)
+        self._requests = float(self.rpm)
+        self._tokens = float(self.tpm)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill_locked(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    def acquire(self, tokens: int) -> None:
+        # 1リクエストでバケット容量を超える場合は満タンになるまで待てば通す
+        tokens = min(tokens, self.tpm)
+        while True:
+            with self._lock:
+                self._refill_locked()
+                if self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+                wait_requests = (1 - self._requests) * 60 / self.rpm
+                wait_tokens = (tokens - self._tokens) * 60 / self.tpm
+            time.sleep(max(wait_requests, wait_tokens, 0.01))
+
+
+def _is_retryable(exc: Exception) -> bool:
+    if isinstance(exc, (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    if isinstance(exc, openai.APIStatusError):
+        return exc.status_code == 429 or exc.status_code >= 500
+    return False
+
+
+def _retry_after(exc: Exception) -> float | None:
+    response = getattr(exc, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimitedEmbeddings(Embeddings):
+    """
+    埋め込みクライアントを RPM/TPM 制限とリトライ付きで呼び出すラッパー。
+    request_size 件ずつ1リクエストとして送り、429/5xx はジッター付き指数バックオフで再試行する。
+    """
+
+    def __init__(
+        self,
+        inner: Embeddings,
+        limiter: RateLimiter,
+        request_size: int = 25,
+        max_retries: int = 6,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+    ):
+        self.inner = inner
+        self.limiter = limiter
+        self.request_size = request_size
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        vectors = []
+        for i in range(0, len(texts), self.request_size):
+            part = texts[i:i + self.request_size]
+            vectors.extend(self._call(lambda: self.inner.embed_documents(part), count_tokens(part)))
+        return vectors
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._call(lambda: self.inner.embed_query(text), count_tokens([text]))
+
+    def _call(self, fn, tokens: int):
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire(tokens)
+            try:
+                return fn()
+            except Exception as e:
+                if attempt >= self.max_retries or not _is_retryable(e):
+                    raise
+                # full jitter。Retry-After があればそれ以上待つ
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                delay = max(delay, _retry_after(e) or 0)
+                print(f"RAG: 埋め込みAPIエラーのため {delay:.1f} 秒後に再試行します（{attempt + 1}/{self.max_retries}）: {e}")
+                time.sleep(delay)
+
+
+class BackgroundBatcher:
+    """
+    iterable を別スレッドで消費し、batch_size 件ずつのバッチを上限付きキューで受け渡す。
+    CSVの読込・分割と埋め込みを並行させつつ、先読みは maxsize バッチまでに抑える。
+    produced はこれまでに作られた件数、finished は iterable を最後まで読んだかどうか。
+    """
+
+    _DONE = object()
+
+    def __init__(self, iterable: Iterable, batch_size: int, maxsize: int = 4):
+        self.produced = 0
+        self.finished = False
+        self._queue = queue.Queue(maxsize=max(1, maxsize))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(iter(iterable), batch_size),
+            name="rag-ingest",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def _put(self, item) -> bool:
+        # 消費側が止まった場合に永久に待たないよう、stop を見ながら入れる
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self, items, batch_size: int) -> None:
+        last = self._DONE
+        try:
+            batch = []
+            for item in items:
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    self.produced += len(batch)
+                    if not self._put(batch):
+                        return
+                    batch = []
+            if batch:
+                self.produced += len(batch)
+                self._put(batch)
+        except Exception as e:
+            last = e
+        finally:
+            self.finished = True
+            self._put(last)
+
+    def __iter__(self) -> Iterator[list]:
+        try:
+            while True:
+                item = self._queue.get()
+                if item is self._DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        self._stop.set()
+
+
+def embed_batches_concurrently(
+    batches: Iterable[list],
+    embeddings: Embeddings,
+    max_workers: int = 4,
+) -> Iterator[tuple[list, list[list[float]]]]:
+    """
+    Document のバッチをスレッドプールで並列に埋め込み、完了した順に (batch, vectors) を返す。
+    同時に処理中のバッチは max_workers * 2 個までに抑える。
+    DB への書き込みは呼び出し側（1スレッド）で行う想定。
+    """
+    batches = iter(batches)
+    max_in_flight = max_workers * 2
+    pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="rag-embed")
+    pending = {}
+    try:
+        while True:
+            while len(pending) < max_in_flight:
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                texts = [d.page_content for d in batch]
+                pending[pool.submit(embeddings.embed_documents, texts)] = batch
+
+            if not pending:
+                return
+
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                batch = pending.pop(fut)
+                yield batch, fut.result()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+class PrecomputedEmbeddings(Embeddings):
+    """
+    Chroma の embedding_function に渡すラッパー。replay() の中の embed_documents は渡したベクトルをそのまま返し（APIを呼ばない）、
+    それ以外は inner に任せる。埋め込み済みのバッチを公開APIの add_texts で書き込むために使う。
+    """
+
+    def __init__(self, inner: Embeddings | None = None):
+        self.inner = inner
+        self._local = threading.local()
+
+    @contextmanager
+    def replay(self, vectors: list[list[float]]):
+        self._local.vectors = vectors
+        try:
+            yield
+        finally:
+            self._local.vectors = None
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        vectors = getattr(self._local, "vectors", None)
+        if vectors is not None:
+            if len(vectors) != len(texts):
+                raise ValueError(f"ベクトル数({len(vectors)})とテキスト数({len(texts)})が一致しません。")
+            return vectors
+        if self.inner is None:
+            raise ValueError("埋め込み済みのベクトルが渡されていません。")
+        return self.inner.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        if self.inner is None:
+            raise ValueError("テキストでの検索には埋め込みクライアントが必要です。")
+        return self.inner.embed_query(text)
+
+
+def write_batch(vectorstore, batch: list, vectors: list[list[float]]) -> None:
+    """
+    埋め込み済みのバッチをベクトルDB（Chroma / NumpyVectorStore）に書き込む（埋め込みの再計算はしない）。
+    metadata に chunk_id があればそれをIDにするので、同じチャンクの再書き込みは上書きになる。
+    Chroma は embedding_function が PrecomputedEmbeddings のものに限る。
+    """
+    ids = [d.metadata.get("chunk_id") or str(uuid.uuid4()) for d in batch]
+    texts = [d.page_content for d in batch]
+    metadatas = [d.metadata for d in batch]
+    if isinstance(vectorstore, NumpyVectorStore):
+        vectorstore.upsert(ids=ids, embeddings=vectors, documents=texts, metadatas=metadatas)
+        return
+    replay = vectorstore.embeddings
+    if not isinstance(replay, PrecomputedEmbeddings):
+        raise TypeError("Chroma の embedding_function を PrecomputedEmbeddings にしてください（埋め込みを再計算しないため）。")
+    with replay.replay(vectors):
+        # add_texts は ids が同じものを上書きする（upsert）
+        vectorstore.add_texts(texts, metadatas=metadatas, ids=ids)
@@ -0,0 +1,171 @@
+import hashlib
+import unicodedata
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# e-Stat（社会・人口統計体系 市区町村データ）形式のCSVを整形して読み込む。
+# 先頭に空行・表番号・分野名などが数行あり、その後に
+#   日本語見出し / 英語見出し / 項目コード / 単位 / 調査年
+# の見出し行が続き、データ行になる。
+
+ESTAT_FILES = {"2024医療.csv", "2024居住.csv", "2024教育.csv"}
+
+# 整形ロジックを変えたら上げる（Parquetキャッシュを作り直す）
+PARSER_VERSION = 1
+
+CODE_COLUMN = "市区町村コード"
+PREF_COLUMN = "都道府県"
+NAME_COLUMN = "市区町村"
+NAME_EN_COLUMN = "Municipalities"
+
+# 都道府県（配列の順が都道府県コード 01〜47）
+PREFECTURES = (
+    "北海道", "青森県", "岩手県", "宮城県", "秋田県", "山形県", "福島県", "茨城県", "栃木県", "群馬県",
+    "埼玉県", "千葉県", "東京都", "神奈川県", "新潟県", "富山県", "石川県", "福井県", "山梨県", "長野県",
+    "岐阜県", "静岡県", "愛知県", "三重県", "滋賀県", "京都府", "大阪府", "兵庫県", "奈良県", "和歌山県",
+    "鳥取県", "島根県", "岡山県", "広島県", "山口県", "徳島県", "香川県", "愛媛県", "高知県", "福岡県",
+    "佐賀県", "長崎県", "熊本県", "大分県", "宮崎県", "鹿児島県", "沖縄県",
+)
+PREF_CODES = {name: i for i, name in enumerate(PREFECTURES, start=1)}
+
+# 読込時に試すエンコーディング（前回検出したものがあれば最初に試す）
+CSV_ENCODINGS = ("utf-8", "cp932")
+
+# 欠損・秘匿を表す記号
+MISSING_MARKS = {"", "-", "…", "...", "***", "x", "X", "―"}
+
+# 見出し行を探す範囲（先頭から）
+HEADER_SEARCH_ROWS = 40
+
+
+def normalize_text(value: str) -> str:
+    """全角英数・半角カナを NFKC で正規化し、改行と前後の空白を取り除く"""
+    text = unicodedata.normalize("NFKC", str(value))
+    return "".join(text.split("\n")).strip()
+
+
+def pref_code_of(name: str) -> int | None:
+    """都道府県名（「沖縄」のような 都/府/県 を省いた形も可）から都道府県コード（1〜47）を返す"""
+    name = normalize_text(name)
+    code = PREF_CODES.get(name)
+    if code is None and name and name[-1] not in "都道府県":
+        code = PREF_CODES.get(name + "県") or PREF_CODES.get(name + "府") or PREF_CODES.get(name + "都")
+    return code
+
+
+def find_header_row(raw: pd.DataFrame) -> int:
+    for i in range(min(HEADER_SEARCH_ROWS, len(raw))):
+        cells = {normalize_text(v) for v in raw.iloc[i]}
+        if NAME_COLUMN in cells and NAME_EN_COLUMN in cells:
+            return i
+    raise ValueError("e-Stat形式の見出し行（市区町村 / Municipalities）が見つかりません")
+
+
+def downcast_numeric(values: pd.Series) -> pd.Series:
+    """
+    整数値だけの列は最小の整数型（欠損があれば nullable 整数）にする。
+    小数の列は float32 にすると JSON 化で桁が崩れる（91.23 → 91.2300033569）ので float64 のまま。
+    """
+    numeric = pd.to_numeric(values, errors="coerce")
+    present = numeric.dropna()
+    if len(present) and np.all(np.mod(present, 1) == 0):
+        if len(present) == len(numeric):
+            return pd.to_numeric(numeric, downcast="integer")
+        for dtype, info in (("Int8", np.iinfo(np.int8)), ("Int16", np.iinfo(np.int16)),
+                            ("Int32", np.iinfo(np.int32)), ("Int64", np.iinfo(np.int64))):
+            if info.min <= present.min() and present.max() <= info.max:
+                return numeric.astype(dtype)
+    return numeric.astype("float64")
+
+
+def load_estat_table(path: Path, encoding: str = "utf-8") -> pd.DataFrame:
+    """
+    e-Stat形式のCSVを、1行1地域の表に整形して返す。
+    列は 市区町村コード / 都道府県 / 市区町村 / Municipalities と各指標（日本語見出し）。
+    英語見出し・項目コード・単位・調査年は df.attrs["columns"] に残す。
+    """
+    raw = pd.read_csv(str(path), header=None, dtype=str, encoding=encoding, keep_default_na=False)
+    header = find_header_row(raw)
+    ja = [normalize_text(v) for v in raw.iloc[header]]
+    en = [normalize_text(v) for v in raw.iloc[header + 1]] if header + 1 < len(raw) else [""] * len(ja)
+
+    name_col = ja.index(NAME_COLUMN)
+    name_en_col = ja.index(NAME_EN_COLUMN)
+    # 末尾の「市区町村ｺｰﾄﾞ」列（NFKC で「市区町村コード」になる）
+    code_col = ja.index(CODE_COLUMN) if CODE_COLUMN in ja else name_col - 1
+
+    # 見出しの下の 英語見出し / 項目コード / 単位 / 調査年 を項目ごとにまとめる
+    sub_rows = [[normalize_text(v) for v in raw.iloc[r]] for r in range(header + 1, min(header + 5, len(raw)))]
+    value_cols = [i for i in range(name_en_col + 1, len(ja)) if i != code_col and (ja[i] or en[i])]
+
+    body = raw.iloc[header + 1:]
+    codes = body.iloc[:, code_col].str.strip()
+    body = body[codes != ""]
+    codes = codes[codes != ""]
+
+    df = pd.DataFrame({
+        CODE_COLUMN: codes.values,
+        NAME_COLUMN: [normalize_text(v) for v in body.iloc[:, name_col]],
+        NAME_EN_COLUMN: [normalize_text(v) for v in body.iloc[:, name_en_col]],
+    })
+
+    # 2桁コードの行が都道府県。その名前を各市区町村に付ける
+    pref_names = {c: n for c, n in zip(df[CODE_COLUMN], df[NAME_COLUMN]) if len(c) == 2}
+    df.insert(1, PREF_COLUMN, pd.Categorical(df[CODE_COLUMN].str[:2].map(pref_names)))
+
+    columns_info = {}
+    for i in value_cols:
+        label = ja[i] or en[i]
+        values = body.iloc[:, i].str.strip().str.replace(",", "", regex=False)
+        values = values.where(~values.isin(MISSING_MARKS))
+        series = downcast_numeric(values)
+        if series.isna().all():
+            continue  # 空の列は捨てる
+        df[label] = series.values
+        columns_info[label] = {
+            "en": sub_rows[0][i] if len(sub_rows) > 0 else "",
+            "code": sub_rows[1][i] if len(sub_rows) > 1 else "",
+            "unit": sub_rows[2][i] if len(sub_rows) > 2 else "",
+            "year": sub_rows[3][i] if len(sub_rows) > 3 else "",
+        }
+
+    df.attrs["columns"] = columns_info
+    return df
+
+
+def _cache_key(path: Path) -> str:
+    stat = path.stat()
+    raw = f"{path.name}:{stat.st_size}:{stat.st_mtime_ns}:{PARSER_VERSION}".encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()[:16]
+
+
+def load_estat_cached(path: Path, encoding: str = "utf-8", cache_dir: Path | None = None) -> pd.DataFrame:
+    """
+    load_estat_table の結果を、ファイルのフィンガープリントをキーに Parquet でキャッシュする。
+    CSVが変わっていなければ生のCSVは解析しない。
+    """
+    path = Path(path)
+    if cache_dir is None:
+        return load_estat_table(path, encoding=encoding)
+
+    cache_dir = Path(cache_dir)
+    cache_path = cache_dir / f"{path.stem}-{_cache_key(path)}.parquet"
+    if cache_path.exists():
+        try:
+            return pd.read_parquet(cache_path)
+        except Exception as e:
+            print(f"RAG: Parquetキャッシュを読めないため再作成します: {cache_path.name} ({e})")
+
+    df = load_estat_table(path, encoding=encoding)
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        for old in cache_dir.glob(f"{path.stem}-*.parquet"):
+            old.unlink(missing_ok=True)
+        tmp = cache_path.with_suffix(".tmp")
+        df.to_parquet(tmp, index=False)
+        tmp.replace(cache_path)
+    except Exception as e:
+        print(f"RAG: Parquetキャッシュを書き込めませんでした: {path.name} ({e})")
+    return df
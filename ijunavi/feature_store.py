@@ -0,0 +1,350 @@
+import hashlib
+import json
+import re
+import threading
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from .estat import (
+    CODE_COLUMN,
+    CSV_ENCODINGS,
+    ESTAT_FILES,
+    NAME_COLUMN,
+    NAME_EN_COLUMN,
+    PARSER_VERSION,
+    PREF_COLUMN,
+    downcast_numeric,
+    load_estat_cached,
+    normalize_text,
+)
+
+# 市区町村ごとの特徴量テーブル。
+# 2024年の4つの表（人口・医療・居住・教育）を市区町村コード（5桁、都道府県は2桁）で横に結合し、
+# Arrow IPC（Feather）ファイルとしてキャッシュする。読込はプロセスごとに1回だけで、DataFrame に変換する
+# （文字列・カテゴリ・欠損のある列はコピーになるので、メモリマップはしない）。
+
+POPULATION_FILE = "2024人口.csv"
+MUNICIPALITY_FILES = (POPULATION_FILE, *sorted(ESTAT_FILES))
+
+# 結合・整形のロジックを変えたら上げる（キャッシュを作り直す）
+FEATURE_VERSION = 1
+
+IDENTITY_COLUMNS = [CODE_COLUMN, PREF_COLUMN, NAME_COLUMN, NAME_EN_COLUMN]
+
+# 項目ごとの情報（出典ファイル・単位など）を Arrow のスキーマに保存するときのキー
+_COLUMNS_META_KEY = b"ijunavi.columns"
+_ENCODINGS_META_KEY = b"ijunavi.encodings"
+
+# 年齢3区分（開始年齢で振り分ける）
+AGE_GROUPS = (("年少人口", 0, 14), ("生産年齢人口", 15, 64), ("老年人口", 65, 200))
+
+
+def _read_with_fallback(path: Path, reader, encoding_hint: str | None = None):
+    """前回検出した文字コード → 候補の順に読み、(結果, 文字コード) を返す"""
+    last_error = None
+    for encoding in dict.fromkeys([encoding_hint, *CSV_ENCODINGS]):
+        if not encoding:
+            continue
+        try:
+            return reader(path, encoding), encoding
+        except UnicodeDecodeError as e:
+            last_error = e
+    raise last_error
+
+
+def load_population_table(path: Path, encoding: str = "utf-8") -> pd.DataFrame:
+    """
+    住民基本台帳の年齢階級別人口（団体コード6桁・男/女/計の3行で1地域）を1行1地域の表にする。
+    団体コードは末尾が検査数字なので先頭5桁を市区町村コードにし、都道府県の行は先頭2桁にする。
+    """
+    raw = pd.read_csv(str(path), header=None, dtype=str, encoding=encoding, keep_default_na=False)
+    header = None
+    for i in range(min(40, len(raw))):
+        cells = [normalize_text(v) for v in raw.iloc[i]]
+        if "団体コード" in cells and "性別" in cells:
+            header = i
+            break
+    if header is None:
+        raise ValueError(f"{path.name}: 見出し行（団体コード / 性別）が見つかりません")
+
+    bands = [normalize_text(v) for v in raw.iloc[header - 1]] if header > 0 else []
+    body = raw.iloc[header + 1:]
+    body = body[body.iloc[:, 0].str.strip().str.fullmatch(r"\d{6}")]
+
+    raw_code = body.iloc[:, 0].str.strip()
+    name = body.iloc[:, 2].map(normalize_text)
+    is_pref = name.isin(["-", ""])
+    code = raw_code.str[:5].where(~is_pref, raw_code.str[:2])
+    sex = body.iloc[:, 3].map(normalize_text)
+
+    def numbers(col: int) -> pd.Series:
+        return pd.to_numeric(body.iloc[:, col].str.strip().str.replace(",", "", regex=False), errors="coerce")
+
+    df = pd.DataFrame({
+        CODE_COLUMN: code[sex == "計"].values,
+        PREF_COLUMN: body.iloc[:, 1].map(normalize_text)[sex == "計"].values,
+        NAME_COLUMN: name.where(~is_pref, body.iloc[:, 1].map(normalize_text))[sex == "計"].values,
+    })
+    by_sex = {s: pd.Series(numbers(4)[sex == s].values, index=code[sex == s].values) for s in ("計", "男", "女")}
+    df["人口総数"] = by_sex["計"].reindex(df[CODE_COLUMN]).values
+    df["男性人口"] = by_sex["男"].reindex(df[CODE_COLUMN]).values
+    df["女性人口"] = by_sex["女"].reindex(df[CODE_COLUMN]).values
+
+    # 5歳階級（「0歳～4歳」「100歳以上」）を年齢3区分に集計する
+    totals = sex.values == "計"
+    for label, lo, hi in AGE_GROUPS:
+        cols = []
+        for col in range(5, len(bands)):
+            m = re.match(r"(\d+)歳", bands[col])
+            if m and lo <= int(m.group(1)) <= hi:
+                cols.append(col)
+        df[label] = sum(numbers(c).values[totals] for c in cols) if cols else np.nan
+
+    for col in df.columns[3:]:
+        df[col] = downcast_numeric(df[col]).values
+    df.attrs["columns"] = {
+        col: {"en": "", "code": "", "unit": "人", "year": "2025", "source": path.name}
+        for col in df.columns[3:]
+    }
+    return df
+
+
+def build_feature_table(data_dir: Path, cache_dir: Path | None = None, encodings: dict | None = None) -> pd.DataFrame:
+    """
+    4つの表を市区町村コードで外部結合した、1行1地域の表を作る。
+    地域名は人口の表（区は「札幌市中央区」のように市名付き）を優先し、無い地域と英語名は e-Stat の表から取る。
+    """
+    encodings = encodings or {}
+    detected = {}
+    frames = []
+    for name in MUNICIPALITY_FILES:
+        path = Path(data_dir) / name
+        if not path.exists():
+            continue
+        if name in ESTAT_FILES:
+            reader = lambda p, enc: load_estat_cached(p, encoding=enc, cache_dir=cache_dir)
+        else:
+            reader = load_population_table
+        df, detected[name] = _read_with_fallback(path, reader, encodings.get(name))
+        for info in df.attrs.get("columns", {}).values():
+            info["source"] = name
+        frames.append(df)
+
+    if not frames:
+        raise FileNotFoundError(f"市区町村データのCSVが見つかりません: {data_dir}")
+
+    columns_info = {}
+    identity = None
+    values = []
+    for df in frames:
+        keyed = df.set_index(CODE_COLUMN)
+        ids = keyed[[c for c in IDENTITY_COLUMNS[1:] if c in keyed.columns]].astype(object)
+        identity = ids if identity is None else _prefer(identity, ids)
+        value_cols = [c for c in keyed.columns if c not in IDENTITY_COLUMNS]
+        values.append(keyed[value_cols])
+        columns_info.update({c: df.attrs["columns"][c] for c in value_cols if c in df.attrs.get("columns", {})})
+
+    table = identity.join(values, how="outer").sort_index()
+    table.index.name = CODE_COLUMN
+    table = table.reset_index()
+
+    table[PREF_COLUMN] = pd.Categorical(table[PREF_COLUMN])
+    for col in (NAME_COLUMN, NAME_EN_COLUMN):
+        if col in table.columns:
+            table[col] = table[col].fillna("").astype(str)
+    for col in columns_info:
+        table[col] = downcast_numeric(table[col]).values
+
+    table.attrs["columns"] = columns_info
+    table.attrs["encodings"] = detected
+    return table
+
+
+def _prefer(base: pd.DataFrame, other: pd.DataFrame) -> pd.DataFrame:
+    """識別列（都道府県・地域名・英語名）を結合する。先に読んだ表の値を優先し、空欄だけ後の表で埋める"""
+    merged = base.reindex(base.index.union(other.index))
+    for col in other.columns:
+        fill = other[col].reindex(merged.index)
+        if col not in merged.columns:
+            merged[col] = fill
+        else:
+            merged[col] = merged[col].where(merged[col].notna() & (merged[col] != ""), fill)
+    return merged
+
+
+def joined_sources(source_name: str) -> list[str]:
+    """
+    source_name のドキュメントが内容に使う、ほかの CSV。市区町村データは地域名・英語名を
+    4つの表から補い合う（_prefer）ので、どれかが変わるとほかの表のドキュメントも変わる。
+    """
+    if source_name not in MUNICIPALITY_FILES:
+        return []
+    return [name for name in MUNICIPALITY_FILES if name != source_name]
+
+
+def feature_cache_key(data_dir: Path) -> str:
+    parts = [f"v{FEATURE_VERSION}", f"p{PARSER_VERSION}"]
+    for name in MUNICIPALITY_FILES:
+        path = Path(data_dir) / name
+        if path.exists():
+            stat = path.stat()
+            parts.append(f"{name}:{stat.st_size}:{stat.st_mtime_ns}")
+    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()[:16]
+
+
+def save_feature_table(table: pd.DataFrame, path: Path) -> None:
+    """解凍なしで読めるよう、圧縮なしの Arrow IPC（Feather v2）で書く"""
+    arrow = pa.Table.from_pandas(table, preserve_index=False)
+    metadata = dict(arrow.schema.metadata or {})
+    metadata[_COLUMNS_META_KEY] = json.dumps(table.attrs.get("columns", {}), ensure_ascii=False).encode("utf-8")
+    metadata[_ENCODINGS_META_KEY] = json.dumps(table.attrs.get("encodings", {})).encode("utf-8")
+    arrow = arrow.replace_schema_metadata(metadata)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{threading.get_ident()}.tmp")
+    feather.write_feather(arrow, str(tmp), compression="uncompressed")
+    tmp.replace(path)
+
+
+def read_feature_table(path: Path) -> pd.DataFrame:
+    """
+    Arrow から DataFrame に変換して読む。変換済みの列から Arrow 側のバッファを解放するので、
+    読込中のメモリは表1つ分を大きく超えない。
+    """
+    arrow = feather.read_table(str(path), memory_map=False)
+    metadata = arrow.schema.metadata or {}
+    table = arrow.to_pandas(split_blocks=True, self_destruct=True)
+    del arrow
+    table.attrs["columns"] = json.loads(metadata.get(_COLUMNS_META_KEY, b"{}"))
+    table.attrs["encodings"] = json.loads(metadata.get(_ENCODINGS_META_KEY, b"{}"))
+    return table
+
+
+class FeatureStore:
+    """
+    結合済みの市区町村テーブル。frame の行は市区町村コード順で、
+    get(コード) と find(地域名) はハッシュ索引で引く。
+    """
+
+    def __init__(self, frame: pd.DataFrame, key: str = ""):
+        self.key = key
+        self.frame = frame
+        self.columns = frame.attrs.get("columns", {})
+        self.encodings = frame.attrs.get("encodings", {})
+        self._positions = {code: i for i, code in enumerate(frame[CODE_COLUMN])}
+        self._by_name = {}
+        for i, (pref, name) in enumerate(zip(frame[PREF_COLUMN].astype(object), frame[NAME_COLUMN])):
+            self._by_name.setdefault(name, []).append(i)
+            if isinstance(pref, str) and pref != name:
+                self._by_name.setdefault(pref + name, []).append(i)
+
+    def __len__(self) -> int:
+        return len(self.frame)
+
+    @staticmethod
+    def normalize_code(code) -> str:
+        """団体コード（6桁）や数値でも、5桁（都道府県は2桁）の市区町村コードにそろえる"""
+        text = str(code).strip()
+        if text.isdigit():
+            if len(text) == 6:
+                return text[:5]
+            if len(text) in (1, 4):
+                return text.zfill(len(text) + 1)
+        return text
+
+    def get(self, code) -> dict | None:
+        i = self._positions.get(self.normalize_code(code))
+        if i is None:
+            return None
+        return self.frame.iloc[i].to_dict()
+
+    def find(self, name: str, pref: str | None = None) -> list[dict]:
+        """地域名（「那覇市」「沖縄県那覇市」など）で引く。同名の地域があれば全部返す"""
+        name = normalize_text(name)
+        rows = self._by_name.get(name, [])
+        if pref:
+            rows = [i for i in rows if self.frame[PREF_COLUMN].iat[i] == pref]
+        return [self.frame.iloc[i].to_dict() for i in rows]
+
+    def source_columns(self, source_name: str) -> list[str]:
+        return [c for c, info in self.columns.items() if info.get("source") == source_name]
+
+    def source_frame(self, source_name: str) -> pd.DataFrame:
+        """元のCSV1つ分の項目だけを取り出した表（値が1つも無い地域は除く）。ドキュメント作成用"""
+        return self._source_slice(source_name, 0, len(self.frame))
+
+    def iter_source_frames(self, source_name: str, rows: int = 800) -> Iterator[tuple[int, pd.DataFrame]]:
+        """
+        source_frame を rows 行前後ずつ（都道府県の切れ目で）区切って (先頭行の位置, 表) で返す。
+        ファイル1つ分の表をまとめて作らないので、ドキュメント作成中のメモリは区切り1つ分で済む。
+        """
+        prefs = self.frame[CODE_COLUMN].astype(str).str[:2].to_numpy()
+        offset, start = 0, 0
+        while start < len(prefs):
+            end = min(start + max(1, rows), len(prefs))
+            while end < len(prefs) and prefs[end] == prefs[end - 1]:
+                end += 1
+            df = self._source_slice(source_name, start, end)
+            if len(df):
+                yield offset, df
+            offset += len(df)
+            start = end
+
+    def _source_slice(self, source_name: str, start: int, end: int) -> pd.DataFrame:
+        value_cols = self.source_columns(source_name)
+        ids = [c for c in IDENTITY_COLUMNS if c in self.frame.columns]
+        df = self.frame.iloc[start:end][ids + value_cols]
+        df = df[df[value_cols].notna().any(axis=1)].reset_index(drop=True)
+        df.attrs = {"columns": {c: self.columns[c] for c in value_cols}}
+        return df
+
+    def matrix(self, columns: list[str]) -> np.ndarray:
+        """数値列を float64 の2次元配列で返す（欠損は NaN）。スコア計算用"""
+        return np.column_stack([
+            pd.to_numeric(self.frame[c], errors="coerce").to_numpy(dtype="float64", na_value=np.nan)
+            for c in columns
+        ])
+
+
+_STORE = None
+_STORE_LOCK = threading.Lock()
+
+
+def get_feature_store(data_dir: Path, cache_dir: Path | None = None, encodings: dict | None = None) -> FeatureStore:
+    """
+    プロセス内で共有する FeatureStore。CSVが変わっていなければキャッシュ（Arrow）を読むだけ。
+    cache_dir が無ければ毎回CSVから作る（キャッシュしない）。
+    """
+    global _STORE
+    key = feature_cache_key(data_dir)
+    with _STORE_LOCK:
+        if _STORE is not None and _STORE.key == key:
+            return _STORE
+
+        if cache_dir is None:
+            _STORE = FeatureStore(build_feature_table(data_dir, encodings=encodings), key)
+            return _STORE
+
+        cache_dir = Path(cache_dir)
+        path = cache_dir / f"municipalities-{key}.arrow"
+        if path.exists():
+            try:
+                _STORE = FeatureStore(read_feature_table(path), key)
+                return _STORE
+            except Exception as e:
+                print(f"RAG: 市区町村テーブルのキャッシュを読めないため再作成します: {path.name} ({e})")
+
+        table = build_feature_table(data_dir, cache_dir=cache_dir, encodings=encodings)
+        try:
+            for old in cache_dir.glob("municipalities-*.arrow"):
+                old.unlink(missing_ok=True)
+            save_feature_table(table, path)
+        except Exception as e:
+            print(f"RAG: 市区町村テーブルのキャッシュを書き込めませんでした: {e}")
+        _STORE = FeatureStore(table, key)
+        return _STORE
@@ -0,0 +1,474 @@
+import json
+import os
+import time
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+from langchain.schema import Document
+
+from .embedding_pipeline import count_tokens, token_counts
+from .estat import CODE_COLUMN, CSV_ENCODINGS, NAME_COLUMN, NAME_EN_COLUMN, PREF_COLUMN, pref_code_of
+from .feature_store import MUNICIPALITY_FILES, get_feature_store
+
+# CSV → ドキュメント → チャンク の変換。
+# プロセスプールのワーカーからも呼ばれるので、Django や Chroma には依存させない。
+
+# 1チャンクのトークン数の目安（cl100k_base で数える）。行の途中では切らないので、
+# 1行だけで超える場合はその行だけのチャンクになる
+CHUNK_TOKENS = int(os.getenv("RAG_CHUNK_TOKENS", "1000"))
+
+# ドキュメントの作り方を変えたら上げる（CSVが同じでも再インデックスさせる）
+INGEST_VERSION = 8
+
+# 表形式CSVの1行の書き方
+#   json     : 1行1レコードの JSON（列名を毎行くり返す）
+#   table    : 先頭に列名を1回だけ書き、各行は値を "|" 区切りで並べる
+#   sentence : 1行1地域の文（「列名 値単位」を読点でつなぐ。欠損値は書かない）
+ROW_FORMATS = ("json", "table", "sentence")
+DEFAULT_ROW_FORMAT = "table"
+
+# ソースごとの書き方。環境変数 RAG_ROW_FORMATS="2024人口.csv=json,2024医療.csv=table" で上書きできる
+# （tenpo2511.csv は常に文形式で、この設定は使わない）
+SOURCE_ROW_FORMATS = {
+    "2024人口.csv": "sentence",
+    "2024医療.csv": "sentence",
+    "2024居住.csv": "sentence",
+    "2024教育.csv": "sentence",
+}
+
+
+def row_format_for(source_name: str) -> str:
+    formats = dict(SOURCE_ROW_FORMATS)
+    for item in os.getenv("RAG_ROW_FORMATS", "").split(","):
+        name, _, fmt = item.partition("=")
+        if name.strip() and fmt.strip():
+            formats[name.strip()] = fmt.strip()
+    fmt = formats.get(source_name, DEFAULT_ROW_FORMAT)
+    if fmt not in ROW_FORMATS:
+        raise ValueError(f"{source_name}: 未対応の行形式です: {fmt}（{' / '.join(ROW_FORMATS)}）")
+    return fmt
+
+
+def _cell_strings(values: pd.Series) -> tuple[np.ndarray, np.ndarray]:
+    """列の値を1行に収まる文字列にする。欠損は空文字で、欠損かどうかも返す"""
+    missing = values.isna().to_numpy()
+    text = _text_column(values)
+    text = np.array([v.replace("\n", " ").replace("|", "/") for v in text], dtype=object)
+    text[missing] = ""
+    return text, missing
+
+
+def _unit(df: pd.DataFrame, column: str) -> str:
+    # e-Stat の単位は「施設:number of hospitals」の形なので日本語部分だけ使う
+    info = df.attrs.get("columns", {}).get(column, {})
+    return info.get("unit", "").split(":")[0]
+
+
+def serialize_rows(df: pd.DataFrame, row_format: str) -> tuple[str, list[str]]:
+    """
+    df の各行を row_format で1行ずつの文字列にする。
+    戻り値は (見出し, 行のリスト)。見出しは table 形式の列名行で、他の形式では空文字。
+    """
+    if row_format == "json":
+        if df.empty:
+            return "", []
+        return "", df.to_json(orient="records", force_ascii=False, lines=True).rstrip("\n").split("\n")
+
+    columns = [str(c) for c in df.columns]
+    if row_format == "table":
+        lines = np.full(len(df), "", dtype=object)
+        for i, col in enumerate(df.columns):
+            text, _ = _cell_strings(df[col])
+            lines = text if i == 0 else lines + "|" + text
+        header = "|".join(c.replace("|", "/") for c in columns)
+        return header, list(lines)
+
+    if row_format == "sentence":
+        # e-Stat の表は「都道府県市区町村（コード）:」を文頭に置き、残りの列を「列名 値単位」で並べる（英語名は省く）
+        id_cols = [c for c in (PREF_COLUMN, NAME_COLUMN, NAME_EN_COLUMN, CODE_COLUMN) if c in df.columns]
+        if NAME_COLUMN in df.columns:
+            name, _ = _cell_strings(df[NAME_COLUMN])
+            if PREF_COLUMN in df.columns:
+                pref, _ = _cell_strings(df[PREF_COLUMN])
+                name = np.where(pref == name, name, pref + name)
+            if CODE_COLUMN in df.columns:
+                code, _ = _cell_strings(df[CODE_COLUMN])
+                name = name + "（" + code + "）"
+            heads = name + ": "
+        else:
+            id_cols = []
+            heads = np.full(len(df), "", dtype=object)
+
+        body = np.full(len(df), "", dtype=object)
+        for col in df.columns:
+            if col in id_cols:
+                continue
+            text, missing = _cell_strings(df[col])
+            piece = str(col) + " " + text + _unit(df, col) + "、"
+            body = body + np.where(missing, "", piece)
+        lines = [h + b[:-1] + "。" if b else h.rstrip(": ") + "。" for h, b in zip(heads, body)]
+        return "", lines
+
+    raise ValueError(f"未対応の行形式です: {row_format}")
+
+
+def pack_row_ranges(
+    row_tokens: list[int],
+    max_tokens: int | None,
+    group_rows: int,
+    reserved: int = 0,
+    keys=None,
+) -> list[tuple[int, int]]:
+    """
+    行を先頭から詰めて (start, end) の範囲に区切る。1範囲は最大 group_rows 行で、
+    max_tokens があれば reserved（見出し部分）と各行のトークン数（改行込み）の合計がそれを超えないようにする。
+    行の途中では区切らないので、1行だけで予算を超える行はその行だけの範囲になる。
+    keys（都道府県コードなど）を渡すと、値が変わる行でも必ず区切る。
+    """
+    ranges = []
+    start, used = 0, reserved
+    for i, tokens in enumerate(row_tokens):
+        over = max_tokens is not None and used + tokens + 1 > max_tokens
+        new_key = keys is not None and i > 0 and keys[i] != keys[i - 1]
+        if i > start and (i - start >= group_rows or over or new_key):
+            ranges.append((start, i))
+            start, used = i, reserved
+        used += tokens + 1
+    if start < len(row_tokens):
+        ranges.append((start, len(row_tokens)))
+    return ranges
+
+
+def csv_df_to_grouped_docs(
+    df: pd.DataFrame,
+    source_name: str,
+    group_rows: int = 800,
+    row_offset: int = 0,
+    row_format: str = "json",
+    max_tokens: int | None = CHUNK_TOKENS,
+    table_rows: bool = False,
+) -> list[Document]:
+    """
+    df を行の切れ目で区切ってドキュメント（そのまま1チャンク）にする。
+    row_offset は df の先頭行がCSV全体で何行目か（分割読込用）。
+    1ドキュメントは最大 group_rows 行・max_tokens トークンで、table 形式の列名行は各ドキュメントに入る。
+    metadata の tokens はドキュメント全体のトークン数（検索時のコンテキスト予算に使う）。
+    table_rows は df が結合済みの市区町村テーブルから取り出した表の場合。行番号は元のCSVの行ではないので、
+    metadata は table_row_from / table_row_to、本文は「市区町村テーブルの行:」にする。
+    """
+    header, lines = serialize_rows(df, row_format)
+    head = f"列: {header}\n" if header else ""
+    row_key, row_label = ("table_row", "市区町村テーブルの行") if table_rows else ("row", "行")
+
+    def content(start: int, end: int) -> str:
+        text = "\n".join(lines[start:end])
+        return f"ファイル: {source_name}\n{row_label}: {row_offset + start + 1}-{row_offset + end}\n{head}内容:\n{text}"
+
+    # 市区町村コードのある表は都道府県ごとに区切り、チャンクに地域コードを付ける（検索時の絞り込み用）
+    codes = None
+    if CODE_COLUMN in df.columns:
+        codes = pd.to_numeric(df[CODE_COLUMN], errors="coerce").to_numpy(dtype="float64", na_value=np.nan)
+    pref_keys = None if codes is None else [_pref_of_code(c) for c in codes]
+
+    # 見出し部分は行番号の桁数が最大の場合で見積もる
+    reserved = count_tokens([content(len(lines), len(lines))]) if max_tokens is not None else 0
+    ranges = pack_row_ranges(token_counts(lines), max_tokens, group_rows, reserved, keys=pref_keys)
+
+    texts = [content(start, end) for start, end in ranges]
+    docs = []
+    for (start, end), text, tokens in zip(ranges, texts, token_counts(texts)):
+        metadata = {
+            "source": source_name,
+            f"{row_key}_from": row_offset + start + 1,
+            f"{row_key}_to": row_offset + end,
+            "row_format": row_format,
+            "tokens": tokens,
+        }
+        if codes is not None:
+            metadata.update(_area_metadata(codes[start:end]))
+        docs.append(Document(page_content=text, metadata=metadata))
+    return docs
+
+
+def _pref_of_code(code: float) -> int | None:
+    """市区町村コード（5桁）または都道府県コード（2桁）を数値化したものから都道府県コードを返す"""
+    if np.isnan(code):
+        return None
+    return int(code) // 1000 if code >= 1000 else int(code)
+
+
+def _area_metadata(codes: np.ndarray) -> dict:
+    """
+    チャンクの地域メタデータ。pref_code は都道府県コード（1〜47）、
+    muni_code_from / muni_code_to は含まれる市区町村コードの範囲（都道府県の行は 都道府県コード×1000 として扱う）。
+    """
+    codes = codes[~np.isnan(codes)]
+    if not len(codes):
+        return {}
+    munis = np.where(codes >= 1000, codes, codes * 1000).astype(np.int64)
+    return {
+        "pref_code": _pref_of_code(float(codes[0])),
+        "muni_code_from": int(munis.min()),
+        "muni_code_to": int(munis.max()),
+    }
+
+
+def row_range(metadata: dict) -> tuple[int | None, int | None]:
+    """チャンクの行範囲。市区町村データは市区町村テーブルでの行（table_row_from / table_row_to）"""
+    if "table_row_from" in metadata:
+        return metadata.get("table_row_from"), metadata.get("table_row_to")
+    return metadata.get("row_from"), metadata.get("row_to")
+
+
+def iter_chunk_ids(chunks) -> Iterator[Document]:
+    """
+    ファイル名と行範囲から安定したチャンクIDを付けながら返す（再開時のスキップ判定に使う）。
+    同じ行範囲が複数チャンクに分割された場合は連番で区別する。
+    """
+    seen = {}
+    for chunk in chunks:
+        md = chunk.metadata
+        row_from, row_to = row_range(md)
+        key = f"{md.get('source')}:{row_from}-{row_to}"
+        n = seen.get(key, 0)
+        seen[key] = n + 1
+        md["chunk_id"] = f"{key}:{n}"
+        yield chunk
+
+
+def assign_chunk_ids(chunks: list[Document]) -> list[Document]:
+    for _ in iter_chunk_ids(chunks):
+        pass
+    return chunks
+
+
+def read_spill(path: Path) -> Iterator[Document]:
+    """parse_source_file が書き出したチャンク（1行1チャンクの JSON）を1件ずつ読む"""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            item = json.loads(line)
+            yield Document(page_content=item["page_content"], metadata=item["metadata"])
+
+
+def iter_csv_grouped_docs(
+    path: Path,
+    group_rows: int = 800,
+    encoding: str = "utf-8",
+    row_format: str = "json",
+    counts: dict | None = None,
+) -> Iterator[Document]:
+    """CSVを group_rows 行ずつ読み込み、読んだ分からドキュメントにして返す。counts["rows"] に読んだ行数を足す"""
+    offset = 0
+    with pd.read_csv(str(path), encoding=encoding, chunksize=group_rows, low_memory=False) as reader:
+        for part in reader:
+            if counts is not None:
+                counts["rows"] = counts.get("rows", 0) + len(part)
+            yield from csv_df_to_grouped_docs(
+                part, source_name=path.name, group_rows=group_rows, row_offset=offset, row_format=row_format,
+            )
+            offset += len(part)
+
+
+def load_source_table(path: Path, encoding: str = "utf-8", cache_dir: Path | None = None) -> pd.DataFrame:
+    """
+    表形式CSVを1つの DataFrame として読む。市区町村データ（人口・医療・居住・教育）は
+    結合済みの市区町村テーブルからそのファイルの項目だけを取り出す。
+    """
+    if path.name in MUNICIPALITY_FILES:
+        return get_feature_store(path.parent, cache_dir, {path.name: encoding}).source_frame(path.name)
+    return pd.read_csv(str(path), encoding=encoding, low_memory=False)
+
+
+def iter_source_documents(
+    path: Path,
+    encoding: str = "utf-8",
+    cache_dir: Path | None = None,
+    counts: dict | None = None,
+) -> Iterator[Document]:
+    """1ファイル分のドキュメントを作った順に返す。counts を渡すと counts["rows"] にドキュメント化した行数を足す"""
+    counts = {} if counts is None else counts
+    if path.name in MUNICIPALITY_FILES:
+        # CSVを直接読まず、結合済みの市区町村テーブル（Arrowキャッシュがあればそれ）から区切りごとに作る
+        store = get_feature_store(path.parent, cache_dir, {path.name: encoding})
+        row_format = row_format_for(path.name)
+        for offset, df in store.iter_source_frames(path.name, rows=800):
+            counts["rows"] = counts.get("rows", 0) + len(df)
+            yield from csv_df_to_grouped_docs(
+                df, source_name=path.name, group_rows=800, row_offset=offset, row_format=row_format, table_rows=True,
+            )
+    elif path.name == "tenpo2511.csv":
+        # 整形（melt）に全体が必要だが、元データは小さいのでまとめて読む
+        long_df = load_tenpo2511_as_long_df(path, encoding=encoding)
+        counts["rows"] = counts.get("rows", 0) + len(long_df)
+        yield from tenpo_long_df_to_docs(
+            long_df, source_name=path.name, group_rows=1200, max_tokens=CHUNK_TOKENS, by_prefecture=True,
+        )
+    else:
+        yield from iter_csv_grouped_docs(
+            path, group_rows=800, encoding=encoding, row_format=row_format_for(path.name), counts=counts,
+        )
+
+
+def _read_csv_safely(path: Path, **kwargs) -> pd.DataFrame:
+    try:
+        return pd.read_csv(str(path), low_memory=False, **kwargs)
+    except UnicodeDecodeError:
+        return pd.read_csv(str(path), low_memory=False, encoding="cp932", **kwargs)
+
+
+def load_tenpo2511_as_long_df(path: Path, encoding: str | None = None) -> pd.DataFrame:
+    if encoding:
+        df = pd.read_csv(str(path), low_memory=False, encoding=encoding, header=2)
+    else:
+        df = _read_csv_safely(path, header=2)
+
+    if len(df.columns) >= 2:
+        df = df.rename(columns={df.columns[0]: "year", df.columns[1]: "timing"})
+
+    for col in ["合計", "集計日", "year", "timing"]:
+        if col not in df.columns:
+            pass
+
+    id_cols = [c for c in ["year", "timing", "集計日"] if c in df.columns]
+    if not id_cols:
+        raise ValueError("tenpo2511.csv のヘッダー解析に失敗しました（year/timing/集計日が見つかりません）")
+
+    exclude = set(id_cols) | {"合計"}
+    pref_cols = [c for c in df.columns if c not in exclude]
+
+    long_df = df.melt(
+        id_vars=id_cols,
+        value_vars=pref_cols,
+        var_name="prefecture",
+        value_name="store_count",
+    )
+
+    long_df["store_count"] = pd.to_numeric(long_df["store_count"], errors="coerce")
+    long_df = long_df.dropna(subset=["store_count"]).reset_index(drop=True)
+
+    if "集計日" in long_df.columns:
+        long_df["date"] = long_df["集計日"].astype(str)
+    else:
+        long_df["date"] = ""
+
+    if "year" not in long_df.columns:
+        long_df["year"] = ""
+    if "timing" not in long_df.columns:
+        long_df["timing"] = ""
+
+    return long_df[["year", "timing", "date", "prefecture", "store_count"]]
+
+
+def _text_column(values: pd.Series) -> np.ndarray:
+    # f-string と同じ文字列表現にそろえる（NaN は "nan"）
+    return np.asarray(values, dtype=object).astype(str).astype(object)
+
+
+def tenpo_long_df_to_docs(
+    long_df: pd.DataFrame,
+    source_name: str,
+    group_rows: int = 1200,
+    max_tokens: int | None = None,
+    by_prefecture: bool = False,
+) -> list[Document]:
+    """
+    整形済みの店舗数データを1行1文にしてドキュメント化する。
+    文の組み立ては列単位でまとめて行う（max_tokens と by_prefecture を指定しなければ iterrows 版と出力は同一）。
+    max_tokens を指定すると、文の切れ目で区切って1ドキュメントをそのトークン数以内にする。
+    by_prefecture を指定すると都道府県が変わる行で区切り、metadata に pref_code を付ける。
+    """
+    store_count = np.asarray(long_df["store_count"], dtype="float64")
+    missing = np.isnan(store_count)
+    counts = _text_column(pd.Series(np.where(missing, 0, store_count).astype(np.int64)))
+    if missing.any():
+        counts = np.where(missing, _text_column(long_df["store_count"]), counts)
+
+    lines = (
+        "スーパー店舗数。" + _text_column(long_df["year"]) + " " + _text_column(long_df["timing"])
+        + "（集計日 " + _text_column(long_df["date"]) + "）"
+        + _text_column(long_df["prefecture"]) + "の店舗数は" + counts + "。"
+    )
+
+    row_tokens = token_counts(list(lines)) if max_tokens is not None else [0] * len(lines)
+    prefs = [pref_code_of(str(p)) for p in long_df["prefecture"]] if by_prefecture else None
+    docs = []
+    for start, end in pack_row_ranges(row_tokens, max_tokens, group_rows, keys=prefs):
+        metadata = {"source": source_name, "row_from": start + 1, "row_to": end}
+        if prefs is not None and prefs[start] is not None:
+            metadata["pref_code"] = prefs[start]
+        docs.append(Document(page_content="\n".join(lines[start:end]), metadata=metadata))
+    if max_tokens is not None:
+        for doc, tokens in zip(docs, token_counts([d.page_content for d in docs])):
+            doc.metadata["tokens"] = tokens
+    return docs
+
+
+def tenpo_long_df_to_docs_iterrows(long_df: pd.DataFrame, source_name: str, group_rows: int = 1200) -> list[Document]:
+    """行ごとに文を組み立てる旧実装（ベンチマークと出力一致の確認用）"""
+    docs = []
+    total = len(long_df)
+    for start in range(0, total, group_rows):
+        end = min(start + group_rows, total)
+        part = long_df.iloc[start:end]
+
+        lines = []
+        for _, r in part.iterrows():
+            sc = int(r["store_count"]) if pd.notna(r["store_count"]) else r["store_count"]
+            lines.append(
+                f"スーパー店舗数。{r['year']} {r['timing']}（集計日 {r['date']}）"
+                f"{r['prefecture']}の店舗数は{sc}。"
+            )
+
+        docs.append(
+            Document(
+                page_content="\n".join(lines),
+                metadata={"source": source_name, "row_from": start + 1, "row_to": end},
+            )
+        )
+    return docs
+
+
+def parse_source_file(path: str, spill_path: str, encoding_hint: str | None = None, cache_dir: str | None = None) -> dict:
+    """
+    1ファイルを読み込み、チャンク化とID付与まで行う（プロセスプールのワーカーで実行される）。
+    チャンクはできた順に spill_path（1行1チャンクの JSON）へ書き出し、メモリにもプロセス間の受け渡しにも溜めない。
+    親プロセスは read_spill で1件ずつ読む。
+    ドキュメントは作成時にトークン数の上限内で行の切れ目に区切ってあるので、そのまま1チャンクになる。
+    前回検出したエンコーディングがあれば最初にそれで読み、失敗したら他の候補で読み直す。
+    cache_dir は e-Stat 形式の整形済みデータ（Parquet）の置き場所。
+    """
+    path = Path(path)
+    started = time.perf_counter()
+
+    last_error = None
+    for encoding in dict.fromkeys([encoding_hint, *CSV_ENCODINGS]):
+        if not encoding:
+            continue
+        chunks = 0
+        counts = {"rows": 0}
+        try:
+            with open(spill_path, "w", encoding="utf-8") as spill:
+                docs = iter_source_documents(path, encoding=encoding, cache_dir=cache_dir, counts=counts)
+                for doc in iter_chunk_ids(docs):
+                    chunks += 1
+                    spill.write(json.dumps({"page_content": doc.page_content, "metadata": doc.metadata}, ensure_ascii=False))
+                    spill.write("\n")
+        except UnicodeDecodeError as e:
+            last_error = e
+            continue
+
+        if path.name in MUNICIPALITY_FILES:
+            # 市区町村データは FeatureStore 側で文字コードを判定している
+            encoding = get_feature_store(path.parent, cache_dir).encodings.get(path.name, encoding)
+        return {
+            "name": path.name,
+            "encoding": encoding,
+            "rows": counts["rows"],
+            "chunks": chunks,
+            "spill": spill_path,
+            "seconds": time.perf_counter() - started,
+        }
+
+    raise last_error
@@ -0,0 +1,206 @@
+import asyncio
+import os
+import threading
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from django.db.models import F
+from django.utils import timezone
+
+from .admission import Busy
+from .models import RecommendationJob
+
+# 提案の生成・RAGの初期化ジョブのキュー（DBのテーブル）とワーカー。
+# ジョブはDBにあるので、サーバーやワーカーを再起動しても続きから処理する（running のまま止まったものは入れ直す）。
+# LLMへの同時リクエスト数は、ワーカー1つあたり JOB_CONCURRENCY まで。
+
+JOB_CONCURRENCY = int(os.getenv("RAG_JOB_CONCURRENCY", "4"))
+JOB_MAX_ATTEMPTS = int(os.getenv("RAG_JOB_MAX_ATTEMPTS", "3"))
+# running のまま この秒数を過ぎたジョブは、ワーカーが落ちたものとみなして入れ直す
+JOB_STALE_SECONDS = float(os.getenv("RAG_JOB_STALE_SECONDS", "600"))
+# 待機中のジョブが無いときの問い合わせ間隔。空が続くと JOB_POLL_SECONDS から倍々に JOB_IDLE_POLL_MAX_SECONDS まで延ばす
+JOB_POLL_SECONDS = float(os.getenv("RAG_JOB_POLL_SECONDS", "0.5"))
+JOB_IDLE_POLL_MAX_SECONDS = float(os.getenv("RAG_JOB_IDLE_POLL_MAX_SECONDS", "5"))
+# 長く動かすワーカーが止まったジョブを拾い直す間隔
+JOB_STALE_CHECK_SECONDS = float(os.getenv("RAG_JOB_STALE_CHECK_SECONDS", "60"))
+# プロセス内のワーカーは、この秒数ジョブが無ければ終了する（次の登録・状態の問い合わせで起動し直す）
+JOB_IDLE_EXIT_SECONDS = float(os.getenv("RAG_JOB_IDLE_EXIT_SECONDS", "300"))
+# 別プロセスのワーカー（manage.py run_recommendation_worker）を使う場合は 0 にする
+JOB_INPROCESS_WORKER = os.getenv("RAG_JOB_INPROCESS_WORKER", "1") == "1"
+
+_worker_thread = None
+_worker_lock = threading.Lock()
+
+
+def is_error_result(result: dict) -> bool:
+    return result.get("headline", "").startswith(("【システムエラー】", "【エラー】"))
+
+
+def enqueue(answers: dict, session_key: str = "", user=None) -> RecommendationJob:
+    return RecommendationJob.objects.create(
+        answers=answers,
+        session_key=session_key or "",
+        user=user if user is not None and user.is_authenticated else None,
+    )
+
+
+def enqueue_init() -> RecommendationJob:
+    """RAGの初期化ジョブ。待機中・実行中のものがあればそれを返す（二重に作らない）"""
+    pending = RecommendationJob.objects.filter(
+        kind=RecommendationJob.INIT, status__in=(RecommendationJob.QUEUED, RecommendationJob.RUNNING)
+    ).order_by("created_at").first()
+    if pending is not None:
+        return pending
+    return RecommendationJob.objects.create(kind=RecommendationJob.INIT, answers={})
+
+
+def requeue_stale() -> int:
+    """実行中のまま JOB_STALE_SECONDS を過ぎたジョブを待機中に戻す（試行回数を使い切ったものは失敗にする）"""
+    cutoff = timezone.now() - timedelta(seconds=JOB_STALE_SECONDS)
+    stale = RecommendationJob.objects.filter(status=RecommendationJob.RUNNING, started_at__lt=cutoff)
+    failed = stale.filter(attempts__gte=JOB_MAX_ATTEMPTS).update(
+        status=RecommendationJob.FAILED, error="ワーカーが応答しませんでした", finished_at=timezone.now()
+    )
+    requeued = stale.update(status=RecommendationJob.QUEUED)
+    if failed or requeued:
+        print(f"RAG: 止まっていたジョブを入れ直しました（{requeued}件、失敗 {failed}件）")
+    return requeued
+
+
+async def claim_next() -> RecommendationJob | None:
+    """
+    一番古い待機中のジョブを実行中にして返す。
+    別のワーカーと同じジョブを取り合っても、status が queued のままの方だけが更新できる。
+    """
+    while True:
+        job = await RecommendationJob.objects.filter(status=RecommendationJob.QUEUED).order_by("created_at").afirst()
+        if job is None:
+            return None
+        claimed = await RecommendationJob.objects.filter(pk=job.pk, status=RecommendationJob.QUEUED).aupdate(
+            status=RecommendationJob.RUNNING, started_at=timezone.now(), attempts=F("attempts") + 1
+        )
+        if claimed:
+            await job.arefresh_from_db()
+            return job
+
+
+async def run_init_job(job: RecommendationJob, initialize) -> None:
+    """initialize() を await する（True で成功）。失敗しても入れ直さない（次の rag_init で登録し直す）"""
+    try:
+        if initialize is None:
+            raise RuntimeError("このワーカーは初期化ジョブを実行できません")
+        ok, error = bool(await initialize()), ""
+    except Exception as e:
+        ok, error = False, str(e)
+    if not ok and not error:
+        error = "RAGの初期化に失敗しました"
+    await RecommendationJob.objects.filter(pk=job.pk).aupdate(
+        status=RecommendationJob.DONE if ok else RecommendationJob.FAILED,
+        result={"ok": ok},
+        error=error,
+        finished_at=timezone.now(),
+    )
+    print(f"RAG: 初期化ジョブ {job.pk} → {'done' if ok else 'failed'}")
+
+
+async def run_job(job: RecommendationJob, recommend, initialize=None) -> None:
+    """recommend(answers) を await して結果を保存する。失敗したら JOB_MAX_ATTEMPTS まで入れ直す"""
+    if job.kind == RecommendationJob.INIT:
+        await run_init_job(job, initialize)
+        return
+    try:
+        result = await recommend(job.answers)
+    except Busy as e:
+        # 混雑は失敗に数えず、待機中に戻してから少し間を空ける
+        await RecommendationJob.objects.filter(pk=job.pk).aupdate(
+            status=RecommendationJob.QUEUED, attempts=F("attempts") - 1
+        )
+        await asyncio.sleep(e.retry_after)
+        return
+    except Exception as e:
+        result = {"headline": "【システムエラー】ジョブの実行に失敗しました", "spots": [f"エラー詳細: {e}"]}
+
+    fields = {"result": result, "error": "", "finished_at": timezone.now(), "status": RecommendationJob.DONE}
+    if is_error_result(result):
+        fields["error"] = result.get("headline", "")
+        if job.attempts < JOB_MAX_ATTEMPTS:
+            fields.update(status=RecommendationJob.QUEUED, result=None, finished_at=None)
+        else:
+            fields["status"] = RecommendationJob.FAILED
+    await RecommendationJob.objects.filter(pk=job.pk).aupdate(**fields)
+    print(f"RAG: ジョブ {job.pk} → {fields['status']}（{job.attempts}回目）")
+
+
+class JobWorker:
+    """
+    concurrency 個のループがそれぞれジョブを取り出して recommend（初期化ジョブは initialize）を await する。
+    idle_exit 秒ジョブが無ければ終わる（None なら動き続ける）。
+    """
+
+    def __init__(
+        self,
+        recommend,
+        concurrency: int = JOB_CONCURRENCY,
+        poll: float = JOB_POLL_SECONDS,
+        initialize=None,
+        idle_exit: float | None = None,
+    ):
+        self.recommend = recommend
+        self.initialize = initialize
+        self.concurrency = max(1, concurrency)
+        self.poll = poll
+        self.idle_exit = idle_exit
+
+    async def run(self, once: bool = False) -> None:
+        """once なら待機中のジョブが無くなったところで終わる"""
+        await sync_to_async(requeue_stale)()
+        await asyncio.gather(*(self._loop(once) for _ in range(self.concurrency)))
+
+    def idle_delay(self, idle: int) -> float:
+        """空振りが idle 回続いたときの待ち時間（倍々に延ばし、JOB_IDLE_POLL_MAX_SECONDS で頭打ち）"""
+        return min(self.poll * 2 ** min(idle - 1, 16), max(self.poll, JOB_IDLE_POLL_MAX_SECONDS))
+
+    async def _loop(self, once: bool) -> None:
+        idle = 0
+        idle_since = last_check = time.monotonic()
+        while True:
+            job = await claim_next()
+            if job is not None:
+                await run_job(job, self.recommend, self.initialize)
+                idle = 0
+                idle_since = time.monotonic()
+                continue
+            if once:
+                return
+            now = time.monotonic()
+            if self.idle_exit is not None and now - idle_since >= self.idle_exit:
+                return
+            if now - last_check >= JOB_STALE_CHECK_SECONDS:
+                # 長く動かすプロセスなので、切れたDB接続を捨てて止まったジョブを拾い直す
+                await sync_to_async(close_old_connections)()
+                await sync_to_async(requeue_stale)()
+                last_check = now
+            idle += 1
+            await asyncio.sleep(self.idle_delay(idle))
+
+
+def start_background_worker(recommend, initialize=None) -> None:
+    """
+    プロセス内のワーカー（デーモンスレッドのイベントループ）を1つだけ起動する。
+    JOB_IDLE_EXIT_SECONDS ジョブが無ければスレッドごと終わるので、ジョブを登録・確認するときに毎回呼ぶ。
+    """
+    global _worker_thread
+    with _worker_lock:
+        if _worker_thread is not None and _worker_thread.is_alive():
+            return
+
+        def runner():
+            try:
+                asyncio.run(JobWorker(recommend, initialize=initialize, idle_exit=JOB_IDLE_EXIT_SECONDS).run())
+            except Exception as e:
+                print(f"RAG: ジョブワーカーが停止しました: {e}")
+
+        _worker_thread = threading.Thread(target=runner, name="recommendation-jobs", daemon=True)
+        _worker_thread.start()
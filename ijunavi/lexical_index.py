@@ -0,0 +1,185 @@
+import unicodedata
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+
+# チャンク本文の文字 n-gram による BM25 転置インデックス。
+# 形態素解析なしで日本語の地名・語句（「沖縄」「小学校」など）を完全一致に近い形で引ける。
+# ベクトルDBと同じディレクトリに .npz で保存し、ID は Chroma のチャンクIDと共通。
+
+NGRAM = 2
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# 保存形式を変えたら上げる（古いファイルは読まずに作り直す）
+INDEX_VERSION = 2
+
+# チャンクのメタデータに地域コードが無いときの値
+NO_AREA = -1
+
+
+def normalize(text: str) -> str:
+    return unicodedata.normalize("NFKC", text).lower()
+
+
+def ngrams(text: str, n: int = NGRAM) -> list[str]:
+    """空白・改行をまたがない文字 n-gram（n 文字未満の語はそのまま1語として扱う）"""
+    grams = []
+    for word in normalize(text).split():
+        if len(word) < n:
+            grams.append(word)
+            continue
+        grams.extend(word[i:i + n] for i in range(len(word) - n + 1))
+    return grams
+
+
+class LexicalIndex:
+    """
+    CSR 形式の転置インデックス（語ごとに文書番号と出現回数の配列）。
+    search() は BM25 の上位文書と、クエリの語（idf の重み）のうち上位文書が含む割合 coverage を返す。
+    """
+
+    def __init__(self, ids, vocab, indptr, postings, tfs, doc_len, areas=None, fingerprint: str = ""):
+        self.ids = np.asarray(ids)
+        self.vocab = np.asarray(vocab)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.postings = np.asarray(postings, dtype=np.int32)
+        self.tfs = np.asarray(tfs, dtype=np.float32)
+        self.doc_len = np.asarray(doc_len, dtype=np.float32)
+        # 文書ごとの (pref_code, muni_code_from, muni_code_to)。地域での絞り込みに使う
+        if areas is None:
+            areas = np.full((len(self.ids), 3), NO_AREA)
+        self.areas = np.asarray(areas, dtype=np.int64).reshape(len(self.ids), 3)
+        self.fingerprint = fingerprint
+
+        self._terms = {term: i for i, term in enumerate(self.vocab.tolist())}
+        n_docs = len(self.ids)
+        df = np.diff(self.indptr).astype(np.float64)
+        self.idf = np.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+        self.avg_len = float(self.doc_len.mean()) if n_docs else 0.0
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def build(
+        cls, ids: list[str], texts: list[str], metadatas: list[dict] | None = None, fingerprint: str = ""
+    ) -> "LexicalIndex":
+        terms = {}
+        rows, cols, counts = [], [], []
+        doc_len = np.zeros(len(texts), dtype=np.float32)
+        for d, text in enumerate(texts):
+            grams = Counter(ngrams(text))
+            doc_len[d] = sum(grams.values())
+            for gram, count in grams.items():
+                rows.append(terms.setdefault(gram, len(terms)))
+                cols.append(d)
+                counts.append(count)
+
+        rows = np.asarray(rows, dtype=np.int64)
+        order = np.argsort(rows, kind="stable")
+        indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(terms)), out=indptr[1:])
+        vocab = np.empty(len(terms), dtype=object)
+        for term, i in terms.items():
+            vocab[i] = term
+        return cls(
+            ids=np.asarray(ids, dtype=str),
+            vocab=vocab.astype(str),
+            indptr=indptr,
+            postings=np.asarray(cols, dtype=np.int32)[order],
+            tfs=np.asarray(counts, dtype=np.float32)[order],
+            doc_len=doc_len,
+            areas=[_area_of(md) for md in (metadatas or [{}] * len(texts))],
+            fingerprint=fingerprint,
+        )
+
+    def save(self, path: Path) -> None:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "wb") as f:
+            np.savez(
+                f,
+                version=np.int64(INDEX_VERSION),
+                fingerprint=np.str_(self.fingerprint),
+                ids=self.ids,
+                vocab=self.vocab,
+                indptr=self.indptr,
+                postings=self.postings,
+                tfs=self.tfs,
+                doc_len=self.doc_len,
+                areas=self.areas,
+            )
+        tmp.replace(path)
+
+    @classmethod
+    def load(cls, path: Path) -> "LexicalIndex | None":
+        """保存形式が古い・壊れている場合は None"""
+        try:
+            with np.load(str(path), allow_pickle=False) as data:
+                if int(data["version"]) != INDEX_VERSION:
+                    return None
+                return cls(
+                    ids=data["ids"],
+                    vocab=data["vocab"],
+                    indptr=data["indptr"],
+                    postings=data["postings"],
+                    tfs=data["tfs"],
+                    doc_len=data["doc_len"],
+                    areas=data["areas"],
+                    fingerprint=str(data["fingerprint"]),
+                )
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def area_mask(self, prefs=(), munis=()) -> np.ndarray:
+        """pref_code が prefs のどれか、またはコード範囲が munis のどれかを含む文書のマスク"""
+        pref, lo, hi = self.areas.T
+        mask = np.isin(pref, list(prefs))
+        for muni in munis:
+            mask |= (lo <= muni) & (hi >= muni) & (lo != NO_AREA)
+        return mask
+
+    def search(self, query: str, k: int = 10, mask: np.ndarray | None = None) -> tuple[list[str], np.ndarray, float]:
+        """
+        BM25 の上位 k 件の (チャンクID, スコア) と、最上位の文書の coverage（0〜1）を返す。
+        coverage はクエリの語の idf 合計のうち、最上位の文書に含まれる語の割合。
+        mask を渡すと、その文書（area_mask() など）だけから選ぶ。
+        """
+        term_ids = sorted({self._terms[g] for g in ngrams(query) if g in self._terms})
+        query_terms = set(ngrams(query))
+        if not term_ids or not len(self.ids):
+            return [], np.zeros(0), 0.0
+
+        scores = np.zeros(len(self.ids), dtype=np.float64)
+        matched_idf = np.zeros(len(self.ids), dtype=np.float64)
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_len / max(self.avg_len, 1e-9))
+        for t in term_ids:
+            start, end = self.indptr[t], self.indptr[t + 1]
+            docs = self.postings[start:end]
+            tf = self.tfs[start:end]
+            scores[docs] += self.idf[t] * tf * (BM25_K1 + 1) / (tf + norm[docs])
+            matched_idf[docs] += self.idf[t]
+        if mask is not None:
+            scores[~mask] = 0.0
+
+        k = min(k, int((scores > 0).sum()))
+        if k == 0:
+            return [], np.zeros(0), 0.0
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+
+        # 索引に無い語も分母に入れる（その語を含む文書は無いので、idf は最大値で見積もる）
+        unknown = len(query_terms) - len(term_ids)
+        total_idf = self.idf[term_ids].sum() + unknown * float(self.idf.max(initial=0.0))
+        coverage = float(matched_idf[top[0]] / total_idf) if total_idf > 0 else 0.0
+        return self.ids[top].tolist(), scores[top], coverage
+
+
+def _area_of(metadata: dict | None) -> tuple[int, int, int]:
+    """チャンクのメタデータから (pref_code, muni_code_from, muni_code_to)。無いものは NO_AREA"""
+    metadata = metadata or {}
+    values = [metadata.get(key) for key in ("pref_code", "muni_code_from", "muni_code_to")]
+    return tuple(NO_AREA if v is None else int(v) for v in values)
@@ -0,0 +1,60 @@
+import time
+
+import numpy as np
+import pandas as pd
+from django.core.management.base import BaseCommand
+
+from ijunavi.estat import PREFECTURES
+from ijunavi.ingest import tenpo_long_df_to_docs, tenpo_long_df_to_docs_iterrows
+
+
+def make_long_df(rows: int, seed: int = 0) -> pd.DataFrame:
+    """load_tenpo2511_as_long_df と同じ列構成の合成データ（都道府県 × 集計日）"""
+    rng = np.random.default_rng(seed)
+    idx = np.arange(rows)
+    dates = pd.date_range("2000-01-01", periods=rows // len(PREFECTURES) + 1, freq="D")
+    day = dates[idx // len(PREFECTURES)]
+    return pd.DataFrame({
+        "year": day.year,
+        "timing": np.where(day.day <= 15, "上旬", "下旬"),
+        "date": day.strftime("%Y-%m-%d"),
+        "prefecture": np.array(PREFECTURES, dtype=object)[idx % len(PREFECTURES)],
+        "store_count": rng.integers(0, 5000, rows).astype("float64"),
+    })
+
+
+class Command(BaseCommand):
+    help = "tenpo2511.csv のドキュメント化（列演算版 と iterrows版）の速度を比較する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+        parser.add_argument("--repeat", type=int, default=1, help="各サイズの計測回数（最速値を表示）")
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'rows':>10} {'iterrows[s]':>12} {'vectorized[s]':>14} {'speedup':>8}  identical")
+        for rows in options["rows"]:
+            long_df = make_long_df(rows)
+
+            t_old, old_docs = self._measure(tenpo_long_df_to_docs_iterrows, long_df, options["repeat"])
+            t_new, new_docs = self._measure(tenpo_long_df_to_docs, long_df, options["repeat"])
+
+            identical = (
+                [d.page_content for d in old_docs] == [d.page_content for d in new_docs]
+                and [d.metadata for d in old_docs] == [d.metadata for d in new_docs]
+            )
+            self.stdout.write(
+                f"{rows:>10} {t_old:>12.3f} {t_new:>14.3f} {t_old / t_new:>7.1f}x  {'yes' if identical else 'NO'}"
+            )
+            if not identical:
+                self.stderr.write(self.style.ERROR(f"{rows}行: 出力が一致しません"))
+
+    @staticmethod
+    def _measure(func, long_df, repeat):
+        best = None
+        docs = None
+        for _ in range(max(1, repeat)):
+            started = time.perf_counter()
+            docs = func(long_df, source_name="tenpo2511.csv", group_rows=1200)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return best, docs
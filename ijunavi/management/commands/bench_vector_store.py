@@ -0,0 +1,113 @@
+import multiprocessing
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from langchain_core.documents import Document
+
+from ijunavi.embedding_pipeline import PrecomputedEmbeddings, write_batch
+from ijunavi.numpy_store import NumpyVectorStore
+
+# 作成時間・（別プロセスでの）オープン時間・検索のレイテンシを Chroma と NumpyVectorStore で比べる。
+# 埋め込みは乱数のベクトルを使うので、APIキーは不要。
+
+
+def open_store(backend: str, path: str):
+    if backend == "numpy":
+        return NumpyVectorStore(path)
+    from langchain_chroma import Chroma
+
+    return Chroma(persist_directory=path, embedding_function=PrecomputedEmbeddings())
+
+
+def measure_open(backend: str, path: str, dim: int) -> tuple[float, float]:
+    """新しいプロセスで (ストアを開く時間, 最初の検索までの時間) を測る（コールドスタートの再現）"""
+    if backend == "chroma":
+        import langchain_chroma  # noqa: F401  モジュールの読み込み時間は含めない
+    start = time.perf_counter()
+    store = open_store(backend, path)
+    opened = time.perf_counter() - start
+    store.similarity_search_by_vector(np.ones(dim, dtype=np.float32).tolist(), k=4)
+    return opened, time.perf_counter() - start
+
+
+def percentiles(samples: list[float]) -> str:
+    p50, p99 = np.percentile(np.asarray(samples) * 1000, [50, 99])
+    return f"p50 {p50:7.2f}ms  p99 {p99:7.2f}ms"
+
+
+class Command(BaseCommand):
+    help = "ベクトルDBの実装（chroma / numpy）ごとに作成・オープン・検索の時間を比べる"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--backends", nargs="+", choices=("chroma", "numpy"), default=["chroma", "numpy"])
+        parser.add_argument("--size", type=int, default=3000, help="チャンク数")
+        parser.add_argument("--dim", type=int, default=1536, help="埋め込みの次元数")
+        parser.add_argument("--queries", type=int, default=200)
+        parser.add_argument("--batch", type=int, default=200, help="1回の書き込みのチャンク数（DB作成時と同じ）")
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(0)
+        size, dim = options["size"], options["dim"]
+        vectors = rng.standard_normal((size, dim), dtype=np.float32)
+        queries = rng.standard_normal((options["queries"], dim), dtype=np.float32)
+        documents = [
+            Document(
+                page_content=f"チャンク{i}",
+                metadata={
+                    "source": "bench.csv",
+                    "pref_code": i % 47 + 1,
+                    "row_from": i,
+                    "row_to": i,
+                    "chunk_id": f"bench.csv:{i}-{i}:0",
+                },
+            )
+            for i in range(size)
+        ]
+        where = {"pref_code": {"$in": [13, 47]}}
+
+        self.stdout.write(f"{size}チャンク × {dim}次元、検索 {len(queries)}回（k=4、MMR は fetch_k=10）")
+        ctx = multiprocessing.get_context("spawn")
+        tmp = Path(tempfile.mkdtemp(prefix="bench_vector_store_"))
+        try:
+            for backend in options["backends"]:
+                path = str(tmp / backend)
+                store = open_store(backend, path)
+
+                start = time.perf_counter()
+                for i in range(0, size, options["batch"]):
+                    end = i + options["batch"]
+                    write_batch(store, documents[i:end], vectors[i:end].tolist())
+                if backend == "numpy":
+                    store.compact()
+                built = time.perf_counter() - start
+                del store
+
+                with ctx.Pool(1) as pool:
+                    opened, first = pool.apply(measure_open, (backend, path, dim))
+
+                store = open_store(backend, path)
+                timings = {"top-k": [], "mmr": [], "top-k+where": []}
+                for q in queries:
+                    q = q.tolist()
+                    for name, search in (
+                        ("top-k", lambda: store.similarity_search_by_vector(q, k=4)),
+                        ("mmr", lambda: store.max_marginal_relevance_search_by_vector(q, k=4, fetch_k=10)),
+                        ("top-k+where", lambda: store.similarity_search_by_vector(q, k=4, filter=where)),
+                    ):
+                        start = time.perf_counter()
+                        search()
+                        timings[name].append(time.perf_counter() - start)
+
+                self.stdout.write(
+                    f"[{backend}] 作成 {built:.2f}秒 / オープン {opened * 1000:.1f}ms"
+                    f"（最初の検索まで {first * 1000:.1f}ms）"
+                )
+                for name, samples in timings.items():
+                    self.stdout.write(f"  {name:<12} {percentiles(samples)}")
+                del store
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
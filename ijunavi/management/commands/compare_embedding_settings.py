@@ -0,0 +1,90 @@
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from ijunavi import rag_service
+from ijunavi.management.commands.compare_row_formats import make_queries
+from ijunavi.numpy_store import NumpyVectorStore, normalize_rows
+
+# 埋め込みの次元数・int8 量子化ごとに、フル精度（既定の次元数・float32）の検索結果をどれだけ再現できるか
+# （recall@k）と、索引の大きさ・検索時間を比べる。
+# text-embedding-3-* の次元の短縮は「先頭 d 次元を取って正規化し直す」のと同じなので、
+# APIで埋め込むのはフル次元の1回だけ（埋め込みキャッシュ有効）。
+
+
+class Command(BaseCommand):
+    help = "埋め込みの次元数と int8 量子化の組み合わせごとに recall@k・索引サイズ・検索時間を比べる"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dims", nargs="+", type=int, default=[1536, 1024, 512, 256])
+        parser.add_argument("--quantization", nargs="+", choices=("none", "int8"), default=["none", "int8"])
+        parser.add_argument("--samples", type=int, default=100, help="質問数（市区町村テーブルの行から作る）")
+        parser.add_argument("-k", type=int, default=4)
+        parser.add_argument("--rescore-factor", type=int, default=4, help="int8 で float32 に並べ替える候補数（k の倍数）")
+
+    def handle(self, *args, **options):
+        openai_key = os.getenv("OPENAI_API_KEY")
+        if not openai_key:
+            raise CommandError("OPENAI_API_KEY が必要です。")
+        embeddings = rag_service.make_embeddings(openai_key, dimensions=None)
+        k = options["k"]
+
+        chunks = list(rag_service.load_and_split_documents())
+        queries = [q for _, q in make_queries(rag_service.get_features().frame, options["samples"])]
+        if not chunks or not queries:
+            raise CommandError("チャンクまたは質問を作れませんでした。")
+
+        full_docs = normalize_rows(embeddings.embed_documents([c.page_content for c in chunks]))
+        full_queries = normalize_rows(embeddings.embed_documents(queries))
+        truth = np.argsort(-(full_queries @ full_docs.T), axis=1)[:, :k]
+
+        ids = [c.metadata.get("chunk_id") or str(i) for i, c in enumerate(chunks)]
+        position = {chunk_id: i for i, chunk_id in enumerate(ids)}
+        self.stdout.write(f"{len(chunks)}チャンク、質問 {len(queries)}件（正解はフル次元 float32 の上位 {k} 件）")
+        self.stdout.write(f"{'dims':>5} {'quant':<6} {'index':>10} {'recall@' + str(k):>9} {'p50':>8} {'p99':>8}")
+
+        tmp = Path(tempfile.mkdtemp(prefix="compare_embedding_settings_"))
+        try:
+            for dims in options["dims"]:
+                if dims > full_docs.shape[1]:
+                    self.stderr.write(f"{dims}次元: モデルの次元数（{full_docs.shape[1]}）を超えるため省略")
+                    continue
+                doc_vecs = normalize_rows(full_docs[:, :dims])
+                query_vecs = normalize_rows(full_queries[:, :dims])
+                for quant in options["quantization"]:
+                    store = NumpyVectorStore(
+                        tmp / f"{dims}-{quant}",
+                        quantization=None if quant == "none" else quant,
+                        rescore_factor=options["rescore_factor"],
+                    )
+                    store.upsert(
+                        ids=ids,
+                        embeddings=doc_vecs,
+                        documents=[c.page_content for c in chunks],
+                        metadatas=[c.metadata for c in chunks],
+                    )
+
+                    hits, timings = 0, []
+                    for q, expected in zip(query_vecs, truth):
+                        start = time.perf_counter()
+                        docs = store.similarity_search_by_vector(q, k=k)
+                        timings.append(time.perf_counter() - start)
+                        hits += len({position[d.id] for d in docs} & set(expected.tolist()))
+
+                    p50, p99 = np.percentile(np.asarray(timings) * 1000, [50, 99])
+                    self.stdout.write(
+                        f"{dims:>5} {quant:<6} {store.index_bytes() / 1024:>8.0f}KB "
+                        f"{hits / (k * len(queries)):>9.1%} {p50:>6.2f}ms {p99:>6.2f}ms"
+                    )
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        self.stdout.write(
+            "設定は RAG_EMBEDDING_DIMENSIONS / RAG_VECTOR_BACKEND=numpy / RAG_VECTOR_QUANTIZATION=int8。"
+            "index は検索で全体を読む行列の大きさ"
+        )
@@ -0,0 +1,115 @@
+import os
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from ijunavi import rag_service
+from ijunavi.embedding_pipeline import count_tokens
+from ijunavi.estat import NAME_COLUMN, PREF_COLUMN
+from ijunavi.ingest import (
+    CSV_ENCODINGS,
+    MUNICIPALITY_FILES,
+    ROW_FORMATS,
+    csv_df_to_grouped_docs,
+    load_source_table,
+    row_format_for,
+    row_range,
+)
+
+
+def make_queries(df, samples: int, seed: int = 0) -> list[tuple[int, str]]:
+    """
+    行を無作為に選び、その行を答えとする質問文を作る（(行番号, 質問) のリスト。行番号は0始まり）。
+    e-Stat の表は「都道府県市区町村の指標名」、それ以外は行の先頭の文字列値を並べたもの。
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(df), size=min(samples, len(df)), replace=False)
+    value_cols = [c for c in df.columns if str(df[c].dtype) not in ("object", "str", "string", "category")]
+
+    queries = []
+    for i in sorted(int(r) for r in rows):
+        row = df.iloc[i]
+        if NAME_COLUMN in df.columns and value_cols:
+            place = str(row[NAME_COLUMN])
+            if PREF_COLUMN in df.columns and str(row[PREF_COLUMN]) != place:
+                place = f"{row[PREF_COLUMN]}{place}"
+            queries.append((i, f"{place}の{value_cols[rng.integers(len(value_cols))]}"))
+        else:
+            words = [str(v) for v in row.tolist() if isinstance(v, str) and v.strip()][:3]
+            if words:
+                queries.append((i, " ".join(words)))
+    return queries
+
+
+def hit_rate(docs, queries, embeddings, k: int) -> float:
+    """質問ごとに余弦類似度の上位 k 件を取り、答えの行を含むドキュメントがあれば命中とする"""
+    doc_vecs = np.asarray(embeddings.embed_documents([d.page_content for d in docs]), dtype=np.float32)
+    query_vecs = np.asarray(embeddings.embed_documents([q for _, q in queries]), dtype=np.float32)
+    doc_vecs /= np.linalg.norm(doc_vecs, axis=1, keepdims=True)
+    query_vecs /= np.linalg.norm(query_vecs, axis=1, keepdims=True)
+
+    top = np.argsort(-(query_vecs @ doc_vecs.T), axis=1)[:, :k]
+    hits = 0
+    for (row, _), idx in zip(queries, top):
+        ranges = [row_range(docs[j].metadata) for j in idx]
+        hits += any(lo <= row + 1 <= hi for lo, hi in ranges)
+    return hits / len(queries) if queries else 0.0
+
+
+class Command(BaseCommand):
+    help = "表形式CSVの行の書き方（json / table / sentence）ごとにトークン数と検索の命中率を比較する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sources", nargs="+", help="対象のCSV（省略時は tenpo2511.csv 以外のホワイトリスト全部）")
+        parser.add_argument("--formats", nargs="+", choices=ROW_FORMATS, default=list(ROW_FORMATS))
+        parser.add_argument("--hit-rate", action="store_true", help="埋め込みAPIで検索の命中率も測る（キャッシュ有効）")
+        parser.add_argument("--samples", type=int, default=30, help="命中率の計測に使う質問数（ソースごと）")
+        parser.add_argument("-k", type=int, default=4, help="命中とみなす検索順位")
+
+    def handle(self, *args, **options):
+        names = options["sources"] or sorted(n for n in rag_service.ALLOWED_CSV if n != "tenpo2511.csv")
+        embeddings = None
+        if options["hit_rate"]:
+            openai_key = os.getenv("OPENAI_API_KEY")
+            if not openai_key:
+                raise CommandError("--hit-rate には OPENAI_API_KEY が必要です。")
+            embeddings = rag_service.get_embeddings(openai_key)
+
+        header = f"{'source':<16} {'format':<9} {'docs':>5} {'tokens':>10} {'tok/row':>8} {'ratio':>8}"
+        if embeddings is not None:
+            header += f" {'hit@' + str(options['k']):>7}"
+        self.stdout.write(header)
+
+        for name in names:
+            path = rag_service.DATA_DIR / name
+            if not path.exists():
+                self.stderr.write(f"{name}: ファイルがありません")
+                continue
+            df = self._load(path)
+            queries = make_queries(df, options["samples"]) if embeddings is not None else []
+
+            baseline = None
+            for fmt in options["formats"]:
+                docs = csv_df_to_grouped_docs(df, source_name=name, row_format=fmt, table_rows=name in MUNICIPALITY_FILES)
+                tokens = count_tokens([d.page_content for d in docs])
+                if baseline is None:
+                    baseline = tokens
+                current = " *" if fmt == row_format_for(name) else ""
+                line = (
+                    f"{name:<16} {fmt + current:<9} {len(docs):>5} {tokens:>10} "
+                    f"{tokens / max(1, len(df)):>8.1f} {tokens / baseline:>7.2f}x"
+                )
+                if embeddings is not None:
+                    line += f" {hit_rate(docs, queries, embeddings, options['k']):>7.1%}"
+                self.stdout.write(line)
+
+        self.stdout.write("* は現在の設定（SOURCE_ROW_FORMATS / RAG_ROW_FORMATS）。ratio は --formats の先頭の形式とのトークン数の比")
+
+    @staticmethod
+    def _load(path):
+        for encoding in CSV_ENCODINGS:
+            try:
+                return load_source_table(path, encoding=encoding, cache_dir=rag_service.PARQUET_CACHE_DIR)
+            except UnicodeDecodeError:
+                continue
+        raise CommandError(f"{path.name}: 文字コードを判定できません")
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ijunavi import rag_service
+from ijunavi.precomputed import DEFAULT_AGE_DECADES, answer_grid, precompute
+from ijunavi.views import QUESTIONS, build_recommendation_prompt
+
+# ベクトルDBを作り直したあとは RAG の初期化が自動で実行する（RAG_PRECOMPUTE_AFTER_REBUILD）。
+# 手動で作るとき・件数や年代を指定するときに使う。作成済みの組み合わせは飛ばすので、中断しても続きから再開できる。
+# CSVが変わっていれば（フィンガープリントが違えば）全部作り直す。
+
+
+class Command(BaseCommand):
+    help = "チャットの選択肢の全組み合わせ × 年代について、提案を事前に作って保存する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=4, help="同時に生成する数（LLMの同時リクエスト数）")
+        parser.add_argument(
+            "--decades", nargs="+", type=int, default=list(DEFAULT_AGE_DECADES), help="対象の年代（20 → 20代）"
+        )
+        parser.add_argument("--limit", type=int, help="今回作る最大件数（試験用）")
+
+    def handle(self, *args, **options):
+        # このコマンドで作るので、初期化の中では事前計算を始めない
+        if not rag_service.initialize_rag(precompute_after_rebuild=False):
+            raise CommandError("RAGの初期化に失敗しました。")
+
+        def generate(answers: dict) -> dict:
+            return rag_service.generate_recommendation(build_recommendation_prompt(answers), answers=answers)
+
+        counts = precompute(
+            rag_service.get_precomputed_store(),
+            answer_grid(QUESTIONS, options["decades"]),
+            rag_service.recommendation_key,
+            generate,
+            concurrency=options["concurrency"],
+            limit=options["limit"],
+            log=self.stdout.write,
+        )
+        if counts["saved"] or counts["failed"]:
+            self.stdout.write(
+                f"完了: 保存 {counts['saved']}件 / 失敗 {counts['failed']}件（保存先 {rag_service.PRECOMPUTED_PATH}）"
+            )
@@ -0,0 +1,28 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from ijunavi import jobs
+from ijunavi.views import _aget_rag_recommendation, _ainitialize_rag
+
+# 提案・初期化ジョブのワーカー。Webサーバーとは別のプロセスで動かす場合は、Web側で RAG_JOB_INPROCESS_WORKER=0 にする。
+# 複数起動してもよい（同じジョブを二重に実行しない）。LLMへの同時リクエスト数は 起動数 × --concurrency。
+
+
+class Command(BaseCommand):
+    help = "提案の生成ジョブ（RecommendationJob）を取り出して実行する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=jobs.JOB_CONCURRENCY, help="同時に実行するジョブ数")
+        parser.add_argument("--once", action="store_true", help="待機中のジョブを処理し終えたら終了する")
+
+    def handle(self, *args, **options):
+        worker = jobs.JobWorker(
+            _aget_rag_recommendation, concurrency=options["concurrency"], initialize=_ainitialize_rag
+        )
+        self.stdout.write(f"ジョブワーカーを開始します（同時 {worker.concurrency}件）")
+        try:
+            asyncio.run(worker.run(once=options["once"]))
+        except KeyboardInterrupt:
+            # 実行中だったジョブは JOB_STALE_SECONDS 後に別のワーカーが入れ直す
+            self.stdout.write("停止しました。")
@@ -1,10 +1,22 @@
 import logging
 
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from . import timing
+
 class SilenceProgressEndpointLogMiddleware:
+    # ASGI で同期専用のミドルウェアがあると、リクエスト全体がスレッドで実行されて async ビューの意味がなくなるため両対応にする
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
         if request.path.startswith("/rag/progress/"):
             logger = logging.getLogger("django.server")
             old_handlers = logger.handlers
@@ -22,3 +34,56 @@ class SilenceProgressEndpointLogMiddleware:
                 logger.propagate = old_propagate
 
         return self.get_response(request)
+
+    async def __acall__(self, request):
+        if request.path.startswith("/rag/progress/"):
+            logger = logging.getLogger("django.server")
+            old_handlers = logger.handlers
+            old_level = logger.level
+            old_propagate = logger.propagate
+
+            try:
+                logger.handlers = [logging.NullHandler()]
+                logger.setLevel(logging.CRITICAL)
+                logger.propagate = False
+                return await self.get_response(request)
+            finally:
+                logger.handlers = old_handlers
+                logger.setLevel(old_level)
+                logger.propagate = old_propagate
+
+        return await self.get_response(request)
+
+
+class ServerTimingMiddleware:
+    """
+    リクエスト中に timing.span で記録した区間を Server-Timing ヘッダーとログ1行にする（記録が無ければ何もしない）。
+    StreamingHttpResponse はヘッダーを返した後に生成するので、ここでは Server-Timing を付けられない
+    （SSE の rag_stream は、生成中に記録した区間を result / busy の直前の timing イベントで送る）。
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with timing.collect() as spans:
+            response = self.get_response(request)
+        return self._finish(request, response, spans)
+
+    async def __acall__(self, request):
+        with timing.collect() as spans:
+            response = await self.get_response(request)
+        return self._finish(request, response, spans)
+
+    def _finish(self, request, response, spans):
+        if spans:
+            response["Server-Timing"] = timing.server_timing_header(spans)
+            timing.log_spans(request.path, spans, response.status_code)
+        return response
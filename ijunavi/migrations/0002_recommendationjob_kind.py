@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ijunavi', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recommendationjob',
+            name='kind',
+            field=models.CharField(choices=[('recommend', '提案'), ('init', '初期化')], default='recommend', max_length=10),
+        ),
+    ]
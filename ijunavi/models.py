@@ -1,4 +1,55 @@
+import uuid
+
+from django.conf import settings
 from django.db import models
 
 # Create your models here.
 
+
+class RecommendationJob(models.Model):
+    """
+    提案の生成ジョブ。ワーカー（manage.py run_recommendation_worker かプロセス内のスレッド）が
+    queued → running → done / failed の順に進める。ログインしていれば user に紐づき、提案の履歴になる。
+    kind が init のものはRAGの初期化（ベクトルDBの作成）で、answers は空。
+    """
+
+    RECOMMEND = "recommend"
+    INIT = "init"
+    KIND_CHOICES = [
+        (RECOMMEND, "提案"),
+        (INIT, "初期化"),
+    ]
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (QUEUED, "待機中"),
+        (RUNNING, "実行中"),
+        (DONE, "完了"),
+        (FAILED, "失敗"),
+    ]
+
+    # 状態の問い合わせURLに使うので推測できないIDにする
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL, related_name="recommendation_jobs"
+    )
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, default=RECOMMEND)
+    session_key = models.CharField(max_length=40, blank=True)
+    answers = models.JSONField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        db_table = "recommendation_jobs"
+        indexes = [models.Index(fields=["status", "created_at"])]
+
+    def __str__(self):
+        return f"{self.id}（{self.get_status_display()}）"
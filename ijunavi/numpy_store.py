@@ -0,0 +1,559 @@
+import json
+import os
+import shutil
+import threading
+import uuid
+from pathlib import Path
+from typing import Any, Iterable
+
+import numpy as np
+from langchain.schema import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+# Chroma の代わりに使える、プロセス内の NumPy ベクトルストア。
+# 埋め込みは正規化した float32 の .npy に保存し、読み取り専用でメモリマップするので、
+# 複数のワーカープロセスが同じファイルを開いてもページキャッシュを共有する。
+# 書き込みはバッチごとに segments/ へ差分（追加・上書き・削除）を1ファイルずつ足していき、compact() でまとめて
+# 世代ディレクトリ（gen-*/）に書き出す。どの世代を読むかは CURRENT が指すので、ベクトルと本文は必ず組で切り替わる。
+# 開くときは CURRENT の世代を読み、その後の segments を順に当て直す（作成の途中で止まっても書き込んだバッチは残る）。
+# 検索は全件との内積による厳密な top-k（数千チャンク程度なら ANN より速い）と、その上位からの MMR。
+# quantization="int8" では int8 に量子化した行列（1/4 の大きさ）で候補を選び、
+# 候補の行だけ float32 で読み直して並べ替える（float32 の .npy はメモリマップなので触った行しか読まない）。
+# get / delete / where（$and, $or, $eq, $ne, $in, $nin, $gt, $gte, $lt, $lte）は
+# rag_service が Chroma に対して使っている範囲だけを同じ形で実装している。
+
+VECTORS_FILE = "vectors.npy"
+RECORDS_FILE = "records.json"
+INT8_FILE = "vectors.int8.npy"
+SCALES_FILE = "scales.npy"
+CURRENT_FILE = "CURRENT"
+SEGMENTS_DIR = "segments"
+
+QUANTIZATIONS = (None, "int8")
+
+# int8 の行列は、この行数ずつ float32 に戻して内積を取る（一度に全体を変換しない）
+INT8_BLOCK_ROWS = 1024
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def quantize_int8(vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """行ごとの対称スカラー量子化。vectors ≒ q * scales[:, None]"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scales = np.abs(vectors).max(axis=1) / 127 if len(vectors) else np.zeros(0, dtype=np.float32)
+    scales = np.where(scales == 0, 1.0, scales).astype(np.float32)
+    q = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return q, scales
+
+
+def int8_scores(q: np.ndarray, scales: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """量子化した行列とクエリ（float32）の内積の近似値"""
+    out = np.empty(len(q), dtype=np.float32)
+    for start in range(0, len(q), INT8_BLOCK_ROWS):
+        end = start + INT8_BLOCK_ROWS
+        out[start:end] = q[start:end].astype(np.float32) @ query
+    return out * scales
+
+
+def mmr_select(query: np.ndarray, candidates: np.ndarray, k: int, lambda_mult: float = 0.5) -> list[int]:
+    """
+    正規化済みの候補ベクトルから MMR で k 件を選び、候補内の番号を返す。
+    類似度行列は1回の行列積で作り、各ステップは「選択済みとの最大類似度」の配列を更新するだけ。
+    """
+    if not len(candidates) or k <= 0:
+        return []
+    to_query = candidates @ query
+    between = candidates @ candidates.T
+
+    selected = [int(np.argmax(to_query))]
+    redundancy = between[selected[0]].copy()
+    while len(selected) < min(k, len(candidates)):
+        score = lambda_mult * to_query - (1 - lambda_mult) * redundancy
+        score[selected] = -np.inf
+        j = int(np.argmax(score))
+        selected.append(j)
+        np.maximum(redundancy, between[j], out=redundancy)
+    return selected
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    persist_directory の世代ディレクトリに vectors.npy（正規化済み float32、行 = チャンク）と
+    records.json（ids / documents / metadatas）を置くベクトルストア。
+    upsert / delete はバッチの分だけを segments/ に書き足し（全体は書き直さない）、compact() で新しい世代にまとめる。
+    世代は一時ディレクトリに書いてから名前を変え、CURRENT を置き換えて切り替える（読み込み中のプロセスは古い世代を見続ける）。
+    quantization="int8" のときは vectors.int8.npy / scales.npy も置き、近似スコアの上位
+    k × rescore_factor 件を float32 で並べ替える。
+    """
+
+    def __init__(
+        self,
+        persist_directory: str | Path,
+        embedding_function: Embeddings | None = None,
+        quantization: str | None = None,
+        rescore_factor: int = 4,
+    ):
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"未対応の量子化方式です: {quantization}")
+        self.path = Path(persist_directory)
+        self._embedding = embedding_function
+        self.quantization = quantization
+        self.rescore_factor = rescore_factor
+        self._lock = threading.Lock()
+        self._load()
+
+    @property
+    def embeddings(self) -> Embeddings | None:
+        return self._embedding
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    # --- 保存・読み込み ---
+
+    def _load(self) -> None:
+        current = self._read_current()
+        if current:
+            base_dir = self.path / current["generation"]
+        elif (self.path / VECTORS_FILE).exists():
+            # 世代ディレクトリを使う前の形式（直下に vectors.npy / records.json）
+            base_dir = self.path
+        else:
+            base_dir = None
+        self._base_dir = base_dir
+        self._through = current.get("segments_through", 0) if current else 0
+
+        vectors = np.zeros((0, 0), dtype=np.float32)
+        records = {"ids": [], "documents": [], "metadatas": []}
+        if base_dir is not None and (base_dir / VECTORS_FILE).exists() and (base_dir / RECORDS_FILE).exists():
+            vectors = np.load(base_dir / VECTORS_FILE, mmap_mode="r")
+            records = json.loads((base_dir / RECORDS_FILE).read_text(encoding="utf-8"))
+            if len(records["ids"]) != len(vectors):
+                print(f"RAG: {base_dir} のベクトルと本文の件数が合わないため読み込みません。")
+                vectors = np.zeros((0, 0), dtype=np.float32)
+                records = {"ids": [], "documents": [], "metadatas": []}
+        self._set(vectors, records["ids"], records["documents"], records["metadatas"])
+        if self.quantization == "int8":
+            self._load_int8()
+
+        # 前回 compact してから書き足した分を順に当て直す
+        self._seq = self._through
+        for seq, path in self._segment_files():
+            if seq <= self._through:
+                continue
+            try:
+                with np.load(path, allow_pickle=False) as z:
+                    segment_vectors = z["vectors"]
+                    segment = json.loads(str(z["records"]))
+            except (OSError, ValueError, KeyError) as e:
+                # 以降の差分は順序に依存するので、ここで止める
+                print(f"RAG: {path} を読めないため、以降の書き込みを読み込みません: {e}")
+                break
+            if segment["deleted"]:
+                self._remove(segment["deleted"])
+            if segment["ids"]:
+                self._apply(segment["ids"], segment_vectors, segment["documents"], segment["metadatas"])
+            self._seq = seq
+
+    def _read_current(self) -> dict | None:
+        try:
+            return json.loads((self.path / CURRENT_FILE).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+
+    def _segment_files(self) -> list[tuple[int, Path]]:
+        segments = self.path / SEGMENTS_DIR
+        if not segments.exists():
+            return []
+        files = [(int(p.stem), p) for p in segments.glob("*.npz") if p.stem.isdigit()]
+        return sorted(files)
+
+    def _load_int8(self) -> None:
+        """量子化済みの行列を開く。無いか件数が合わなければ検索のときに float32 から作る（量子化方式だけ変えた場合）"""
+        self._q, self._scales = None, None
+        if self._base_dir is None:
+            return
+        int8_path = self._base_dir / INT8_FILE
+        scales_path = self._base_dir / SCALES_FILE
+        if int8_path.exists() and scales_path.exists():
+            q = np.load(int8_path, mmap_mode="r")
+            scales = np.load(scales_path)
+            if len(q) == len(self._ids) == len(scales):
+                self._q, self._scales = q, scales
+
+    def _int8(self) -> tuple[np.ndarray, np.ndarray]:
+        """検索に使う量子化済みの行列。書き足した行の分だけ量子化して継ぎ足す"""
+        if self._q is None:
+            self._q, self._scales = quantize_int8(self._vectors) if len(self._ids) else (
+                np.zeros((0, 0), dtype=np.int8), np.zeros(0, dtype=np.float32)
+            )
+        elif len(self._q) < len(self._ids):
+            q, scales = quantize_int8(self._vectors[len(self._q):])
+            self._q = np.concatenate([self._q, q]) if len(self._q) else q
+            self._scales = np.concatenate([self._scales, scales])
+        return self._q, self._scales
+
+    @property
+    def _vectors(self) -> np.ndarray:
+        """全件の行列。書き足した行があれば、読むときに1回だけつなげる"""
+        if self._tail:
+            parts = ([self._matrix] if len(self._matrix) else []) + self._tail
+            self._matrix = np.concatenate(parts)
+            self._tail = []
+        return self._matrix
+
+    def index_bytes(self) -> int:
+        """検索で全体を読む行列の大きさ（int8 なら量子化した行列とスケール）"""
+        if self.quantization == "int8":
+            q, scales = self._int8()
+            return int(q.nbytes + scales.nbytes)
+        return int(self._vectors.nbytes)
+
+    def _set(self, vectors: np.ndarray, ids: list, documents: list, metadatas: list) -> None:
+        self._matrix = vectors
+        self._tail = []
+        self._ids = list(ids)
+        self._documents = list(documents)
+        self._metadatas = [md or {} for md in metadatas]
+        self._positions = {i: n for n, i in enumerate(self._ids)}
+        self._columns = {}
+        self._q, self._scales = None, None
+
+    def _apply(self, ids: list, vectors: np.ndarray, documents: list, metadatas: list) -> None:
+        """メモリ上の行に upsert する。新しいIDは行列の末尾に足すだけで、全体はコピーしない"""
+        updated, appended = [], []
+        for row, (i, text, md) in enumerate(zip(ids, documents, metadatas)):
+            n = self._positions.get(i)
+            if n is not None:
+                self._documents[n], self._metadatas[n] = text, md or {}
+                updated.append((row, n))
+            else:
+                self._positions[i] = len(self._ids)
+                self._ids.append(i)
+                self._documents.append(text)
+                self._metadatas.append(md or {})
+                appended.append(row)
+        if updated:
+            matrix = self._vectors
+            if not matrix.flags.writeable:
+                matrix = np.array(matrix, dtype=np.float32)
+            rows, targets = zip(*updated)
+            matrix[list(targets)] = vectors[list(rows)]
+            self._matrix = matrix
+            self._q = None
+        if appended:
+            self._tail.append(np.asarray(vectors[appended], dtype=np.float32))
+        self._columns = {}
+
+    def _remove(self, ids: list) -> None:
+        drop = {self._positions[i] for i in ids if i in self._positions}
+        if not drop:
+            return
+        keep = [n for n in range(len(self._ids)) if n not in drop]
+        self._set(
+            np.array(self._vectors[keep], dtype=np.float32),
+            [self._ids[n] for n in keep],
+            [self._documents[n] for n in keep],
+            [self._metadatas[n] for n in keep],
+        )
+
+    def _write_segment(self, vectors: np.ndarray, ids: list, documents: list, metadatas: list, deleted: list) -> None:
+        """差分1件を segments/ に書く。ベクトルと本文を1つの .npz にまとめ、書き終えてから名前を付ける"""
+        segments = self.path / SEGMENTS_DIR
+        segments.mkdir(parents=True, exist_ok=True)
+        self._seq += 1
+        path = segments / f"{self._seq:08d}.npz"
+        tmp = path.with_name(path.name + ".tmp")
+        records = {"ids": ids, "documents": documents, "metadatas": metadatas, "deleted": deleted}
+        with open(tmp, "wb") as f:
+            np.savez(
+                f,
+                vectors=np.ascontiguousarray(vectors, dtype=np.float32),
+                records=np.array(json.dumps(records, ensure_ascii=False)),
+            )
+        os.replace(tmp, path)
+
+    def compact(self) -> None:
+        """
+        書き足した差分を新しい世代にまとめる（作成の最後に1回呼ぶ）。
+        一時ディレクトリに全ファイルを書いてから名前を変え、CURRENT を置き換えて切り替える。
+        """
+        with self._lock:
+            if self._seq == self._through and self._base_dir is not None and self._base_dir != self.path:
+                return
+            self.path.mkdir(parents=True, exist_ok=True)
+            name = f"gen-{uuid.uuid4().hex[:12]}"
+            tmp_dir = self.path / f".{name}.tmp"
+            tmp_dir.mkdir()
+            vectors = np.ascontiguousarray(self._vectors, dtype=np.float32)
+            np.save(tmp_dir / VECTORS_FILE, vectors)
+            records = {"ids": self._ids, "documents": self._documents, "metadatas": self._metadatas}
+            (tmp_dir / RECORDS_FILE).write_text(json.dumps(records, ensure_ascii=False), encoding="utf-8")
+            if self.quantization == "int8":
+                q, scales = self._int8()
+                np.save(tmp_dir / INT8_FILE, np.ascontiguousarray(q))
+                np.save(tmp_dir / SCALES_FILE, scales)
+            os.rename(tmp_dir, self.path / name)
+
+            current = self.path / CURRENT_FILE
+            tmp = current.with_name(current.name + ".tmp")
+            tmp.write_text(json.dumps({"generation": name, "segments_through": self._seq}), encoding="utf-8")
+            os.replace(tmp, current)
+
+            # 切り替えた後で古い世代と当て直し済みの差分を消す（開いているプロセスのメモリマップはそのまま使える）
+            old = self._base_dir
+            for seq, path in self._segment_files():
+                if seq <= self._seq:
+                    path.unlink(missing_ok=True)
+            if old is not None and old != self.path:
+                shutil.rmtree(old, ignore_errors=True)
+            for legacy in (VECTORS_FILE, RECORDS_FILE, INT8_FILE, SCALES_FILE):
+                (self.path / legacy).unlink(missing_ok=True)
+
+            self._base_dir, self._through = self.path / name, self._seq
+            self._matrix, self._tail = np.load(self._base_dir / VECTORS_FILE, mmap_mode="r"), []
+            if self.quantization == "int8":
+                self._load_int8()
+
+    # --- 書き込み ---
+
+    def upsert(self, ids: list[str], embeddings: list[list[float]], documents: list[str], metadatas: list[dict]) -> None:
+        """同じIDは上書き、新しいIDは末尾に追加する（Chroma の collection.upsert と同じ引数）"""
+        new_vectors = normalize_rows(embeddings)
+        metadatas = [md or {} for md in metadatas]
+        with self._lock:
+            self._write_segment(new_vectors, list(ids), list(documents), metadatas, [])
+            self._apply(list(ids), new_vectors, list(documents), metadatas)
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: list[dict] | None = None,
+        ids: list[str] | None = None,
+        **kwargs: Any,
+    ) -> list[str]:
+        if self._embedding is None:
+            raise ValueError("add_texts には embedding_function が必要です。")
+        texts = list(texts)
+        ids = list(ids) if ids else [str(uuid.uuid4()) for _ in texts]
+        metadatas = metadatas or [{} for _ in texts]
+        self.upsert(ids, self._embedding.embed_documents(texts), texts, metadatas)
+        return ids
+
+    def delete(self, ids: list[str] | None = None, **kwargs: Any) -> bool | None:
+        if not ids:
+            return None
+        with self._lock:
+            found = [i for i in ids if i in self._positions]
+            if not found:
+                return True
+            self._write_segment(np.zeros((0, self._vectors.shape[1]), dtype=np.float32), [], [], [], found)
+            self._remove(found)
+        return True
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: list[str],
+        embedding: Embeddings,
+        metadatas: list[dict] | None = None,
+        ids: list[str] | None = None,
+        persist_directory: str | Path = "",
+        **kwargs: Any,
+    ) -> "NumpyVectorStore":
+        store = cls(persist_directory, embedding_function=embedding)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        store.compact()
+        return store
+
+    # --- 読み込み（Chroma の get と同じ形の dict を返す） ---
+
+    def get(
+        self,
+        ids: list[str] | None = None,
+        where: dict | None = None,
+        include: list[str] | tuple = ("documents", "metadatas"),
+        limit: int | None = None,
+        **kwargs: Any,
+    ) -> dict:
+        if ids is not None:
+            rows = [self._positions[i] for i in ids if i in self._positions]
+            if where:
+                mask = self._where_mask(where)
+                rows = [n for n in rows if mask[n]]
+        else:
+            rows = np.flatnonzero(self._where_mask(where)).tolist()
+        if limit is not None:
+            rows = rows[:limit]
+
+        result = {"ids": [self._ids[n] for n in rows], "documents": None, "metadatas": None, "embeddings": None}
+        if "documents" in include:
+            result["documents"] = [self._documents[n] for n in rows]
+        if "metadatas" in include:
+            result["metadatas"] = [self._metadatas[n] for n in rows]
+        if "embeddings" in include:
+            result["embeddings"] = np.array(self._vectors[rows]) if rows else np.zeros((0, 0), dtype=np.float32)
+        return result
+
+    def get_by_ids(self, ids, /) -> list[Document]:
+        got = self.get(ids=list(ids))
+        return [
+            Document(id=i, page_content=text, metadata=md)
+            for i, text, md in zip(got["ids"], got["documents"], got["metadatas"])
+        ]
+
+    # --- where ---
+
+    def _column(self, key: str) -> np.ndarray:
+        column = self._columns.get(key)
+        if column is None:
+            column = np.empty(len(self._metadatas), dtype=object)
+            column[:] = [md.get(key) for md in self._metadatas]
+            self._columns[key] = column
+        return column
+
+    def _numeric_column(self, key: str) -> np.ndarray:
+        cache_key = ("numeric", key)
+        column = self._columns.get(cache_key)
+        if column is None:
+            column = np.array(
+                [v if isinstance(v, (int, float)) and not isinstance(v, bool) else np.nan for v in self._column(key)],
+                dtype=np.float64,
+            )
+            self._columns[cache_key] = column
+        return column
+
+    def _compare(self, key: str, op: str, value: Any) -> np.ndarray:
+        if op in ("$gt", "$gte", "$lt", "$lte"):
+            column = self._numeric_column(key)
+            with np.errstate(invalid="ignore"):
+                return {
+                    "$gt": column > value,
+                    "$gte": column >= value,
+                    "$lt": column < value,
+                    "$lte": column <= value,
+                }[op]
+        column = self._column(key)
+        if op == "$eq":
+            return column == value
+        if op == "$ne":
+            return column != value
+        if op in ("$in", "$nin"):
+            values = set(value)
+            found = np.fromiter((v in values for v in column), dtype=bool, count=len(column))
+            return found if op == "$in" else ~found
+        raise ValueError(f"未対応の where 演算子です: {op}")
+
+    def _where_mask(self, where: dict | None) -> np.ndarray:
+        mask = np.ones(len(self._ids), dtype=bool)
+        for key, condition in (where or {}).items():
+            if key == "$and":
+                for clause in condition:
+                    mask &= self._where_mask(clause)
+            elif key == "$or":
+                either = np.zeros(len(self._ids), dtype=bool)
+                for clause in condition:
+                    either |= self._where_mask(clause)
+                mask &= either
+            else:
+                if not isinstance(condition, dict):
+                    condition = {"$eq": condition}
+                for op, value in condition.items():
+                    mask &= self._compare(key, op, value)
+        return mask
+
+    # --- 検索 ---
+
+    def _embed_query(self, query: str) -> np.ndarray:
+        if self._embedding is None:
+            raise ValueError("テキストでの検索には embedding_function が必要です。")
+        return normalize_rows(self._embedding.embed_query(query))
+
+    def _top_k(self, query: np.ndarray, k: int, where: dict | None) -> tuple[np.ndarray, np.ndarray]:
+        """(行番号, 余弦類似度) を類似度の高い順に k 件"""
+        if not len(self._ids):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        rows = np.flatnonzero(self._where_mask(where)) if where else np.arange(len(self._ids))
+        if self.quantization == "int8":
+            # 近似スコアで候補を絞ってから float32 で並べ替える
+            q, scales = self._int8()
+            if where:
+                q, scales = q[rows], scales[rows]
+            # 候補は行番号順に読む（メモリマップを前から順に触る）
+            rows = np.sort(rows[self._argtop(int8_scores(q, scales, query), k * self.rescore_factor)])
+            sims = np.asarray(self._vectors[rows]) @ query
+        else:
+            sims = (self._vectors if not where else self._vectors[rows]) @ query
+        top = self._argtop(sims, k)
+        return rows[top], sims[top]
+
+    @staticmethod
+    def _argtop(scores: np.ndarray, k: int) -> np.ndarray:
+        """scores の大きい順に k 件の番号"""
+        k = min(k, len(scores))
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64)
+        top = np.argpartition(-scores, k - 1)[:k]
+        return top[np.argsort(-scores[top], kind="stable")]
+
+    def _document(self, n: int) -> Document:
+        return Document(id=self._ids[n], page_content=self._documents[n], metadata=self._metadatas[n])
+
+    def similarity_search_by_vector_with_score(
+        self, embedding: list[float], k: int = 4, filter: dict | None = None, **kwargs: Any
+    ) -> list[tuple[Document, float]]:
+        """スコアは Chroma と同じく距離（1 - 余弦類似度、小さいほど近い）"""
+        rows, sims = self._top_k(normalize_rows(embedding), k, filter)
+        return [(self._document(n), float(1 - s)) for n, s in zip(rows, sims)]
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, filter: dict | None = None, **kwargs: Any
+    ) -> list[tuple[Document, float]]:
+        rows, sims = self._top_k(self._embed_query(query), k, filter)
+        return [(self._document(n), float(1 - s)) for n, s in zip(rows, sims)]
+
+    def similarity_search_by_vector(
+        self, embedding: list[float], k: int = 4, filter: dict | None = None, **kwargs: Any
+    ) -> list[Document]:
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k, filter)]
+
+    def similarity_search(self, query: str, k: int = 4, filter: dict | None = None, **kwargs: Any) -> list[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
+
+    def _select_relevance_score_fn(self):
+        return self._cosine_relevance_score_fn
+
+    def max_marginal_relevance_search_by_vector(
+        self,
+        embedding: list[float],
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        filter: dict | None = None,
+        **kwargs: Any,
+    ) -> list[Document]:
+        query = normalize_rows(embedding)
+        rows, _ = self._top_k(query, fetch_k, filter)
+        if not len(rows):
+            return []
+        candidates = np.asarray(self._vectors[rows])
+        return [self._document(int(rows[j])) for j in mmr_select(query, candidates, k, lambda_mult)]
+
+    def max_marginal_relevance_search(
+        self,
+        query: str,
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        filter: dict | None = None,
+        **kwargs: Any,
+    ) -> list[Document]:
+        return self.max_marginal_relevance_search_by_vector(
+            self._embed_query(query), k=k, fetch_k=fetch_k, lambda_mult=lambda_mult, filter=filter
+        )
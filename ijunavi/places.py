@@ -0,0 +1,90 @@
+import re
+from dataclasses import dataclass, field
+
+from .estat import CODE_COLUMN, NAME_COLUMN, PREFECTURES, normalize_text
+from .feature_store import FeatureStore
+
+# 質問文から都道府県・市区町村の名前を拾い、検索の絞り込み条件（Chroma の where）にする。
+
+
+@dataclass
+class PlaceMatch:
+    prefs: set[int] = field(default_factory=set)    # 都道府県コード（1〜47）
+    munis: set[int] = field(default_factory=set)    # 市区町村コード（5桁を数値化したもの）
+    names: list[str] = field(default_factory=list)  # 見つかった表記（ログ用）
+
+    def __bool__(self) -> bool:
+        return bool(self.prefs or self.munis)
+
+
+class PlaceMatcher:
+    """
+    地名の表記 → (都道府県コード, 市区町村コード) の辞書で、文を左から最長一致で走査する。
+    表記は正式名（「沖縄県」「国頭郡恩納村」）に加え、都道府県は「沖縄」、郡部の町村は「恩納村」でも引ける。
+    """
+
+    def __init__(self, store: FeatureStore):
+        self.surfaces: dict[str, set[tuple[int, int | None]]] = {}
+
+        for i, pref in enumerate(PREFECTURES, start=1):
+            self._add(pref, i, None)
+            if pref != "北海道":
+                self._add(pref[:-1], i, None)
+
+        for code, name in zip(store.frame[CODE_COLUMN], store.frame[NAME_COLUMN]):
+            code = str(code)
+            if len(code) != 5 or not code.isdigit() or not name:
+                continue
+            pref, muni = int(code[:2]), int(code)
+            self._add(name, pref, muni)
+            short = re.sub(r"^.+?郡", "", name)
+            if short != name and len(short) >= 2:
+                self._add(short, pref, muni)
+
+        self.lengths = sorted({len(s) for s in self.surfaces}, reverse=True)
+
+    def _add(self, surface: str, pref: int, muni: int | None) -> None:
+        self.surfaces.setdefault(normalize_text(surface), set()).add((pref, muni))
+
+    def extract(self, text: str) -> PlaceMatch:
+        text = normalize_text(text)
+        match = PlaceMatch()
+        i = 0
+        while i < len(text):
+            for length in self.lengths:
+                hits = self.surfaces.get(text[i:i + length])
+                if hits:
+                    for pref, muni in hits:
+                        if muni is None:
+                            match.prefs.add(pref)
+                        else:
+                            match.munis.add(muni)
+                    match.names.append(text[i:i + length])
+                    i += length
+                    break
+            else:
+                i += 1
+
+        # 「東京都府中市」のように都道府県と市区町村が両方あれば、その都道府県の市区町村だけに絞り、
+        # 都道府県の条件は市区町村の条件に含める（都道府県全体には広げない）
+        if match.prefs and match.munis:
+            inside = {m for m in match.munis if m // 1000 in match.prefs}
+            if inside:
+                match.munis = inside
+                match.prefs -= {m // 1000 for m in inside}
+        return match
+
+
+def chroma_where(match: PlaceMatch) -> dict | None:
+    """
+    PlaceMatch を Chroma の where にする。市区町村はチャンクのコード範囲に含まれるもの、
+    都道府県は pref_code が一致するもの（どちらかに当てはまれば対象）。
+    """
+    clauses = []
+    if match.prefs:
+        clauses.append({"pref_code": {"$in": sorted(match.prefs)}})
+    for muni in sorted(match.munis):
+        clauses.append({"$and": [{"muni_code_from": {"$lte": muni}}, {"muni_code_to": {"$gte": muni}}]})
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$or": clauses}
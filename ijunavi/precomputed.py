@@ -0,0 +1,132 @@
+import itertools
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+# 選択肢だけで決まる回答（自由記述なし・年齢は年代の代表値）の提案を事前に作っておく保存先。
+# CSVのフィンガープリントごとに1つの JSON にまとめ、フィンガープリントが変わったら作り直す。
+
+# 事前計算する年代（代表値は各年代の真ん中: 20代 → 25歳）
+DEFAULT_AGE_DECADES = (20, 30, 40, 50, 60, 70, 80, 90)
+
+
+def answer_grid(questions: list[dict], decades=DEFAULT_AGE_DECADES) -> list[dict]:
+    """
+    チャットの質問（views.QUESTIONS）の選択肢の全組み合わせ × 年代。自由記述（else）は空。
+    選択肢の無い質問は age と else だけを想定している。
+    """
+    keys = [q["key"] for q in questions if q["choices"]]
+    choices = [q["choices"] for q in questions if q["choices"]]
+    grid = []
+    for decade in decades:
+        for combo in itertools.product(*choices):
+            grid.append({"age": decade + 5, **dict(zip(keys, combo)), "else": ""})
+    return grid
+
+
+class PrecomputedStore:
+    """
+    {"fingerprint": ..., "entries": {キー: {"answers": ..., "result": ...}}} の JSON ファイル。
+    書き込みは一時ファイルに書いてから置き換える。読み込みはファイルの更新時刻が変わったときだけ。
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._data = {"fingerprint": "", "entries": {}}
+        self._mtime = None
+
+    def _reload_locked(self) -> None:
+        try:
+            mtime = self.path.stat().st_mtime_ns
+        except FileNotFoundError:
+            self._data, self._mtime = {"fingerprint": "", "entries": {}}, None
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            self._data = json.loads(self.path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            self._data = {"fingerprint": "", "entries": {}}
+        self._mtime = mtime
+
+    def get(self, key: str, fingerprint: str) -> dict | None:
+        with self._lock:
+            self._reload_locked()
+            if self._data.get("fingerprint") != fingerprint:
+                return None
+            entry = self._data["entries"].get(key)
+        return dict(entry["result"]) if entry else None
+
+    def keys(self, fingerprint: str) -> set[str]:
+        """fingerprint に対して作成済みのキー（再開時のスキップ判定用）"""
+        with self._lock:
+            self._reload_locked()
+            if self._data.get("fingerprint") != fingerprint:
+                return set()
+            return set(self._data["entries"])
+
+    def put(self, key: str, fingerprint: str, answers: dict, result: dict) -> None:
+        with self._lock:
+            self._reload_locked()
+            if self._data.get("fingerprint") != fingerprint:
+                # CSVが変わったので前回の分は捨てる
+                self._data = {"fingerprint": fingerprint, "entries": {}}
+            self._data["entries"][key] = {"answers": answers, "result": result}
+
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(self.path.name + ".tmp")
+            tmp.write_text(json.dumps(self._data, ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp, self.path)
+            self._mtime = self.path.stat().st_mtime_ns
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._reload_locked()
+            return len(self._data.get("entries", {}))
+
+
+def precompute(store: PrecomputedStore, grid: list[dict], key_fn, generate, concurrency: int = 4, limit=None, log=print) -> dict:
+    """
+    grid の回答のうち作成済みでないものを generate(answers) で同時 concurrency 件ずつ作り、store に保存する。
+    key_fn(answers) は (キー, フィンガープリント)。作成済みは飛ばすので、中断しても続きから再開できる。
+    【システムエラー】の提案は保存しない（次回に再試行）。戻り値は件数 {"total", "already", "saved", "failed"}。
+    """
+    keys = [key_fn(answers) for answers in grid]
+    fingerprint = keys[0][1] if keys else ""
+    done = store.keys(fingerprint)
+    todo = [(answers, key) for answers, (key, _) in zip(grid, keys) if key not in done]
+    counts = {"total": len(grid), "already": len(grid) - len(todo), "saved": 0, "failed": 0}
+    if limit is not None:
+        todo = todo[:limit]
+
+    log(f"{len(grid)}通りのうち作成済み {counts['already']}件、今回 {len(todo)}件を同時 {concurrency}件で作成します。")
+    if not todo:
+        return counts
+
+    start = time.perf_counter()
+    finished = 0
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="rag-precompute") as pool:
+        futures = {pool.submit(generate, answers): (answers, key) for answers, key in todo}
+        for future in as_completed(futures):
+            answers, key = futures[future]
+            label = f"{answers['age'] // 10 * 10}代/{answers['style']}/{answers['climate']}/{answers['family']}"
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"headline": f"【システムエラー】{e}"}
+            finished += 1
+            if result.get("headline", "").startswith("【システムエラー】"):
+                counts["failed"] += 1
+                log(f"[{finished}/{len(todo)}] 失敗: {label}: {result.get('headline')}")
+                continue
+
+            store.put(key, fingerprint, answers, result)
+            counts["saved"] += 1
+            elapsed = time.perf_counter() - start
+            remaining = elapsed / finished * (len(todo) - finished)
+            log(f"[{finished}/{len(todo)}] {label}（経過 {elapsed:.0f}秒、残り約 {remaining:.0f}秒）")
+    return counts
@@ -1,19 +1,56 @@
 import os
 import json
 import hashlib
-import pandas as pd
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import AsyncIterator, Iterator
 from dotenv import load_dotenv
+from asgiref.sync import sync_to_async
 import traceback
 import threading
+import time
+import tempfile
 
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 from langchain_chroma import Chroma
 from langchain.prompts import PromptTemplate
 from langchain.chains import RetrievalQA
 from django.conf import settings
 from langchain.schema import Document
+from langchain_core.prompts import format_document
+
+from .admission import AdmissionController, Busy
+from .embedding_cache import CachedEmbeddings
+from .feature_store import MUNICIPALITY_FILES, FeatureStore, get_feature_store, joined_sources
+from .lexical_index import LexicalIndex
+from .numpy_store import NumpyVectorStore
+from .response_cache import ResponseCache, cache_key, normalize_free_text
+from .semantic_cache import SemanticCache, semantic_scope, semantic_text
+from .singleflight import SingleFlight
+from .timing import record, span, stage_stats
+from .places import PlaceMatch, PlaceMatcher
+from .precomputed import PrecomputedStore, answer_grid, precompute
+from .retrieval import HybridRetriever, MmrRetriever, TokenBudgetRetriever
+from .scoring import rank_municipalities, shortlist_documents
+from .ingest import (
+    INGEST_VERSION,
+    csv_df_to_grouped_docs,
+    load_tenpo2511_as_long_df,
+    parse_source_file,
+    read_spill,
+    row_format_for,
+    tenpo_long_df_to_docs,
+)
+from .embedding_pipeline import (
+    BackgroundBatcher,
+    PrecomputedEmbeddings,
+    RateLimitedEmbeddings,
+    RateLimiter,
+    embed_batches_concurrently,
+    write_batch,
+)
 
 # プロジェクトルート（manage.py がある場所）
 BASE_DIR = settings.BASE_DIR
@@ -31,8 +68,98 @@ ALLOWED_CSV = {"2024人口.csv", "2024医療.csv", "2024居住.csv", "2024教育
 # CSV更新検知用（DB内に保存）
 FINGERPRINT_PATH = DB_DIR / "_fingerprint.json"
 
+# DB作成の途中経過（中断後の再開用。完了時に削除）
+CHECKPOINT_PATH = DB_DIR / "_checkpoint.json"
+
+# e-Stat形式CSVの整形済みデータ（Parquet）と市区町村テーブル（Arrow）。CSVのフィンガープリントごとに作る
+PARQUET_CACHE_DIR = BASE_DIR / ".chroma_db" / "_parquet"
+
+# チャンク本文の文字 n-gram BM25 インデックス（ベクトルDBと一緒に作り直す）
+LEXICAL_INDEX_PATH = DB_DIR / "_bm25.npz"
+
+# ベクトルDBの実装。chroma（既定）か numpy（.npy をメモリマップする NumpyVectorStore、起動が速い）
+VECTOR_BACKENDS = ("chroma", "numpy")
+VECTOR_BACKEND = os.getenv("RAG_VECTOR_BACKEND", "chroma")
+NUMPY_STORE_DIR = DB_DIR / "_numpy"
+# numpy のときだけ有効。int8 なら量子化した行列で候補を選び、上位を float32 で並べ替える
+VECTOR_QUANTIZATION = os.getenv("RAG_VECTOR_QUANTIZATION", "none")
+
+# BM25 とベクトル検索の併用（RRF で統合）。BM25 の最上位がクエリの語を
+# LEXICAL_SKIP_COVERAGE 以上含む場合はベクトル検索を省く
+HYBRID_RETRIEVAL = os.getenv("RAG_HYBRID_RETRIEVAL", "1") == "1"
+LEXICAL_SKIP_COVERAGE = float(os.getenv("RAG_LEXICAL_SKIP_COVERAGE", "0.9"))
+
+# 質問に都道府県・市区町村名があれば、そのチャンクだけを検索する（Chroma の where で絞り込む）。
+# 候補が少ないので MMR の fetch_k は FILTERED_FETCH_K に減らす
+PLACE_FILTER = os.getenv("RAG_PLACE_FILTER", "1") == "1"
+FILTERED_FETCH_K = int(os.getenv("RAG_FILTERED_FETCH_K", "6"))
+
+# 埋め込みモデルとディスクキャッシュ（DB再作成で消えないよう DB_DIR の外に置く）
+EMBEDDING_MODEL = "text-embedding-3-small"
+# 埋め込みの次元数（text-embedding-3-* は短くできる）。0 ならモデルの既定（1536）
+EMBEDDING_DIMENSIONS = int(os.getenv("RAG_EMBEDDING_DIMENSIONS", "0")) or None
+EMBEDDING_CACHE_PATH = BASE_DIR / ".chroma_db" / "_embedding_cache.sqlite3"
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("RAG_EMBEDDING_CACHE_MAX_ENTRIES", "50000"))
+
+# 提案結果のキャッシュ（正規化した回答 + CSVのフィンガープリントがキー）。ベクトルDBを作り直しても残す
+RESPONSE_CACHE = os.getenv("RAG_RESPONSE_CACHE", "1") == "1"
+RESPONSE_CACHE_PATH = BASE_DIR / ".chroma_db" / "_response_cache.sqlite3"
+RESPONSE_CACHE_TTL = float(os.getenv("RAG_RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RAG_RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+
+# 完全一致しなかったとき、自由記述の埋め込みが SEMANTIC_CACHE_THRESHOLD 以上近い過去の提案を返す（地名が同じものだけ）
+SEMANTIC_CACHE = os.getenv("RAG_SEMANTIC_CACHE", "1") == "1"
+SEMANTIC_CACHE_PATH = BASE_DIR / ".chroma_db" / "_semantic_cache.sqlite3"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("RAG_SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("RAG_SEMANTIC_CACHE_MAX_ENTRIES", "1000"))
+
+# 同じ提案の生成が同時に走ったら1回にまとめる（ダブルクリック・同じ回答の同時送信）。
+# SINGLE_FLIGHT_LOCK_DIR のロックファイルで別ワーカーの生成とも順番にし、結果は提案キャッシュで共有する
+SINGLE_FLIGHT = os.getenv("RAG_SINGLE_FLIGHT", "1") == "1"
+SINGLE_FLIGHT_CROSS_PROCESS = os.getenv("RAG_SINGLE_FLIGHT_CROSS_PROCESS", "1") == "1"
+SINGLE_FLIGHT_LOCK_DIR = BASE_DIR / ".chroma_db" / "_singleflight"
+
+# LLMへの同時リクエスト数（プロセスごと）。超えた分は LLM_QUEUE_SIZE 件まで最大 LLM_QUEUE_TIMEOUT 秒待たせ、
+# それ以上は「混雑中」（503 + Retry-After）を返す
+LLM_CONCURRENCY = int(os.getenv("RAG_LLM_CONCURRENCY", "8"))
+LLM_QUEUE_SIZE = int(os.getenv("RAG_LLM_QUEUE_SIZE", "32"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("RAG_LLM_QUEUE_TIMEOUT", "30"))
+
+# 選択肢の全組み合わせについて事前に作った提案（manage.py precompute_recommendations）
+PRECOMPUTED_PATH = BASE_DIR / ".chroma_db" / "_precomputed.json"
+# ベクトルDBを作り直したら、初期化の後に別スレッドで作り直す（同時 PRECOMPUTE_CONCURRENCY 件。利用者の生成と LLM_CONCURRENCY を分け合う）
+PRECOMPUTE_AFTER_REBUILD = os.getenv("RAG_PRECOMPUTE_AFTER_REBUILD", "1") == "1"
+PRECOMPUTE_CONCURRENCY = int(os.getenv("RAG_PRECOMPUTE_CONCURRENCY", "2"))
+
+# DB作成時の埋め込みAPI呼び出し（同時実行数とレート制限）
+EMBED_CONCURRENCY = int(os.getenv("RAG_EMBED_CONCURRENCY", "4"))
+EMBED_RPM = int(os.getenv("RAG_EMBED_RPM", "3000"))
+EMBED_TPM = int(os.getenv("RAG_EMBED_TPM", "1000000"))
+
+# CSV読込・分割から埋め込みへ受け渡すバッチの先読み上限（メモリ使用量の上限になる）
+INGEST_QUEUE_BATCHES = int(os.getenv("RAG_INGEST_QUEUE_BATCHES", "4"))
+
+# 回答生成時にプロンプトへ入れる検索結果（コンテキスト）のトークン数の上限
+CONTEXT_TOKENS = int(os.getenv("RAG_CONTEXT_TOKENS", "4000"))
+
+# チャットの回答がある場合は、市区町村テーブルを点数付けして上位 SHORTLIST_SIZE 件だけをコンテキストにする
+USE_SCORING = os.getenv("RAG_USE_SCORING", "1") == "1"
+SHORTLIST_SIZE = int(os.getenv("RAG_SHORTLIST_SIZE", "5"))
+
+# CSV解析に使うプロセス数（1ファイル1プロセス。1以下ならこのプロセス内で順に解析）
+INGEST_PROCESSES = int(os.getenv("RAG_INGEST_PROCESSES", str(os.cpu_count() or 1)))
+
 # グローバル変数としてQAチェーンを保持
 qa_chain = None
+embedding_cache = None
+place_matcher = None
+response_cache = None
+semantic_cache = None
+precomputed_store = None
+precompute_thread = None
+_precompute_lock = threading.Lock()
+single_flight = None
+admission = None
 
 RAG_STATUS = {
     "state": "idle",      # idle / building / ready / error
@@ -40,50 +167,87 @@ RAG_STATUS = {
     "current": 0,
     "percent": 0,
     "message": "",
-    "error": ""
+    "error": "",
+    "resumed": False,     # 中断したDB作成を再開したか
+    "skipped": 0,         # 再開時に既に書き込み済みでスキップしたチャンク数
 }
 RAG_LOCK = threading.Lock()
 
 def get_rag_status():
     with RAG_LOCK:
-        return dict(RAG_STATUS)
+        status = dict(RAG_STATUS)
+    if embedding_cache is not None:
+        status["embedding_cache"] = embedding_cache.stats()
+    if response_cache is not None:
+        status["response_cache"] = response_cache.stats()
+    if semantic_cache is not None:
+        status["semantic_cache"] = semantic_cache.stats()
+    return status
 
 def _set_status(**kwargs):
     with RAG_LOCK:
         RAG_STATUS.update(kwargs)
 
-def csv_df_to_grouped_docs(df: pd.DataFrame, source_name: str, group_rows: int = 800) -> list[Document]:
-    docs = []
-    total = len(df)
-    for start in range(0, total, group_rows):
-        end = min(start + group_rows, total)
-        part = df.iloc[start:end]
-        text = part.to_json(orient="records", force_ascii=False)
-        docs.append(
-            Document(
-                page_content=f"ファイル: {source_name}\n行: {start+1}-{end}\n内容: {text}",
-                metadata={"source": source_name, "row_from": start + 1, "row_to": end},
-            )
-        )
-    return docs
+def _hash_payload(payload) -> str:
+    raw = json.dumps(payload, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()
 
 def compute_data_fingerprint() -> dict:
+    stats = {p.name: p.stat() for p in DATA_DIR.rglob("*.csv") if p.name in ALLOWED_CSV}
     items = []
-    for p in DATA_DIR.rglob("*.csv"):
-        if p.name not in ALLOWED_CSV:
-            continue
-        stat = p.stat()
-        items.append({
-            "name": p.name,
+    for name, stat in stats.items():
+        item = {
+            "name": name,
             "size": stat.st_size,
             "mtime": int(stat.st_mtime),
-        })
+            "ingest": INGEST_VERSION,
+            "format": row_format_for(name),
+            "backend": VECTOR_BACKEND,
+            "embedding": embedding_model_key(),
+            # 地域名などを結合して使うCSV。これが変わってもこのファイルを再インデックスする
+            "joined": {
+                dep: f"{stats[dep].st_size}:{int(stats[dep].st_mtime)}" for dep in joined_sources(name) if dep in stats
+            },
+        }
+        # ファイル単位のフィンガープリント（差分再インデックス用）
+        item["hash"] = _hash_payload(item)
+        items.append(item)
     items.sort(key=lambda x: x["name"])
     payload = {"files": items}
-    raw = json.dumps(payload, sort_keys=True).encode("utf-8")
-    payload["hash"] = hashlib.sha256(raw).hexdigest()
+    payload["hash"] = _hash_payload(payload)
     return payload
 
+def diff_fingerprints(saved_fp: dict | None, current_fp: dict) -> tuple[set[str], set[str]]:
+    """
+    保存済みマニフェストと現在のCSVを比較し、(変更・追加されたファイル, 削除されたファイル) を返す。
+    ファイル単位のハッシュを持たない古いマニフェストの場合は全ファイルを変更扱いにする。
+    """
+    current = {f["name"]: f.get("hash") for f in current_fp.get("files", [])}
+    saved_files = (saved_fp or {}).get("files", [])
+    if not saved_files or any("hash" not in f for f in saved_files):
+        return set(current), set()
+
+    saved = {f["name"]: f["hash"] for f in saved_files}
+    changed = {name for name, h in current.items() if saved.get(name) != h}
+    removed = set(saved) - set(current)
+    return changed, removed
+
+def manifest_encodings(fp: dict | None) -> dict:
+    """マニフェストに記録済みの、ファイルごとの文字コード"""
+    return {f["name"]: f["encoding"] for f in (fp or {}).get("files", []) if f.get("encoding")}
+
+def annotate_fingerprint(current_fp: dict, saved_fp: dict | None, report: dict) -> None:
+    """
+    取り込み結果（検出した文字コード・解析時間）をマニフェストに書き加える。
+    今回読み込まなかったファイルは前回の値を引き継ぐ。ハッシュの計算には含めない。
+    """
+    previous = {f["name"]: f for f in (saved_fp or {}).get("files", [])}
+    for f in current_fp.get("files", []):
+        info = report.get(f["name"]) or previous.get(f["name"], {})
+        for key in ("encoding", "parse_seconds"):
+            if info.get(key) is not None:
+                f[key] = info[key]
+
 def load_saved_fingerprint() -> dict | None:
     try:
         if FINGERPRINT_PATH.exists():
@@ -96,112 +260,342 @@ def save_fingerprint(fp: dict) -> None:
     os.makedirs(DB_DIR, exist_ok=True)
     FINGERPRINT_PATH.write_text(json.dumps(fp, ensure_ascii=False, indent=2), encoding="utf-8")
 
-def _read_csv_safely(path: Path, **kwargs) -> pd.DataFrame:
+def load_checkpoint() -> dict | None:
     try:
-        return pd.read_csv(str(path), low_memory=False, **kwargs)
-    except UnicodeDecodeError:
-        return pd.read_csv(str(path), low_memory=False, encoding="cp932", **kwargs)
-
-def load_tenpo2511_as_long_df(path: Path) -> pd.DataFrame:
-    df = _read_csv_safely(path, header=2)
-
-    if len(df.columns) >= 2:
-        df = df.rename(columns={df.columns[0]: "year", df.columns[1]: "timing"})
-
-    for col in ["合計", "集計日", "year", "timing"]:
-        if col not in df.columns:
-            pass
-
-    id_cols = [c for c in ["year", "timing", "集計日"] if c in df.columns]
-    if not id_cols:
-        raise ValueError("tenpo2511.csv のヘッダー解析に失敗しました（year/timing/集計日が見つかりません）")
-
-    exclude = set(id_cols) | {"合計"}
-    pref_cols = [c for c in df.columns if c not in exclude]
-
-    long_df = df.melt(
-        id_vars=id_cols,
-        value_vars=pref_cols,
-        var_name="prefecture",
-        value_name="store_count",
-    )
-
-    long_df["store_count"] = pd.to_numeric(long_df["store_count"], errors="coerce")
-    long_df = long_df.dropna(subset=["store_count"]).reset_index(drop=True)
+        if CHECKPOINT_PATH.exists():
+            return json.loads(CHECKPOINT_PATH.read_text(encoding="utf-8"))
+    except Exception:
+        return None
+    return None
 
-    if "集計日" in long_df.columns:
-        long_df["date"] = long_df["集計日"].astype(str)
-    else:
-        long_df["date"] = ""
-
-    if "year" not in long_df.columns:
-        long_df["year"] = ""
-    if "timing" not in long_df.columns:
-        long_df["timing"] = ""
-
-    return long_df[["year", "timing", "date", "prefecture", "store_count"]]
-
-def tenpo_long_df_to_docs(long_df: pd.DataFrame, source_name: str, group_rows: int = 1200) -> list[Document]:
-    docs = []
-    total = len(long_df)
-    for start in range(0, total, group_rows):
-        end = min(start + group_rows, total)
-        part = long_df.iloc[start:end]
-
-        lines = []
-        for _, r in part.iterrows():
-            sc = int(r["store_count"]) if pd.notna(r["store_count"]) else r["store_count"]
-            lines.append(
-                f"スーパー店舗数。{r['year']} {r['timing']}（集計日 {r['date']}）"
-                f"{r['prefecture']}の店舗数は{sc}。"
-            )
+def save_checkpoint(checkpoint: dict) -> None:
+    os.makedirs(DB_DIR, exist_ok=True)
+    tmp = CHECKPOINT_PATH.with_suffix(".tmp")
+    tmp.write_text(json.dumps(checkpoint, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, CHECKPOINT_PATH)
 
-        docs.append(
-            Document(
-                page_content="\n".join(lines),
-                metadata={"source": source_name, "row_from": start + 1, "row_to": end},
-            )
-        )
-    return docs
+def clear_checkpoint() -> None:
+    try:
+        CHECKPOINT_PATH.unlink()
+    except FileNotFoundError:
+        pass
+
+def existing_chunk_ids(vectorstore, chunk_ids: list[str], batch_size: int = 500) -> set[str]:
+    """chunk_ids のうち、既にベクトルDBに書き込まれているものを返す。"""
+    found = set()
+    for i in range(0, len(chunk_ids), batch_size):
+        found.update(vectorstore.get(ids=chunk_ids[i:i + batch_size], include=[])["ids"])
+    return found
+
+def has_file_manifest(fp: dict | None) -> bool:
+    """ファイル単位のハッシュを持つマニフェストかどうか（差分更新できるか）"""
+    files = (fp or {}).get("files")
+    return bool(files) and all("hash" in f for f in files)
+
+def embedding_space(fp: dict | None) -> set[tuple]:
+    """マニフェストに記録されたベクトルの種類（ベクトルDBの種類・埋め込みモデルと次元数）"""
+    return {(f.get("backend"), f.get("embedding")) for f in (fp or {}).get("files", [])}
+
+def same_embedding_space(saved_fp: dict | None, current_fp: dict) -> bool:
+    """既存DBのベクトルを今の設定でもそのまま使えるか（次元数などが変わると同じコレクションに書き込めない）"""
+    saved = embedding_space(saved_fp)
+    return len(saved) == 1 and saved == embedding_space(current_fp)
+
+def delete_documents_by_source(vectorstore, sources: set[str]) -> int:
+    """metadata の source が sources に含まれるドキュメントをベクトルDBから削除する。"""
+    deleted = 0
+    for name in sorted(sources):
+        ids = vectorstore.get(where={"source": name}, include=[])["ids"]
+        if ids:
+            vectorstore.delete(ids=ids)
+            deleted += len(ids)
+        print(f"  - 削除: {name}（{len(ids)}チャンク）")
+    return deleted
+
+def build_lexical_index(vectorstore, fingerprint: str) -> LexicalIndex:
+    """ベクトルDBの全チャンクから BM25 インデックスを作って保存する（IDは Chroma と共通）"""
+    got = vectorstore.get(include=["documents", "metadatas"])
+    index = LexicalIndex.build(got["ids"], got["documents"], got["metadatas"], fingerprint=fingerprint)
+    index.save(LEXICAL_INDEX_PATH)
+    print(f"RAG: BM25インデックスを作成しました（{len(index)}チャンク、{len(index.vocab)}語）")
+    return index
+
+def load_lexical_index(vectorstore) -> LexicalIndex:
+    """保存済みの BM25 インデックス。無いか、CSVの構成が変わっていたら作り直す"""
+    fingerprint = (load_saved_fingerprint() or {}).get("hash", "")
+    index = LexicalIndex.load(LEXICAL_INDEX_PATH) if LEXICAL_INDEX_PATH.exists() else None
+    if index is None or index.fingerprint != fingerprint:
+        index = build_lexical_index(vectorstore, fingerprint)
+    return index
 
 # --- RAG初期化関連の関数 ---
-def load_and_split_documents():
+def _iter_parsed_files(csv_files: list[Path], encodings: dict, workers: int, spill_dir: Path):
+    """
+    CSVを1ファイル1プロセスで並列に解析し、渡された順に (path, 結果 または 例外) を返す。
+    チャンクは spill_dir の一時ファイルに書き出されるので、戻り値は件数などの小さな dict だけになる。
+    先読みは workers ファイル分まで。
+    """
+    def args(path: Path) -> tuple:
+        return str(path), str(spill_dir / f"{path.name}.jsonl"), encodings.get(path.name), str(PARQUET_CACHE_DIR)
+
+    if workers <= 1:
+        for path in csv_files:
+            try:
+                yield path, parse_source_file(*args(path))
+            except Exception as e:
+                yield path, e
+        return
+
+    # Django のスレッドから fork すると危険なので spawn でワーカーを起動する
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        files = iter(csv_files)
+        pending = deque()
+
+        def submit_next():
+            path = next(files, None)
+            if path is not None:
+                pending.append((path, pool.submit(parse_source_file, *args(path))))
+
+        for _ in range(workers):
+            submit_next()
+
+        while pending:
+            path, future = pending.popleft()
+            submit_next()
+            try:
+                yield path, future.result()
+            except Exception as e:
+                yield path, e
+
+def load_and_split_documents(
+    names: set[str] | None = None,
+    encodings: dict | None = None,
+    report: dict | None = None,
+) -> Iterator[Document]:
+    """
+    ホワイトリストのCSVを読み込んでチャンクに分割するジェネレータ。
+    names を渡した場合はそのファイルだけを読み込む（差分再インデックス用）。
+    ファイルはプロセスプールで並列に解析し、ファイル名順に返す。ワーカーが一時ファイルに書いたチャンクを
+    1件ずつ読むので、1ファイル分のチャンクをまとめてメモリに載せることはない。
+    encodings は前回検出した文字コード、report にはファイルごとの文字コードと解析時間を書き込む。
+    """
     if not DATA_DIR.exists():
         print(f"RAGエラー: データディレクトリ '{DATA_DIR.resolve()}' が見つかりません。")
-        return []
+        return
 
-    docs = []
     print(f"RAG: '{DATA_DIR}' 内のCSVファイルをスキャン中...（CSVのみ使用）")
 
-    csv_files = [p for p in DATA_DIR.rglob("*.csv") if p.name in ALLOWED_CSV]
-    for path in csv_files:
-        try:
-            if path.name == "tenpo2511.csv":
-                long_df = load_tenpo2511_as_long_df(path)
-                grouped_docs = tenpo_long_df_to_docs(long_df, source_name=path.name, group_rows=1200)
-                docs.extend(grouped_docs)
-                print(f"  - 読込成功: {path.name}（{len(long_df)}行(整形後) → {len(grouped_docs)}docs）")
-            else:
-                df = _read_csv_safely(path)
-                grouped_docs = csv_df_to_grouped_docs(df, source_name=path.name, group_rows=800)
-                docs.extend(grouped_docs)
-                print(f"  - 読込成功: {path.name}（{len(df)}行 → {len(grouped_docs)}docs）")
-
-        except Exception as e:
-            print(f"  - 読込失敗: {path.name} ({e})")
+    csv_files = sorted((p for p in DATA_DIR.rglob("*.csv") if p.name in ALLOWED_CSV), key=lambda p: p.name)
+    if names is not None:
+        csv_files = [p for p in csv_files if p.name in names]
 
     skipped = [p.name for p in DATA_DIR.rglob("*.csv") if p.name not in ALLOWED_CSV]
     if skipped:
         print(f"RAG: 対象外CSVは読み込みません: {', '.join(skipped)}")
 
-    print(f"RAG: 合計 {len(docs)} 件のドキュメントを読み込みました。")
-
-    splitter = RecursiveCharacterTextSplitter(chunk_size=15000, chunk_overlap=0)
-    chunks = splitter.split_documents(docs)
-    print(f"RAG: {len(chunks)} 個のチャンクに分割されました。")
-    return chunks
+    if any(p.name in MUNICIPALITY_FILES for p in csv_files):
+        # 市区町村データの結合テーブルを先に作っておき、ワーカーはキャッシュを読むだけにする
+        store = get_features(encodings)
+        print(f"RAG: 市区町村テーブル {len(store)}地域 × {len(store.columns)}項目")
+
+    workers = max(1, min(INGEST_PROCESSES, len(csv_files)))
+    parse_times = {}
+    total_rows = 0
+    total_chunks = 0
+    with tempfile.TemporaryDirectory(prefix="rag_ingest_") as spill_dir:
+        for path, result in _iter_parsed_files(csv_files, encodings or {}, workers, Path(spill_dir)):
+            if isinstance(result, Exception):
+                print(f"  - 読込失敗: {path.name} ({result})")
+                continue
+
+            print(
+                f"  - 読込成功: {path.name}（{result['rows']}行 → {result['chunks']}チャンク, "
+                f"{result['encoding']}, {result['seconds']:.2f}秒）"
+            )
+            parse_times[path.name] = result["seconds"]
+            if report is not None:
+                report[path.name] = {"encoding": result["encoding"], "parse_seconds": round(result["seconds"], 3)}
+
+            total_rows += result["rows"]
+            total_chunks += result["chunks"]
+            yield from read_spill(Path(result["spill"]))
+            os.remove(result["spill"])
+
+    print(f"RAG: 合計 {total_rows} 行を {total_chunks} 個のチャンクに分割しました。")
+    if parse_times:
+        ranking = ", ".join(f"{name} {sec:.2f}秒" for name, sec in sorted(parse_times.items(), key=lambda x: -x[1]))
+        print(f"RAG: 解析時間（{workers}プロセス）: {ranking}")
+
+def get_features(encodings: dict | None = None) -> FeatureStore:
+    """人口・医療・居住・教育を結合した市区町村テーブル（プロセス内で1回だけ読み込む）"""
+    return get_feature_store(DATA_DIR, PARQUET_CACHE_DIR, encodings)
+
+def get_place_matcher() -> PlaceMatcher | None:
+    """市区町村テーブルの地名から作る PlaceMatcher（読めなければ None にして絞り込みなしで検索する）"""
+    global place_matcher
+    if place_matcher is None:
+        try:
+            place_matcher = PlaceMatcher(get_features())
+            print(f"RAG: 地名辞書を作成しました（{len(place_matcher.surfaces)}表記）")
+        except Exception as e:
+            print(f"RAG: 地名辞書を作成できませんでした（地域での絞り込みなし）: {e}")
+            return None
+    return place_matcher
+
+def embedding_model_key(dimensions: int | None = EMBEDDING_DIMENSIONS) -> str:
+    """埋め込みキャッシュとマニフェストに記録するモデル名（次元数を変えたら別のベクトルとして扱う）"""
+    return f"{EMBEDDING_MODEL}:{dimensions}" if dimensions else EMBEDDING_MODEL
+
+def make_embeddings(openai_key: str, dimensions: int | None = EMBEDDING_DIMENSIONS) -> CachedEmbeddings:
+    """ディスクキャッシュ・レート制限付きの埋め込みクライアント"""
+    client = OpenAIEmbeddings(
+        model=EMBEDDING_MODEL,
+        dimensions=dimensions,
+        openai_api_key=openai_key,
+        openai_api_base="https://api.openai.iniad.org/api/v1",
+        chunk_size=25,
+        max_retries=0,  # 再試行は RateLimitedEmbeddings 側で行う
+    )
+    limited = RateLimitedEmbeddings(client, RateLimiter(EMBED_RPM, EMBED_TPM), request_size=25)
+    return CachedEmbeddings(
+        limited,
+        model=embedding_model_key(dimensions),
+        path=EMBEDDING_CACHE_PATH,
+        max_entries=EMBEDDING_CACHE_MAX_ENTRIES,
+    )
 
-def initialize_vectorstore(chunks):
+def get_response_cache() -> ResponseCache:
+    """提案結果のキャッシュ（プロセス内で1つを共有）"""
+    global response_cache
+    if response_cache is None:
+        response_cache = ResponseCache(
+            RESPONSE_CACHE_PATH, ttl=RESPONSE_CACHE_TTL, max_entries=RESPONSE_CACHE_MAX_ENTRIES
+        )
+    return response_cache
+
+def get_semantic_cache() -> SemanticCache:
+    """意味キャッシュ（プロセス内で1つを共有）"""
+    global semantic_cache
+    if semantic_cache is None:
+        semantic_cache = SemanticCache(
+            SEMANTIC_CACHE_PATH,
+            threshold=SEMANTIC_CACHE_THRESHOLD,
+            ttl=RESPONSE_CACHE_TTL,
+            max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+        )
+    return semantic_cache
+
+def get_precomputed_store() -> PrecomputedStore:
+    global precomputed_store
+    if precomputed_store is None:
+        precomputed_store = PrecomputedStore(PRECOMPUTED_PATH)
+    return precomputed_store
+
+def get_single_flight() -> SingleFlight:
+    global single_flight
+    if single_flight is None:
+        lock_dir = SINGLE_FLIGHT_LOCK_DIR if SINGLE_FLIGHT_CROSS_PROCESS and RESPONSE_CACHE else None
+        single_flight = SingleFlight(lock_dir)
+    return single_flight
+
+def get_admission() -> AdmissionController:
+    """LLM呼び出しの同時実行数の制限（プロセス内で1つを共有）"""
+    global admission
+    if admission is None:
+        admission = AdmissionController(LLM_CONCURRENCY, max_queue=LLM_QUEUE_SIZE, max_wait=LLM_QUEUE_TIMEOUT)
+    return admission
+
+def answer_settings() -> dict:
+    """提案の内容に影響する設定（キャッシュ・事前計算のキーに含める）"""
+    return {"scoring": USE_SCORING, "shortlist": SHORTLIST_SIZE}
+
+def recommendation_key(answers: dict) -> tuple[str, str]:
+    """(キャッシュキー, 現在のベクトルDBのフィンガープリント)"""
+    fingerprint = (load_saved_fingerprint() or {}).get("hash", "")
+    return cache_key(answers, fingerprint, answer_settings()), fingerprint
+
+def precomputed_recommendation(answers: dict) -> dict | None:
+    """事前に作った提案があれば返す（自由記述が空で、年代と選択肢が一致するもの）"""
+    if not answers:
+        return None
+    key, fingerprint = recommendation_key(answers)
+    return get_precomputed_store().get(key, fingerprint)
+
+def start_precompute() -> bool:
+    """
+    選択肢の全組み合わせの提案を別スレッドで作る（作成済みは飛ばす）。既に実行中なら何もしない。
+    QAチェーンができてから呼ぶ。
+    """
+    global precompute_thread
+    # views が rag_service を読み込むので、質問の定義はここで読み込む
+    from .views import QUESTIONS, build_recommendation_prompt
+
+    with _precompute_lock:
+        if precompute_thread is not None and precompute_thread.is_alive():
+            return False
+
+        def generate(answers: dict) -> dict:
+            return generate_recommendation(build_recommendation_prompt(answers), answers=answers)
+
+        def runner():
+            try:
+                counts = precompute(
+                    get_precomputed_store(),
+                    answer_grid(QUESTIONS),
+                    recommendation_key,
+                    generate,
+                    concurrency=PRECOMPUTE_CONCURRENCY,
+                    log=lambda message: print(f"RAG: 事前計算 {message}"),
+                )
+                print(f"RAG: 事前計算が完了しました。（保存 {counts['saved']}件 / 失敗 {counts['failed']}件）")
+            except Exception as e:
+                print(f"RAG: 事前計算に失敗しました: {e}")
+                traceback.print_exc()
+
+        precompute_thread = threading.Thread(target=runner, name="rag-precompute", daemon=True)
+        precompute_thread.start()
+    return True
+
+def get_cache_metrics() -> dict:
+    """提案キャッシュ（完全一致・意味）と埋め込みキャッシュの統計"""
+    metrics = {}
+    if RESPONSE_CACHE:
+        metrics["response_cache"] = get_response_cache().stats()
+    if SEMANTIC_CACHE:
+        metrics["semantic_cache"] = get_semantic_cache().stats()
+    if embedding_cache is not None:
+        metrics["embedding_cache"] = embedding_cache.stats()
+    metrics["precomputed"] = {
+        "entries": len(get_precomputed_store()),
+        "running": precompute_thread is not None and precompute_thread.is_alive(),
+    }
+    if SINGLE_FLIGHT:
+        metrics["single_flight"] = get_single_flight().stats()
+    metrics["admission"] = get_admission().stats()
+    metrics["stages"] = stage_stats()
+    return metrics
+
+def get_embeddings(openai_key: str) -> CachedEmbeddings:
+    """ディスクキャッシュ付きの埋め込みクライアント（プロセス内で1つを共有）"""
+    global embedding_cache
+    if embedding_cache is None:
+        embedding_cache = make_embeddings(openai_key)
+    return embedding_cache
+
+def open_vectorstore(embeddings):
+    """VECTOR_BACKEND のベクトルDBを開く（無ければ空で作る）"""
+    if VECTOR_BACKEND not in VECTOR_BACKENDS:
+        raise ValueError(f"RAG_VECTOR_BACKEND は {' / '.join(VECTOR_BACKENDS)} のいずれかにしてください: {VECTOR_BACKEND}")
+    quantization = None if VECTOR_QUANTIZATION == "none" else VECTOR_QUANTIZATION
+    if VECTOR_BACKEND == "numpy":
+        return NumpyVectorStore(NUMPY_STORE_DIR, embedding_function=embeddings, quantization=quantization)
+    if quantization:
+        print("RAG: RAG_VECTOR_QUANTIZATION は numpy のベクトルDBでのみ有効です（chroma では無視します）")
+    # 書き込みは埋め込み済みのベクトルを渡す（write_batch）。検索の埋め込みは embeddings がそのまま行う
+    return Chroma(persist_directory=str(DB_DIR), embedding_function=PrecomputedEmbeddings(embeddings))
+
+def initialize_vectorstore(chunks, ingest_report: dict | None = None):
     openai_key = os.getenv("OPENAI_API_KEY")
     if not openai_key:
         raise ValueError("OPENAI_API_KEYが環境変数に設定されていません。")
@@ -209,12 +603,8 @@ def initialize_vectorstore(chunks):
     os.environ["OPENAI_API_KEY"] = openai_key
     os.environ["OPENAI_BASE_URL"] = "https://api.openai.iniad.org/api/v1"
 
-    embeddings = OpenAIEmbeddings(
-        model="text-embedding-3-small",
-        openai_api_key=openai_key,
-        openai_api_base="https://api.openai.iniad.org/api/v1",
-        chunk_size=25
-    )
+    embeddings = get_embeddings(openai_key)
+    embeddings.reset_stats()
 
     current_fp = compute_data_fingerprint()
     saved_fp = load_saved_fingerprint()
@@ -228,61 +618,135 @@ def initialize_vectorstore(chunks):
             current=0,
             percent=100,
             message="ベクトルDBは既に作成済みです。",
-            error=""
-        )
-        vectorstore = Chroma(
-            persist_directory=str(DB_DIR),
-            embedding_function=embeddings
+            error="",
+            resumed=False,
+            skipped=0,
         )
-        return vectorstore
+        return open_vectorstore(embeddings)
+
+    space_changed = db_exists and bool(saved_fp) and not same_embedding_space(saved_fp, current_fp)
+    incremental = db_exists and has_file_manifest(saved_fp) and not space_changed
 
-    if db_exists:
-        print("RAG: CSVが更新されたため、既存DBを削除して再作成します。")
+    # 同じCSV構成に対する作成が途中で止まっていたら、書き込み済みのチャンクを活かして再開する
+    checkpoint = load_checkpoint()
+    resuming = db_exists and bool(checkpoint) and checkpoint.get("target") == current_fp.get("hash")
+    if db_exists and checkpoint and not resuming:
+        print("RAG: CSVが再度更新されたため、前回のチェックポイントを破棄します。")
+        clear_checkpoint()
+
+    if db_exists and not incremental and not resuming:
+        if space_changed:
+            print("RAG: 埋め込みモデル・次元数またはベクトルDBの種類が変わったため、既存DBを削除して再作成します。")
+        else:
+            print("RAG: CSVが更新されたため、既存DBを削除して再作成します。")
         import shutil
         shutil.rmtree(DB_DIR, ignore_errors=True)
 
-    print("RAG: 新しいベクトルDBを作成します...")
+    if incremental:
+        changed, removed = diff_fingerprints(saved_fp, current_fp)
+        print(
+            "RAG: 変更のあったCSVのみ再インデックスします。"
+            f"（変更: {', '.join(sorted(changed)) or 'なし'} / 削除: {', '.join(sorted(removed)) or 'なし'}）"
+        )
+    else:
+        print("RAG: 新しいベクトルDBを作成します...")
     os.makedirs(DB_DIR, exist_ok=True)
 
-    vectorstore = Chroma(
-        embedding_function=embeddings,
-        persist_directory=str(DB_DIR),
-    )
+    vectorstore = open_vectorstore(embeddings)
 
-    total = len(chunks)
-    _set_status(
-        state="building",
-        total=total,
-        current=0,
-        percent=0,
-        message=f"ベクトルDB作成中... 0/{total}",
-        error=""
-    )
+    if not resuming:
+        checkpoint = {"target": current_fp.get("hash"), "purged": False, "batches": []}
+        save_checkpoint(checkpoint)
 
-    batch_size = 200
-    for i in range(0, total, batch_size):
-        batch = chunks[i:i + batch_size]
-        vectorstore.add_documents(batch)
+    if incremental and not checkpoint.get("purged"):
+        delete_documents_by_source(vectorstore, changed | removed)
+    checkpoint["purged"] = True
+    save_checkpoint(checkpoint)
+
+    if resuming:
+        print("RAG: 中断したDB作成を再開します。（書き込み済みのチャンクはスキップ）")
 
-        done = i + len(batch)
-        percent = int(done * 100 / total) if total else 100
+    # CSV読込・分割は別スレッドで進め、上限付きキュー経由で埋め込みへ流す
+    batch_size = 200
+    batcher = BackgroundBatcher(chunks, batch_size=batch_size, maxsize=INGEST_QUEUE_BATCHES)
+    written = 0
+    skipped = 0
+
+    def report_progress():
+        total = batcher.produced
+        current = written + skipped
+        percent = int(current * 100 / total) if total else 0
+        message = f"ベクトルDB作成中... {current}/{total}"
+        if not batcher.finished:
+            # 総数がまだ確定していないので100%にはしない
+            percent = min(percent, 99)
+            message += "（CSV読込中）"
         _set_status(
             state="building",
             total=total,
-            current=done,
+            current=current,
             percent=percent,
-            message=f"ベクトルDB作成中... {done}/{total}",
-            error=""
+            message=message,
+            error="",
+            resumed=resuming,
+            skipped=skipped,
         )
 
+    def pending_batches():
+        nonlocal skipped
+        for batch in batcher:
+            if resuming:
+                done_ids = existing_chunk_ids(vectorstore, [c.metadata["chunk_id"] for c in batch])
+                remaining = [c for c in batch if c.metadata["chunk_id"] not in done_ids]
+                skipped += len(batch) - len(remaining)
+                batch = remaining
+                report_progress()
+            if batch:
+                yield batch
+
+    report_progress()
+
+    # 埋め込みは複数バッチを並列に、Chroma への書き込みはこのスレッドだけで行う
+    for batch, vectors in embed_batches_concurrently(pending_batches(), embeddings, max_workers=EMBED_CONCURRENCY):
+        write_batch(vectorstore, batch, vectors)
+        checkpoint["batches"].append(f"{batch[0].metadata['chunk_id']}..{batch[-1].metadata['chunk_id']}")
+        save_checkpoint(checkpoint)
+
+        written += len(batch)
+        report_progress()
+
+    total = batcher.produced
+    if resuming:
+        print(f"RAG: 書き込み済み {skipped}/{total} チャンクをスキップしました。")
+    if isinstance(vectorstore, NumpyVectorStore):
+        # バッチごとに書き足した差分を1つの世代にまとめる
+        vectorstore.compact()
+
+    annotate_fingerprint(current_fp, saved_fp, ingest_report or {})
     save_fingerprint(current_fp)
+    # 事前計算した提案は前のフィンガープリントのものなので、ここから先は使われない（initialize_rag が作り直しを始める）
+    stale = len(get_precomputed_store())
+    if stale:
+        print(f"RAG: 事前計算した提案 {stale}件はCSV変更前のものになりました。")
+    if SEMANTIC_CACHE:
+        # 作り直したCSVを根拠にした提案だけを消す（全体を作り直した場合は全部）
+        dropped = get_semantic_cache().invalidate_sources((changed | removed) if incremental else None)
+        print(f"RAG: 意味キャッシュから {dropped} 件の提案を削除しました。")
+    build_lexical_index(vectorstore, current_fp["hash"])
+    clear_checkpoint()
+
+    cache_stats = embeddings.stats()
+    print(
+        f"RAG: 埋め込みキャッシュ ヒット {cache_stats['hits']} / ミス {cache_stats['misses']}"
+        f"（ヒット率 {cache_stats['hit_rate']:.1%}、保存件数 {cache_stats['entries']}）"
+    )
 
     _set_status(
         state="ready",
         total=total,
         current=total,
         percent=100,
-        message="ベクトルDB作成が完了しました。",
+        message="ベクトルDB作成が完了しました。" + (f"（再開: {skipped}件スキップ）" if resuming else ""),
         error=""
     )
 
@@ -305,14 +769,22 @@ def setup_qa_chain(vectorstore):
             temperature=0.0,
         )
 
-        retriever = vectorstore.as_retriever(
-            search_type="mmr",
-            search_kwargs={
-                "k": 4,
-                "fetch_k": 10,
-                "lambda_mult": 0.5
-            },
-        )
+        # MMR 検索（埋め込みと検索を別々の区間として記録する）
+        retriever = MmrRetriever(vectorstore=vectorstore, k=4, fetch_k=10, lambda_mult=0.5)
+        if HYBRID_RETRIEVAL or PLACE_FILTER:
+            # 地名などの完全一致は BM25 で拾い、ベクトル検索の結果と RRF で統合する
+            retriever = HybridRetriever(
+                vectorstore=vectorstore,
+                vector_retriever=retriever,
+                index=load_lexical_index(vectorstore) if HYBRID_RETRIEVAL else None,
+                place_matcher=get_place_matcher() if PLACE_FILTER else None,
+                k=4,
+                fetch_k=10,
+                filtered_fetch_k=FILTERED_FETCH_K,
+                skip_coverage=LEXICAL_SKIP_COVERAGE,
+            )
+        # 4件の合計がコンテキストの上限を超える場合は、関連の低いものから落とす
+        retriever = TokenBudgetRetriever(retriever=retriever, max_tokens=CONTEXT_TOKENS)
 
         template = """あなたは地方移住の専門家です。
         提供されたコンテキスト情報のみを使用して、ユーザーの質問に回答してください。
@@ -352,7 +824,11 @@ def setup_qa_chain(vectorstore):
         print(f"RAG: QAチェーンのセットアップに失敗しました。エラー: {e}")
         return None
 
-def initialize_rag():
+def initialize_rag(precompute_after_rebuild: bool = True):
+    """
+    ベクトルDBとQAチェーンを用意する。DBを作り直したときは、precompute_after_rebuild かつ PRECOMPUTE_AFTER_REBUILD なら
+    事前計算の提案の作り直しを別スレッドで始める。
+    """
     global qa_chain
     if qa_chain is not None:
         return qa_chain
@@ -363,17 +839,25 @@ def initialize_rag():
         saved_fp = load_saved_fingerprint()
         db_exists = DB_DIR.exists() and any(DB_DIR.iterdir())
 
-        if db_exists and saved_fp and saved_fp.get("hash") == current_fp.get("hash"):
+        ingest_report = {}
+        encodings = manifest_encodings(saved_fp)
+        rebuilding = not (db_exists and saved_fp and saved_fp.get("hash") == current_fp.get("hash"))
+        if not rebuilding:
             print("RAG: CSV変更なしのため、チャンク作成をスキップします。")
             chunks = []
+        elif db_exists and has_file_manifest(saved_fp):
+            changed, _ = diff_fingerprints(saved_fp, current_fp)
+            chunks = load_and_split_documents(changed, encodings=encodings, report=ingest_report)
         else:
-            chunks = load_and_split_documents()
+            chunks = load_and_split_documents(encodings=encodings, report=ingest_report)
 
-        vectorstore = initialize_vectorstore(chunks)
+        vectorstore = initialize_vectorstore(chunks, ingest_report)
         qa_chain = setup_qa_chain(vectorstore)
 
         if qa_chain:
             print("--- RAGシステム初期化完了 ---")
+            if rebuilding and precompute_after_rebuild and PRECOMPUTE_AFTER_REBUILD:
+                start_precompute()
         else:
             print("--- RAGシステム初期化失敗 ---")
 
@@ -384,49 +868,265 @@ def initialize_rag():
 
     return qa_chain
 
-def generate_recommendation(prompt: str) -> dict:
-    global qa_chain
+def answer_place(answers: dict) -> PlaceMatch | None:
+    """自由記述に書かれた地名（PLACE_FILTER が無効、または地名辞書が作れなければ None）"""
+    matcher = get_place_matcher() if PLACE_FILTER else None
+    return matcher.extract(str(answers.get("else") or "")) if matcher is not None else None
 
+def shortlist_municipalities(answers: dict) -> list[Document] | None:
+    """
+    回答に合う市区町村の上位をドキュメントにする。テーブルが作れない場合は None（ベクトル検索に任せる）。
+    自由記述に地名があればその地域の中だけで点数付けし、該当する行が無ければ None（地名で絞り込んだ検索に任せる）。
+    """
+    try:
+        store = get_features(manifest_encodings(load_saved_fingerprint()))
+        place = answer_place(answers)
+        ranked = rank_municipalities(store, answers, top_n=SHORTLIST_SIZE, place=place)
+    except Exception as e:
+        print(f"RAG: 市区町村のスコアリングに失敗したため、ベクトル検索で回答します: {e}")
+        return None
+    if place:
+        print(f"RAG: 自由記述の地名で候補を絞り込みます: {'・'.join(place.names)}（{len(ranked)}件）")
+    if ranked.empty:
+        return None
+    print("RAG: スコア上位 " + ", ".join(f"{p}{n}({s})" for p, n, s in zip(ranked["都道府県"], ranked["市区町村"], ranked["score"])))
+    return shortlist_documents(store, ranked)
+
+@span("cache_lookup")
+def _find_cached_recommendation(answers: dict | None) -> tuple[dict | None, dict]:
+    """
+    完全一致・意味キャッシュの順に過去の提案を探す。
+    戻り値は (見つかった提案 または None, 生成後に _remember_recommendation へ渡すキー情報)。
+    """
+    lookup = {}
+
+    # 同じ回答・同じデータなら、前回の提案をそのまま返す（LLMを呼ばない）
+    if answers and RESPONSE_CACHE:
+        lookup["key"], lookup["fingerprint"] = recommendation_key(answers)
+        cached = get_response_cache().get(lookup["key"], lookup["fingerprint"])
+        if cached is not None:
+            return cached, lookup
+
+    # 言い換えの自由記述は、同じ地名・同じ選択肢で自由記述の埋め込みが十分近い過去の提案で代用する
+    text = semantic_text(answers) if answers and SEMANTIC_CACHE else ""
+    if text:
+        lookup["scope"] = semantic_scope(
+            answers, answer_settings(), model=embedding_model_key(), place=answer_place(answers)
+        )
+        lookup["text"] = text
+        try:
+            lookup["vector"] = get_embeddings(os.getenv("OPENAI_API_KEY")).embed_query(text)
+        except Exception as e:
+            print(f"RAG: 自由記述を埋め込めないため意味キャッシュを使いません: {e}")
+        else:
+            similar = get_semantic_cache().lookup(lookup["scope"], lookup["vector"])
+            if similar is not None:
+                if "key" in lookup:
+                    get_response_cache().put(lookup["key"], lookup["fingerprint"], similar)
+                return similar, lookup
+    return None, lookup
+
+@span("cache_write")
+def _remember_recommendation(
+    lookup: dict, recommendation: dict, sources: list[Document], shortlisted: bool, seconds: float
+) -> None:
+    """生成した提案を完全一致・意味キャッシュに保存する"""
+    if "key" in lookup:
+        get_response_cache().put(lookup["key"], lookup["fingerprint"], recommendation)
+    if "vector" in lookup:
+        # 根拠のCSV（スコアリングの場合は市区町村テーブルの元になったCSV）
+        used = MUNICIPALITY_FILES if shortlisted else {Path(d.metadata.get("source", "")).name for d in sources}
+        get_semantic_cache().put(lookup["scope"], lookup["text"], lookup["vector"], recommendation, used, seconds)
+
+def _answer_documents(prompt: str, answers: dict | None) -> tuple[list[Document], bool]:
+    """回答のコンテキストにするドキュメントと、スコアリングの上位かどうか（False ならベクトル検索の結果）"""
+    with span("scoring"):
+        shortlist = shortlist_municipalities(answers) if answers and USE_SCORING else None
+    if shortlist:
+        # 検索はせず、点数付けした上位の市区町村だけをプロンプトに入れる
+        return shortlist, True
+    # retrieval は検索全体。内訳は embed_query（クエリの埋め込み）・bm25_search・mmr_search の区間で別に記録する
+    with span("retrieval"):
+        return qa_chain.retriever.invoke(prompt), False
+
+def format_recommendation(answer: str, sources: list[Document]) -> dict:
+    """LLMの回答を 見出し / 本文と参照元（spots）/ 参照元のファイル名（sources）に分ける"""
+    lines = answer.split('\n', 1)
+    headline = lines[0].strip() if lines else "AIによる移住先提案"
+    full_answer_body = lines[1].strip() if len(lines) > 1 else headline
+
+    spots = [full_answer_body]
+
+    seen_sources = []
+    if sources:
+        spots.append("\n--- 参照情報 ---")
+        for doc in sources:
+            src = Path(doc.metadata.get("source", "不明")).name
+            if src not in seen_sources:
+                spots.append(f"【参照元】{src}")
+                seen_sources.append(src)
+                if len(seen_sources) >= 3:
+                    break
+
+    return {
+        "headline": headline,
+        "spots": spots,
+        "sources": seen_sources,
+    }
+
+def _error_recommendation(e: Exception) -> dict:
+    print("RAG応答生成エラー:")
+    traceback.print_exc()
+    return {
+        "headline": "【システムエラー】回答生成中に問題が発生しました",
+        "spots": [f"エラー詳細: {str(e)}"],
+    }
+
+INIT_ERROR_RECOMMENDATION = {
+    "headline": "【システムエラー】RAGサービスの初期化に失敗しました",
+    "spots": ["データフォルダ(data)にファイルがあるか、APIキーが正しいか確認してください。"],
+}
+
+def _flight(prompt: str, answers: dict | None, lookup: dict) -> tuple[str, object]:
+    """
+    同時に走っている同じ提案の生成をまとめるキー（回答があれば正規化した回答、無ければ正規化したプロンプト）と、
+    別プロセスが先に作った結果を確かめる関数（提案キャッシュ）
+    """
+    if "key" in lookup:
+        key = lookup["key"]
+    elif answers:
+        key = recommendation_key(answers)[0]
+    else:
+        key = "prompt:" + hashlib.sha256(normalize_free_text(prompt).encode("utf-8")).hexdigest()
+
+    recheck = None
+    if "key" in lookup:
+        recheck = lambda: get_response_cache().get(lookup["key"], lookup["fingerprint"])
+    return key, recheck
+
+def generate_recommendation(prompt: str, answers: dict | None = None) -> dict:
     if qa_chain is None:
         if not initialize_rag():
-            return {
-                "headline": "【システムエラー】RAGサービスの初期化に失敗しました",
-                "spots": ["データフォルダ(data)にファイルがあるか、APIキーが正しいか確認してください。"],
-            }
+            return dict(INIT_ERROR_RECOMMENDATION)
+
+    cached, lookup = _find_cached_recommendation(answers)
+    if cached is not None:
+        return cached
+
+    def produce() -> dict:
+        started = time.perf_counter()
+        docs, shortlisted = _answer_documents(prompt, answers)
+        with get_admission().slot() as waited:
+            record("llm_queue", waited)
+            with span("llm"):
+                result = qa_chain.combine_documents_chain.invoke({"input_documents": docs, "question": prompt})
+        answer = result.get("output_text", "情報が不足しているため、具体的な提案ができません。")
+
+        with span("format"):
+            recommendation = format_recommendation(answer, docs)
+        _remember_recommendation(lookup, recommendation, docs, shortlisted, time.perf_counter() - started)
+        return recommendation
 
     try:
-        result = qa_chain.invoke({"query": prompt})
-        answer = result.get("result", "情報が不足しているため、具体的な提案ができません。")
-        sources = result.get("source_documents", [])
-
-        lines = answer.split('\n', 1)
-        headline = lines[0].strip() if lines else "AIによる移住先提案"
-        full_answer_body = lines[1].strip() if len(lines) > 1 else headline
-
-        spots = [full_answer_body]
-
-        if sources:
-            spots.append("\n--- 参照情報 ---")
-            seen_sources = set()
-            count = 0
-            for doc in sources:
-                src = Path(doc.metadata.get("source", "不明")).name
-                if src not in seen_sources:
-                    spots.append(f"【参照元】{src}")
-                    seen_sources.add(src)
-                    count += 1
-                    if count >= 3:
-                        break
-
-        return {
-            "headline": headline,
-            "spots": spots,
-        }
+        if not SINGLE_FLIGHT:
+            return produce()
+        key, recheck = _flight(prompt, answers, lookup)
+        # 同じ生成を待っていた呼び出しにも同じ提案を返すので、呼び出し側で書き換えてもよいようにコピーする
+        # （generate は先行する同じ生成を待った時間も含む）
+        with span("generate"):
+            return dict(get_single_flight().do(key, produce, recheck))
+
+    except Busy:
+        # 混雑はエラーではないので、呼び出し側で「しばらくしてから再試行」を返す
+        raise
+    except Exception as e:
+        return _error_recommendation(e)
+
+async def agenerate_recommendation(prompt: str, answers: dict | None = None) -> dict:
+    """
+    generate_recommendation の async 版（ASGI のビュー用）。LLMは ainvoke で待ち、イベントループを塞がない。
+    検索・キャッシュ（SQLite・pandas・Chroma）は同期処理なので、スレッドプールで実行する。
+    """
+    if qa_chain is None:
+        if not await sync_to_async(initialize_rag, thread_sensitive=False)():
+            return dict(INIT_ERROR_RECOMMENDATION)
+
+    cached, lookup = await sync_to_async(_find_cached_recommendation, thread_sensitive=False)(answers)
+    if cached is not None:
+        return cached
+
+    async def produce() -> dict:
+        started = time.perf_counter()
+        docs, shortlisted = await sync_to_async(_answer_documents, thread_sensitive=False)(prompt, answers)
+        async with get_admission().aslot() as waited:
+            record("llm_queue", waited)
+            with span("llm"):
+                result = await qa_chain.combine_documents_chain.ainvoke({"input_documents": docs, "question": prompt})
+        answer = result.get("output_text", "情報が不足しているため、具体的な提案ができません。")
+
+        with span("format"):
+            recommendation = format_recommendation(answer, docs)
+        await sync_to_async(_remember_recommendation, thread_sensitive=False)(
+            lookup, recommendation, docs, shortlisted, time.perf_counter() - started
+        )
+        return recommendation
+
+    try:
+        if not SINGLE_FLIGHT:
+            return await produce()
+        key, recheck = _flight(prompt, answers, lookup)
+        with span("generate"):
+            return dict(await get_single_flight().ado(key, produce, recheck))
+
+    except Busy:
+        raise
+    except Exception as e:
+        return _error_recommendation(e)
+
+async def astream_recommendation(prompt: str, answers: dict | None = None) -> AsyncIterator[dict]:
+    """
+    generate_recommendation のストリーミング版（async ジェネレーター）。LLMの出力を astream で受け取り、
+    {"type": "token", "text": ...} で届いたそばから返し、最後に {"type": "result", "result": 提案} を返す
+    （キャッシュにあれば result だけ）。検索・キャッシュは同期処理なので、スレッドプールで実行する。
+    """
+    if qa_chain is None:
+        if not await sync_to_async(initialize_rag, thread_sensitive=False)():
+            yield {"type": "result", "result": dict(INIT_ERROR_RECOMMENDATION)}
+            return
+
+    cached, lookup = await sync_to_async(_find_cached_recommendation, thread_sensitive=False)(answers)
+    if cached is not None:
+        yield {"type": "result", "result": cached}
+        return
+
+    started = time.perf_counter()
+    try:
+        docs, shortlisted = await sync_to_async(_answer_documents, thread_sensitive=False)(prompt, answers)
 
+        # stuff チェーンと同じプロンプトを組み立て、LLMだけをストリーミングで呼ぶ
+        combine = qa_chain.combine_documents_chain
+        context = combine.document_separator.join(format_document(d, combine.document_prompt) for d in docs)
+        messages = combine.llm_chain.prompt.format_prompt(
+            **{combine.document_variable_name: context, "question": prompt}
+        )
+        parts = []
+        async with get_admission().aslot() as waited:
+            record("llm_queue", waited)
+            with span("llm"):
+                async for chunk in combine.llm_chain.llm.astream(messages):
+                    if chunk.content:
+                        parts.append(chunk.content)
+                        yield {"type": "token", "text": chunk.content}
+
+        answer = "".join(parts) or "情報が不足しているため、具体的な提案ができません。"
+        with span("format"):
+            recommendation = format_recommendation(answer, docs)
+        await sync_to_async(_remember_recommendation, thread_sensitive=False)(
+            lookup, recommendation, docs, shortlisted, time.perf_counter() - started
+        )
+        yield {"type": "result", "result": recommendation}
+
+    except Busy:
+        raise
     except Exception as e:
-        print("RAG応答生成エラー:")
-        traceback.print_exc()
-        return {
-            "headline": "【システムエラー】回答生成中に問題が発生しました",
-            "spots": [f"エラー詳細: {str(e)}"],
-        }
+        yield {"type": "result", "result": _error_recommendation(e)}
@@ -0,0 +1,184 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from pathlib import Path
+
+# 提案結果のキャッシュ。チャットの回答は選択肢がほぼ決まっているので、
+# 同じ回答（年齢は年代、自由記述は表記ゆれを除いたもの）とデータのフィンガープリントなら同じ結果を返す。
+
+# キーの作り方を変えたら上げる（古いエントリは使われなくなる）
+CACHE_VERSION = 1
+
+# 自由記述で「条件なし」を意味する回答。空欄と同じキーにする（事前計算の結果が使えるように）
+NO_PREFERENCE_ANSWERS = {
+    "", "なし", "無し", "ナシ", "特になし", "特に無し", "とくになし", "ない", "特にない", "とくにない",
+    "ありません", "特にありません", "none", "no", "n/a", "-",
+}
+
+
+def normalize_free_text(text) -> str:
+    """NFKC で正規化し、連続する空白（改行・全角空白を含む）を1つにまとめる"""
+    text = unicodedata.normalize("NFKC", str(text or ""))
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def normalize_else(text) -> str:
+    """自由記述の正規形。「なし」「特になし。」などの条件なしの回答は空文字にする"""
+    text = normalize_free_text(text)
+    if text.rstrip("。.!！").lower() in NO_PREFERENCE_ANSWERS:
+        return ""
+    return text
+
+
+def age_bucket(age) -> str:
+    """年齢を年代にする（「35」→「30代」）。数値でなければ空文字"""
+    if isinstance(age, str):
+        digits = "".join(c for c in age if c.isdigit())
+        age = int(digits) if digits else None
+    if not isinstance(age, int):
+        return ""
+    return f"{max(age, 0) // 10 * 10}代"
+
+
+def canonical_answers(answers: dict) -> dict:
+    """キャッシュキーにするための回答の正規形"""
+    return {
+        "age": age_bucket(answers.get("age")),
+        "style": normalize_free_text(answers.get("style")),
+        "climate": normalize_free_text(answers.get("climate")),
+        "family": normalize_free_text(answers.get("family")),
+        "else": normalize_else(answers.get("else")),
+    }
+
+
+def cache_key(answers: dict, fingerprint: str, settings: dict | None = None) -> str:
+    """正規化した回答・データのフィンガープリント・回答に影響する設定から作るキー"""
+    payload = {
+        "version": CACHE_VERSION,
+        "answers": canonical_answers(answers),
+        "fingerprint": fingerprint,
+        "settings": settings or {},
+    }
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()
+
+
+class ResponseCache:
+    """
+    SQLite に保存する提案結果のキャッシュ（複数のワーカープロセスで共有できる）。
+    保存から ttl 秒を過ぎたものは使わず、件数が max_entries を超えたら最終利用時刻が古いものから削除する（LRU）。
+    データのフィンガープリントが変わったら、古いフィンガープリントのエントリはまとめて削除する。
+    """
+
+    def __init__(self, path: Path, ttl: float = 7 * 24 * 3600, max_entries: int = 1000):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+        self._fingerprint = None
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                value TEXT NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses(last_used)")
+        self._conn.commit()
+
+    def get(self, key: str, fingerprint: str) -> dict | None:
+        now = time.time()
+        with self._lock:
+            self._invalidate_locked(fingerprint)
+            row = self._conn.execute(
+                "SELECT value, created FROM responses WHERE key = ? AND fingerprint = ?",
+                (key, fingerprint),
+            ).fetchone()
+            if row is not None and now - row[1] > self.ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                self.expirations += 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, fingerprint: str, value: dict) -> None:
+        now = time.time()
+        raw = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._invalidate_locked(fingerprint)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, fingerprint, value, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, fingerprint, raw, now, now),
+            )
+            expired = self._conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,)).rowcount
+            self.expirations += max(expired, 0)
+            self._evict_locked()
+            self._conn.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "entries": entries,
+                "max_entries": self.max_entries,
+            }
+
+    def _invalidate_locked(self, fingerprint: str) -> None:
+        """フィンガープリントが変わっていたら、それ以外のエントリを削除する（プロセスごとに変化時の1回だけ）"""
+        if fingerprint == self._fingerprint:
+            return
+        deleted = self._conn.execute("DELETE FROM responses WHERE fingerprint != ?", (fingerprint,)).rowcount
+        self._conn.commit()
+        self.invalidations += max(deleted, 0)
+        self._fingerprint = fingerprint
+
+    def _evict_locked(self) -> None:
+        count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        overflow = count - self.max_entries
+        if overflow <= 0:
+            return
+        self._conn.execute(
+            """
+            DELETE FROM responses WHERE key IN (
+                SELECT key FROM responses ORDER BY last_used ASC LIMIT ?
+            )
+            """,
+            (overflow,),
+        )
+        self.evictions += overflow
@@ -0,0 +1,149 @@
+from typing import Any
+
+from langchain.schema import Document
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.retrievers import BaseRetriever
+
+from .embedding_pipeline import count_tokens
+from .places import chroma_where
+from .timing import span
+
+# 検索結果をプロンプトに詰める前の調整（QAチェーンの retriever を包んで使う）
+
+
+def document_tokens(doc: Document) -> int:
+    """チャンク作成時に記録したトークン数（古いDBで無ければその場で数える）"""
+    tokens = doc.metadata.get("tokens")
+    if isinstance(tokens, int):
+        return tokens
+    return count_tokens([doc.page_content])
+
+
+def fit_to_budget(docs: list[Document], max_tokens: int) -> list[Document]:
+    """
+    検索順を保ったまま、合計トークン数が max_tokens 以内になるようにドキュメントを選ぶ。
+    入りきらないものは飛ばして次を試す。先頭（最も関連の高いもの）は上限を超えても必ず残す。
+    """
+    selected = []
+    used = 0
+    for doc in docs:
+        tokens = document_tokens(doc)
+        if selected and used + tokens > max_tokens:
+            continue
+        selected.append(doc)
+        used += tokens
+    return selected
+
+
+class TokenBudgetRetriever(BaseRetriever):
+    """retriever の結果を、stuff プロンプトのコンテキストが max_tokens を超えないように絞る"""
+
+    retriever: BaseRetriever
+    max_tokens: int
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        docs = self.retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        return fit_to_budget(docs, self.max_tokens)
+
+
+class MmrRetriever(BaseRetriever):
+    """
+    ベクトルDBの MMR 検索。クエリの埋め込み（embed_query）と検索（mmr_search）を別の区間として記録する。
+    invoke の追加引数（filter / fetch_k）で検索条件を上書きできる。
+    """
+
+    vectorstore: Any
+    k: int = 4
+    fetch_k: int = 10
+    lambda_mult: float = 0.5
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun, **kwargs: Any
+    ) -> list[Document]:
+        embedding = self.vectorstore.embeddings.embed_query(query)
+        with span("mmr_search"):
+            return self.vectorstore.max_marginal_relevance_search_by_vector(
+                embedding,
+                k=kwargs.get("k", self.k),
+                fetch_k=kwargs.get("fetch_k", self.fetch_k),
+                lambda_mult=self.lambda_mult,
+                filter=kwargs.get("filter"),
+            )
+
+
+def document_key(doc: Document) -> str:
+    return doc.metadata.get("chunk_id") or doc.page_content
+
+
+def reciprocal_rank_fusion(rankings: list[list[str]], k: int = 60) -> list[str]:
+    """複数の順位リストを RRF（1 / (k + 順位) の合計）で1つにまとめる"""
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda key: -scores[key])
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    文字 n-gram BM25（LexicalIndex）とベクトル検索の結果を RRF で統合する。
+    BM25 の最上位がクエリの語をほぼすべて含む（coverage >= skip_coverage）場合は、
+    埋め込みAPIを呼ばずに BM25 の結果だけを返す。
+    place_matcher があれば、質問に出てくる都道府県・市区町村のチャンクだけを両方の検索の対象にし、
+    候補が絞られている分ベクトル検索の fetch_k を filtered_fetch_k に減らす（0件なら絞り込みなしで検索し直す）。
+    index が None のときはベクトル検索（と地域の絞り込み）だけを行う。
+    """
+
+    vectorstore: Any
+    vector_retriever: BaseRetriever
+    index: Any = None
+    place_matcher: Any = None
+    k: int = 4
+    fetch_k: int = 10
+    filtered_fetch_k: int = 6
+    rrf_k: int = 60
+    skip_coverage: float = 0.9
+
+    def _lexical_documents(self, ids: list[str]) -> dict[str, Document]:
+        if not ids:
+            return {}
+        got = self.vectorstore.get(ids=ids, include=["documents", "metadatas"])
+        return {
+            i: Document(page_content=text, metadata=md or {})
+            for i, text, md in zip(got["ids"], got["documents"], got["metadatas"])
+        }
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        place = self.place_matcher.extract(query) if self.place_matcher is not None else None
+        if place:
+            docs = self._search(query, place, run_manager)
+            if docs:
+                return docs
+        return self._search(query, None, run_manager)
+
+    def _search(self, query: str, place, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        lexical_ids = []
+        if self.index is not None:
+            mask = self.index.area_mask(place.prefs, place.munis) if place else None
+            with span("bm25_search"):
+                lexical_ids, _, coverage = self.index.search(query, k=self.fetch_k, mask=mask)
+            if coverage >= self.skip_coverage and len(lexical_ids) >= self.k:
+                docs = self._lexical_documents(lexical_ids[:self.k])
+                return [docs[i] for i in lexical_ids[:self.k] if i in docs]
+
+        search_kwargs = {}
+        if place:
+            search_kwargs = {"filter": chroma_where(place), "fetch_k": self.filtered_fetch_k}
+        vector_docs = self.vector_retriever.invoke(
+            query, config={"callbacks": run_manager.get_child()}, **search_kwargs
+        )
+        by_key = {document_key(d): d for d in vector_docs}
+        fused = reciprocal_rank_fusion([lexical_ids, list(by_key)], k=self.rrf_k)[:self.k]
+
+        missing = [key for key in fused if key not in by_key]
+        by_key.update(self._lexical_documents(missing))
+        return [by_key[key] for key in fused if key in by_key]
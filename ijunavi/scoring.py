@@ -0,0 +1,230 @@
+import re
+
+import numpy as np
+import pandas as pd
+from langchain.schema import Document
+
+from .estat import CODE_COLUMN, NAME_COLUMN, PREF_COLUMN
+from .feature_store import FeatureStore
+from .places import PlaceMatch
+
+# チャットの回答から市区町村を点数付けし、上位だけを LLM に渡すためのスコアリング。
+# 特徴量はすべて NumPy の列演算で計算するので、全市区町村（約1,900）でも数ミリ秒で終わる。
+
+# 県庁所在地の年平均気温（℃、平年値の概数）。「暖かい / 涼しい」の判定に使う
+PREF_MEAN_TEMPERATURE = {
+    "01": 9.2, "02": 10.7, "03": 10.6, "04": 12.8, "05": 12.0, "06": 12.1, "07": 13.4, "08": 14.1,
+    "09": 14.3, "10": 15.0, "11": 15.4, "12": 16.2, "13": 15.8, "14": 16.2, "15": 13.9, "16": 14.5,
+    "17": 15.0, "18": 14.8, "19": 15.1, "20": 12.3, "21": 16.2, "22": 16.9, "23": 16.2, "24": 16.2,
+    "25": 15.0, "26": 16.2, "27": 17.1, "28": 16.9, "29": 15.2, "30": 16.9, "31": 15.2, "32": 15.2,
+    "33": 16.2, "34": 16.5, "35": 15.6, "36": 16.8, "37": 16.7, "38": 16.8, "39": 17.3, "40": 17.3,
+    "41": 16.9, "42": 17.2, "43": 17.2, "44": 16.8, "45": 17.7, "46": 18.8, "47": 23.3,
+}
+
+# 特徴量: 名前 → (説明, 計算式)。計算式は列名 → 配列 の関数を受け取る
+FEATURES = {
+    "医師の多さ": ("人口千人あたり医師数", lambda c: c("医師数") / c("人口総数") * 1000),
+    "医療機関の多さ": ("人口1万人あたり病院・診療所数", lambda c: (c("一般病院数") + c("一般診療所数")) / c("人口総数") * 10000),
+    "小学校の多さ": ("年少人口千人あたり小学校数", lambda c: c("小学校数") / c("年少人口") * 1000),
+    "幼稚園の多さ": ("年少人口千人あたり幼稚園数", lambda c: c("幼稚園数") / c("年少人口") * 1000),
+    "子どもの多さ": ("年少人口の割合", lambda c: c("年少人口") / c("人口総数")),
+    "高齢化": ("老年人口の割合", lambda c: c("老年人口") / c("人口総数")),
+    "住宅の広さ": ("1住宅当たり延べ面積", lambda c: c("1住宅当たり延べ面積")),
+    "持ち家率": ("持ち家数 / 居住世帯あり住宅数", lambda c: c("持ち家数") / c("居住世帯あり住宅数")),
+    "買い物・外食": ("人口千人あたり小売店・飲食店数", lambda c: (c("小売店数") + c("飲食店数")) / c("人口総数") * 1000),
+    "都市規模": ("人口総数（対数）", lambda c: np.log10(c("人口総数"))),
+    "暖かさ": ("県庁所在地の年平均気温", None),
+}
+
+# 回答ごとの重み（特徴量の z スコアに掛ける）
+STYLE_WEIGHTS = {
+    "自然": {"都市規模": -1.5, "住宅の広さ": 1.0, "買い物・外食": -0.5},
+    "都市": {"都市規模": 1.5, "買い物・外食": 1.0, "医療機関の多さ": 0.5},
+    "バランス": {"買い物・外食": 0.5, "住宅の広さ": 0.5},
+}
+CLIMATE_WEIGHTS = {
+    "暖かい": {"暖かさ": 1.5},
+    "涼しい": {"暖かさ": -1.5},
+}
+FAMILY_WEIGHTS = {
+    "単身": {"買い物・外食": 1.0},
+    "夫婦のみ": {"医療機関の多さ": 0.5, "住宅の広さ": 0.5},
+    "子どものいる世帯": {"小学校の多さ": 1.0, "幼稚園の多さ": 0.5, "子どもの多さ": 1.0, "住宅の広さ": 0.5},
+    "二世帯": {"住宅の広さ": 1.5, "持ち家率": 1.0, "医師の多さ": 0.5},
+}
+# 「その他の条件」の自由記述に含まれる言葉
+KEYWORD_WEIGHTS = {
+    r"病院|医療|医者|通院": {"医師の多さ": 1.0, "医療機関の多さ": 1.0},
+    r"子育て|教育|学校": {"小学校の多さ": 1.0, "子どもの多さ": 0.5},
+    r"買い物|便利|飲食|外食": {"買い物・外食": 1.0},
+    r"広い|庭|戸建": {"住宅の広さ": 1.0, "持ち家率": 0.5},
+    r"静か|田舎|自然": {"都市規模": -1.0},
+}
+
+# 「バランス」は都市規模が中くらいの地域を好む（z スコアの絶対値に掛ける）
+BALANCE_PENALTY = 0.8
+
+# 離島など人口の極端に少ない地域は1人あたりの指標が振れやすいので候補から外す
+MIN_POPULATION = 3000
+
+# z スコアの上下限（外れ値1つで順位が決まらないようにする）
+Z_CLIP = 3.0
+
+
+def answer_weights(answers: dict) -> dict[str, float]:
+    """チャットの回答（age / style / climate / family / else）を特徴量ごとの重みにする"""
+    weights = {}
+
+    def add(table: dict) -> None:
+        for name, w in table.items():
+            weights[name] = weights.get(name, 0.0) + w
+
+    add(STYLE_WEIGHTS.get(answers.get("style", ""), {}))
+    add(CLIMATE_WEIGHTS.get(answers.get("climate", ""), {}))
+    add(FAMILY_WEIGHTS.get(answers.get("family", ""), {}))
+
+    age = answers.get("age")
+    if isinstance(age, int):
+        if age >= 60:
+            add({"医師の多さ": 1.0, "医療機関の多さ": 0.5})
+        elif age < 40:
+            add({"子どもの多さ": 0.5, "高齢化": -0.5})
+
+    text = str(answers.get("else") or "")
+    for pattern, table in KEYWORD_WEIGHTS.items():
+        if re.search(pattern, text):
+            add(table)
+    return weights
+
+
+def compute_features(store: FeatureStore) -> tuple[np.ndarray, np.ndarray]:
+    """
+    全地域の特徴量行列（地域数 × 特徴量数、単位そのまま）と、点数付けの対象にする行のマスクを返す。
+    対象は人口のわかる市区町村（都道府県の行は除く）。
+    """
+    frame = store.frame
+    available = set(frame.columns)
+    cache = {}
+
+    def column(name: str) -> np.ndarray:
+        if name not in cache:
+            cache[name] = store.matrix([name])[:, 0] if name in available else np.full(len(frame), np.nan)
+        return cache[name]
+
+    codes = frame[CODE_COLUMN].to_numpy(dtype=object)
+    pref_codes = np.array([str(c)[:2] for c in codes], dtype=object)
+    temperature = np.array([PREF_MEAN_TEMPERATURE.get(p, np.nan) for p in pref_codes], dtype="float64")
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        columns = [temperature if func is None else func(column) for _, func in FEATURES.values()]
+    matrix = np.column_stack(columns).astype("float64")
+    matrix[~np.isfinite(matrix)] = np.nan
+
+    population = column("人口総数")
+    eligible = (np.char.str_len(codes.astype(str)) == 5) & np.isfinite(population) & (population >= MIN_POPULATION)
+    return matrix, eligible
+
+
+def zscore(matrix: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """
+    mask の行の中央値と MAD（正規分布の標準偏差相当に換算）で列ごとに標準化し、±Z_CLIP で打ち切る。
+    欠損は 0（中央値扱い）にする。
+    """
+    sample = matrix[mask]
+    with np.errstate(invalid="ignore"):
+        center = np.nanmedian(sample, axis=0)
+        scale = 1.4826 * np.nanmedian(np.abs(sample - center), axis=0)
+    scale[~np.isfinite(scale) | (scale == 0)] = 1.0
+    z = np.clip((matrix - center) / scale, -Z_CLIP, Z_CLIP)
+    return np.nan_to_num(z, nan=0.0)
+
+
+_PREPARED = {}
+
+
+def prepare(store: FeatureStore) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """特徴量行列・対象マスク・z スコアを FeatureStore ごとに1回だけ計算する"""
+    prepared = _PREPARED.get(store.key)
+    if prepared is None or prepared[0] is not store:
+        matrix, eligible = compute_features(store)
+        prepared = (store, matrix, eligible, zscore(matrix, eligible))
+        _PREPARED.clear()
+        _PREPARED[store.key] = prepared
+    return prepared[1:]
+
+
+def place_mask(store: FeatureStore, place: PlaceMatch) -> np.ndarray:
+    """自由記述で挙がった都道府県・市区町村の行だけ True"""
+    codes = store.frame[CODE_COLUMN].astype(str).to_numpy()
+    pref_codes = np.array([int(c[:2]) if c[:2].isdigit() else -1 for c in codes])
+    muni_codes = np.array([int(c) if c.isdigit() else -1 for c in codes])
+    return np.isin(pref_codes, sorted(place.prefs)) | np.isin(muni_codes, sorted(place.munis))
+
+
+def rank_municipalities(
+    store: FeatureStore, answers: dict, top_n: int = 5, place: PlaceMatch | None = None
+) -> pd.DataFrame:
+    """
+    全市区町村を1回の行列演算で点数付けし、上位 top_n 件を返す。
+    place（自由記述の地名）があれば、その都道府県・市区町村の中だけで順位を付ける（該当が無ければ0件）。
+    列は 市区町村コード / 都道府県 / 市区町村 / score と各特徴量（単位そのまま）。
+    """
+    names = list(FEATURES)
+    matrix, eligible, z = prepare(store)
+    if place:
+        eligible = eligible & place_mask(store, place)
+
+    weights = answer_weights(answers)
+    w = np.array([weights.get(n, 0.0) for n in names], dtype="float64")
+    score = z @ w
+    if answers.get("style") == "バランス":
+        score -= BALANCE_PENALTY * np.abs(z[:, names.index("都市規模")])
+    score[~eligible] = -np.inf
+
+    top_n = min(top_n, int(eligible.sum()))
+    top = np.argpartition(-score, top_n - 1)[:top_n] if top_n else np.array([], dtype=int)
+    top = top[np.argsort(-score[top], kind="stable")]
+
+    frame = store.frame
+    ranked = pd.DataFrame({
+        CODE_COLUMN: frame[CODE_COLUMN].to_numpy()[top],
+        PREF_COLUMN: frame[PREF_COLUMN].astype(object).to_numpy()[top],
+        NAME_COLUMN: frame[NAME_COLUMN].to_numpy()[top],
+        "score": np.round(score[top], 3),
+    })
+    for i, name in enumerate(names):
+        ranked[name] = matrix[top, i]
+    ranked.attrs["weights"] = {n: weights[n] for n in names if weights.get(n)}
+    return ranked
+
+
+def shortlist_documents(store: FeatureStore, ranked: pd.DataFrame) -> list[Document]:
+    """上位の市区町村を1地域1ドキュメントにする（元の指標と出典ファイル名つき）"""
+    weighted = ranked.attrs.get("weights", {})
+    docs = []
+    for rank, row in enumerate(ranked.to_dict("records"), start=1):
+        record = store.get(row[CODE_COLUMN]) or {}
+        name = row[NAME_COLUMN] if row[PREF_COLUMN] == row[NAME_COLUMN] else f"{row[PREF_COLUMN]}{row[NAME_COLUMN]}"
+
+        lines = [f"候補{rank}: {name}（市区町村コード {row[CODE_COLUMN]}、スコア {row['score']}）"]
+        for feature, (label, _) in FEATURES.items():
+            if feature in weighted and pd.notna(row[feature]):
+                lines.append(f"- {feature}（{label}）: {row[feature]:.3g}")
+
+        by_source = {}
+        for col, info in store.columns.items():
+            value = record.get(col)
+            if value is None or pd.isna(value):
+                continue
+            unit = info.get("unit", "").split(":")[0]
+            by_source.setdefault(info.get("source", ""), []).append(f"{col} {value}{unit}")
+        for source, items in by_source.items():
+            lines.append(f"[{source}] " + "、".join(items))
+
+        docs.append(
+            Document(
+                page_content="\n".join(lines),
+                metadata={"source": "市区町村スコア", "code": str(row[CODE_COLUMN]), "rank": rank},
+            )
+        )
+    return docs
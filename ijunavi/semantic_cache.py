@@ -0,0 +1,220 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+import numpy as np
+
+from .places import PlaceMatch
+from .response_cache import canonical_answers, normalize_else
+
+# 意味の近い質問への提案キャッシュ。
+# 自由記述の言い換え（「子育てしやすい」「子どもを育てやすい環境」）でも、選択肢の回答と自由記述の地名（scope）が同じで
+# 自由記述の埋め込みの余弦類似度が threshold 以上なら、前回の提案を返す。
+# プロンプト全体は大部分が固定の文面なので、埋め込むのは自由記述だけにする（別の地域の提案と取り違えない）。
+# エントリには回答の根拠にしたCSVを記録し、そのCSVを再インデックスしたときだけ消す。
+
+# 類似度の分布（metrics）の区切り
+SIMILARITY_BINS = (0.80, 0.85, 0.90, 0.93, 0.95, 0.97, 0.99)
+
+
+def semantic_scope(answers: dict, settings: dict | None = None, model: str = "", place: PlaceMatch | None = None) -> str:
+    """
+    自由記述以外の回答（年代・暮らし・気候・家族構成）、自由記述の地名（都道府県・市区町村コード）、
+    設定・埋め込みモデルのハッシュ。比べるのは scope が同じエントリだけ。
+    """
+    answers = canonical_answers(answers)
+    answers.pop("else", None)
+    places = [sorted(place.prefs), sorted(place.munis)] if place else []
+    payload = {"answers": answers, "places": places, "settings": settings or {}, "model": model}
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()
+
+
+def semantic_text(answers: dict) -> str:
+    """埋め込んで比べる文。正規化した自由記述（条件なしなら空文字で、意味キャッシュは使わない）"""
+    return normalize_else(answers.get("else"))
+
+
+class SemanticCache:
+    """
+    SQLite に (scope, 自由記述, 正規化した埋め込み, 提案, 根拠のCSV, 生成にかかった秒数) を保存し、
+    scope ごとの埋め込み行列をメモリに持って最近傍を1回の行列積で探す。
+    ほかのプロセスが書き込んだら（PRAGMA data_version が変わったら）行列を読み直す。
+    """
+
+    def __init__(self, path, threshold: float = 0.95, ttl: float = 7 * 24 * 3600, max_entries: int = 1000):
+        self.path = Path(path)
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self.evictions = 0
+        self.invalidations = 0
+        self.similarities = deque(maxlen=1000)  # 直近の検索での最大類似度
+
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                scope TEXT NOT NULL,
+                prompt TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                value TEXT NOT NULL,
+                sources TEXT NOT NULL,
+                latency REAL NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries(last_used)")
+        self._conn.commit()
+
+        self._index = {}  # scope -> (ids, 行列, 生成秒数)
+        self._version = None
+
+    def lookup(self, scope: str, vector) -> dict | None:
+        """最も近いエントリの類似度が threshold 以上なら、その提案を返す"""
+        query = np.asarray(vector, dtype=np.float32)
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+        with self._lock:
+            self._refresh_locked()
+            entry = self._index.get(scope)
+            if entry is None:
+                self.misses += 1
+                return None
+            ids, matrix, latencies = entry
+            sims = matrix @ query
+            best = int(np.argmax(sims))
+            similarity = float(sims[best])
+            self.similarities.append(similarity)
+            if similarity < self.threshold:
+                self.misses += 1
+                return None
+
+            row = self._conn.execute("SELECT value FROM entries WHERE id = ?", (int(ids[best]),)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE entries SET last_used = ? WHERE id = ?", (time.time(), int(ids[best])))
+            self._conn.commit()
+            self.hits += 1
+            self.saved_seconds += float(latencies[best])
+        print(f"RAG: 意味キャッシュにヒットしました（類似度 {similarity:.3f}）")
+        return json.loads(row[0])
+
+    def put(self, scope: str, prompt: str, vector, value: dict, sources, latency: float) -> None:
+        vector = np.asarray(vector, dtype=np.float32)
+        vector /= max(float(np.linalg.norm(vector)), 1e-12)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                """
+                INSERT INTO entries (scope, prompt, vector, value, sources, latency, created, last_used)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    scope,
+                    prompt,
+                    vector.tobytes(),
+                    json.dumps(value, ensure_ascii=False),
+                    json.dumps(sorted(set(sources)), ensure_ascii=False),
+                    latency,
+                    now,
+                    now,
+                ),
+            )
+            self._conn.execute("DELETE FROM entries WHERE created < ?", (now - self.ttl,))
+            self._evict_locked()
+            self._conn.commit()
+            self._version = None
+
+    def invalidate_sources(self, sources=None) -> int:
+        """根拠に sources のCSVを含むエントリを削除する（None なら全部）"""
+        with self._lock:
+            if sources is None:
+                deleted = self._conn.execute("DELETE FROM entries").rowcount
+            else:
+                sources = set(sources)
+                ids = [
+                    (entry_id,)
+                    for entry_id, used in self._conn.execute("SELECT id, sources FROM entries")
+                    if sources & set(json.loads(used))
+                ]
+                self._conn.executemany("DELETE FROM entries WHERE id = ?", ids)
+                deleted = len(ids)
+            self._conn.commit()
+            self.invalidations += max(deleted, 0)
+            self._version = None
+        return deleted
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            entries = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            sims = np.asarray(self.similarities, dtype=np.float64)
+            counts = np.bincount(np.searchsorted(SIMILARITY_BINS, sims, side="right"), minlength=len(SIMILARITY_BINS) + 1)
+            labels = [f"<{SIMILARITY_BINS[0]:.2f}"] + [
+                f"{lo:.2f}-{hi:.2f}" for lo, hi in zip(SIMILARITY_BINS, SIMILARITY_BINS[1:])
+            ] + [f">={SIMILARITY_BINS[-1]:.2f}"]
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "threshold": self.threshold,
+                "saved_seconds": round(self.saved_seconds, 3),
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": entries,
+                "max_entries": self.max_entries,
+                "similarity": {
+                    "count": int(len(sims)),
+                    "p50": round(float(np.percentile(sims, 50)), 4) if len(sims) else None,
+                    "p90": round(float(np.percentile(sims, 90)), 4) if len(sims) else None,
+                    "histogram": dict(zip(labels, counts.tolist())),
+                },
+            }
+
+    def _refresh_locked(self) -> None:
+        """エントリが変わっていたら scope ごとの埋め込み行列を作り直す"""
+        version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        if version == self._version:
+            return
+        rows = self._conn.execute(
+            "SELECT id, scope, vector, latency FROM entries WHERE created >= ? ORDER BY id",
+            (time.time() - self.ttl,),
+        ).fetchall()
+        grouped = {}
+        for entry_id, scope, blob, latency in rows:
+            grouped.setdefault(scope, []).append((entry_id, np.frombuffer(blob, dtype=np.float32), latency))
+        self._index = {}
+        # scope には埋め込みモデル（次元数）も含むので、scope 内のベクトルの長さは揃っている
+        for scope, items in grouped.items():
+            self._index[scope] = (
+                np.array([i for i, _, _ in items], dtype=np.int64),
+                np.vstack([v for _, v, _ in items]),
+                np.array([lat for _, _, lat in items], dtype=np.float64),
+            )
+        self._version = version
+
+    def _evict_locked(self) -> None:
+        count = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        overflow = count - self.max_entries
+        if overflow <= 0:
+            return
+        self._conn.execute(
+            "DELETE FROM entries WHERE id IN (SELECT id FROM entries ORDER BY last_used ASC LIMIT ?)",
+            (overflow,),
+        )
+        self.evictions += overflow
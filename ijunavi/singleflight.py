@@ -0,0 +1,130 @@
+import asyncio
+import hashlib
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows ではプロセス間のまとめは行わない
+    fcntl = None
+
+# 同じキーの処理が同時に走っているとき、後から来た呼び出しは先に始めた呼び出し（leader）の結果を待って共有する。
+# lock_dir を指定すると、leader はキーごとのロックファイル（flock）で別プロセス（別ワーカー）の leader とも順番になり、
+# ロックを取れた時点で recheck（共有キャッシュの確認）を呼ぶ。別プロセスが作った結果があれば fn は呼ばない。
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self, lock_dir: Path | None = None):
+        self.lock_dir = Path(lock_dir) if lock_dir is not None and fcntl is not None else None
+
+        self.leaders = 0
+        self.shared = 0
+        self.rechecked = 0
+
+        self._lock = threading.Lock()
+        self._calls = {}  # key -> _Call（スレッドから呼ばれた分）
+        self._tasks = {}  # key -> asyncio.Task（イベントループから呼ばれた分）
+
+    def do(self, key: str, fn, recheck=None):
+        """fn() の結果を返す。同じ key を実行中のスレッドがあれば、その結果を待つ（例外も共有する）"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            with self._file_lock(key):
+                call.value = self._recheck(recheck)
+                if call.value is None:
+                    call.value = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+        return call.value
+
+    async def ado(self, key: str, afn, recheck=None):
+        """do の async 版。afn は引数なしで awaitable を返す関数。同じイベントループ内の呼び出しをまとめる"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            task = self._tasks.get(key)
+            if task is not None and task.get_loop() is loop and not task.done():
+                self.shared += 1
+            else:
+                task = loop.create_task(self._alead(key, afn, recheck))
+                self._tasks[key] = task
+                self.leaders += 1
+        # 待っている側がキャンセルされても leader の処理は止めない
+        return await asyncio.shield(task)
+
+    async def _alead(self, key, afn, recheck):
+        try:
+            if self.lock_dir is None:
+                value = self._recheck(recheck)
+                return value if value is not None else await afn()
+
+            # ロック待ちでイベントループを止めないよう、ロックの取得はスレッドで行う
+            lock = self._file_lock(key)
+            await asyncio.to_thread(lock.__enter__)
+            try:
+                value = await asyncio.to_thread(self._recheck, recheck)
+                return value if value is not None else await afn()
+            finally:
+                lock.__exit__(None, None, None)
+        finally:
+            with self._lock:
+                if self._tasks.get(key) is asyncio.current_task():
+                    del self._tasks[key]
+
+    def _recheck(self, recheck):
+        if recheck is None or self.lock_dir is None:
+            return None
+        value = recheck()
+        if value is not None:
+            self.rechecked += 1
+        return value
+
+    @contextmanager
+    def _file_lock(self, key: str):
+        if self.lock_dir is None:
+            yield
+            return
+        self.lock_dir.mkdir(parents=True, exist_ok=True)
+        name = hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+        with open(self.lock_dir / f"{name}.lock", "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "leaders": self.leaders,
+                "shared": self.shared,
+                "rechecked": self.rechecked,
+                "in_flight": len(self._calls) + len(self._tasks),
+                "cross_process": self.lock_dir is not None,
+            }
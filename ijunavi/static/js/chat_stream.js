@@ -0,0 +1,106 @@
+(function () {
+  // 最後の質問の送信に stream=1 を付ける（JS が無ければ従来どおりサーバーで生成してから表示）
+  const finalForm = document.querySelector("form[data-stream-final]");
+  if (finalForm) {
+    finalForm.addEventListener("submit", () => {
+      if (finalForm.querySelector('input[name="stream"]')) return;
+      const flag = document.createElement("input");
+      flag.type = "hidden";
+      flag.name = "stream";
+      flag.value = "1";
+      finalForm.appendChild(flag);
+    });
+  }
+
+  // 提案ジョブの完了を status_url のポーリングで待ち、終わったら結果画面を表示し直す（間隔は 1 秒から 5 秒まで延ばす）
+  function pollJob(statusUrl, headline) {
+    let delay = 1000;
+    const poll = async () => {
+      try {
+        const res = await fetch(statusUrl, { headers: { "X-Requested-With": "XMLHttpRequest" } });
+        const data = await res.json();
+        if (data.redirect_url) {
+          window.location.replace(data.redirect_url);
+          return;
+        }
+      } catch (err) {
+        if (headline) headline.textContent = "通信エラーのため再試行しています…";
+      }
+      delay = Math.min(delay * 1.5, 5000);
+      window.setTimeout(poll, delay);
+    };
+    window.setTimeout(poll, delay);
+  }
+
+  // 結果画面（JS なしで送った回答）：登録済みのジョブを待つ
+  const jobBox = document.getElementById("chat-job");
+  if (jobBox) {
+    pollJob(jobBox.dataset.statusUrl, document.getElementById("chat-job-headline"));
+    return;
+  }
+
+  // 結果画面：提案を Server-Sent Events で受け取りながら表示する
+  const box = document.getElementById("chat-stream");
+  if (!box) return;
+
+  const headline = document.getElementById("chat-stream-headline");
+  const text = document.getElementById("chat-stream-text");
+  const doneUrl = box.dataset.doneUrl || window.location.href;
+
+  if (!window.EventSource) {
+    // SSE が使えない場合は提案ジョブを登録してポーリングする
+    const csrf = box.querySelector('input[name="csrfmiddlewaretoken"]');
+    fetch(box.dataset.jobsUrl, {
+      method: "POST",
+      headers: {
+        "X-CSRFToken": csrf ? csrf.value : "",
+        "X-Requested-With": "XMLHttpRequest",
+      },
+    })
+      .then((res) => res.json())
+      .then((data) => {
+        if (!data.status_url) throw new Error(data.error || "");
+        pollJob(data.status_url, headline);
+      })
+      .catch(() => {
+        if (headline) headline.textContent = "【エラー】提案の取得に失敗しました";
+      });
+    return;
+  }
+
+  const source = new EventSource(box.dataset.streamUrl);
+  let finished = false;
+
+  source.addEventListener("token", (e) => {
+    const data = JSON.parse(e.data);
+    text.textContent += data.text || "";
+  });
+
+  source.addEventListener("result", (e) => {
+    finished = true;
+    source.close();
+    const result = JSON.parse(e.data);
+    if (headline && result.headline) headline.textContent = result.headline;
+    // 結果はセッションに保存済みなので、地図などを含む通常の結果画面を表示し直す
+    window.location.replace(doneUrl);
+  });
+
+  source.addEventListener("busy", (e) => {
+    finished = true;
+    source.close();
+    const data = JSON.parse(e.data);
+    if (headline) headline.textContent = data.message || "ただいま混み合っています";
+    // 回答は保存されているので、少し待ってから繋ぎ直す
+    window.setTimeout(() => window.location.replace(doneUrl), (data.retry_after || 5) * 1000);
+  });
+
+  source.addEventListener("error", () => {
+    if (finished) return;
+    source.close();
+    if (headline) headline.textContent = "【エラー】提案の取得に失敗しました";
+    const retry = document.createElement("p");
+    retry.className = "chat-link";
+    retry.innerHTML = `<a href="${doneUrl}">もう一度表示する</a>`;
+    box.appendChild(retry);
+  });
+})();
@@ -1,3 +1,1401 @@
-from django.test import TestCase
+import asyncio
+import os
+import tempfile
+import threading
+import time
+import warnings
+from datetime import timedelta
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+
+import httpx
+import numpy as np
+import openai
+import pandas as pd
+from asgiref.sync import async_to_sync, sync_to_async
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase
+from langchain_core.documents import Document
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.prompts import ChatPromptTemplate, PromptTemplate
+
+from . import embedding_pipeline, ingest, jobs, rag_service, timing, views
+from .admission import AdmissionController, Busy
+from .embedding_cache import CachedEmbeddings
+from .embedding_pipeline import (
+    BackgroundBatcher,
+    PrecomputedEmbeddings,
+    RateLimitedEmbeddings,
+    RateLimiter,
+    embed_batches_concurrently,
+    write_batch,
+)
+from .estat import load_estat_table
+from .feature_store import FeatureStore, joined_sources, read_feature_table, save_feature_table
+from .ingest import (
+    iter_chunk_ids,
+    iter_csv_grouped_docs,
+    pack_row_ranges,
+    parse_source_file,
+    read_spill,
+    serialize_rows,
+    tenpo_long_df_to_docs,
+    tenpo_long_df_to_docs_iterrows,
+)
+from .lexical_index import LexicalIndex
+from .middleware import ServerTimingMiddleware
+from .models import RecommendationJob
+from .numpy_store import NumpyVectorStore, quantize_int8
+from .places import PlaceMatch, PlaceMatcher, chroma_where
+from .precomputed import PrecomputedStore, answer_grid, precompute
+from .response_cache import ResponseCache, cache_key, normalize_else
+from .semantic_cache import SemanticCache, semantic_scope, semantic_text
+from .retrieval import MmrRetriever, reciprocal_rank_fusion
+from .scoring import place_mask, rank_municipalities
+from .singleflight import SingleFlight
+
+
+def _fp(**files):
+    """ファイル名 → ハッシュ から compute_data_fingerprint と同じ形のマニフェストを作る"""
+    return {"files": [{"name": name, "hash": h} for name, h in sorted(files.items())]}
+
+
+def _municipalities():
+    """テスト用の小さな市区町村テーブル（都道府県の行と市区町村の行）"""
+    rows = [
+        ("01", "北海道", "北海道", 5_000_000),
+        ("01100", "北海道", "札幌市", 1_970_000),
+        ("01202", "北海道", "函館市", 240_000),
+        ("13", "東京都", "東京都", 14_000_000),
+        ("13206", "東京都", "府中市", 260_000),
+        ("34207", "広島県", "府中市", 36_000),
+        ("47", "沖縄県", "沖縄県", 1_460_000),
+        ("47201", "沖縄県", "那覇市", 310_000),
+        ("47211", "沖縄県", "沖縄市", 140_000),
+        ("47348", "沖縄県", "国頭郡恩納村", 11_000),
+        ("47361", "沖縄県", "島尻郡北大東村", 550),
+    ]
+    frame = pd.DataFrame(rows, columns=["市区町村コード", "都道府県", "市区町村", "人口総数"])
+    frame["年少人口"] = frame["人口総数"] * 0.12
+    frame.attrs["columns"] = {c: {"source": "2024人口.csv", "unit": "人"} for c in ("人口総数", "年少人口")}
+    return FeatureStore(frame, key="test")
+
+
+class DiffFingerprintsTests(SimpleTestCase):
+    def test_reports_changed_added_and_removed_files(self):
+        saved = _fp(**{"a.csv": "1", "b.csv": "2", "c.csv": "3"})
+        current = _fp(**{"a.csv": "1", "b.csv": "20", "d.csv": "4"})
+        changed, removed = rag_service.diff_fingerprints(saved, current)
+        self.assertEqual(changed, {"b.csv", "d.csv"})
+        self.assertEqual(removed, {"c.csv"})
+
+    def test_unchanged_manifest_has_no_work(self):
+        fp = _fp(**{"a.csv": "1"})
+        self.assertEqual(rag_service.diff_fingerprints(fp, fp), (set(), set()))
+
+    def test_manifest_without_file_hashes_reindexes_everything(self):
+        saved = {"files": [{"name": "a.csv", "size": 1}]}
+        current = _fp(**{"a.csv": "1", "b.csv": "2"})
+        self.assertEqual(rag_service.diff_fingerprints(saved, current), ({"a.csv", "b.csv"}, set()))
+        self.assertEqual(rag_service.diff_fingerprints(None, current), ({"a.csv", "b.csv"}, set()))
+
+    def test_has_file_manifest(self):
+        self.assertTrue(rag_service.has_file_manifest(_fp(**{"a.csv": "1"})))
+        self.assertFalse(rag_service.has_file_manifest({"files": [{"name": "a.csv"}]}))
+        self.assertFalse(rag_service.has_file_manifest({"files": []}))
+        self.assertFalse(rag_service.has_file_manifest(None))
+
+
+class _FakeEmbeddings:
+    """呼ばれたテキストを記録する埋め込み（float32 で表せない値を返す）"""
+
+    def __init__(self):
+        self.calls = []
+
+    def embed_documents(self, texts):
+        self.calls.append(list(texts))
+        return [[len(t) + 0.1, 1 / 3] for t in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class CachedEmbeddingsTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.inner = _FakeEmbeddings()
+        self.cache = CachedEmbeddings(self.inner, "model", Path(tmp.name) / "emb.sqlite3", max_entries=2)
+        self.addCleanup(self.cache._conn.close)
+
+    def test_counts_hits_and_misses_and_deduplicates(self):
+        first = self.cache.embed_documents(["那覇", "那覇", "札幌市"])
+        second = self.cache.embed_documents(["那覇"])
+
+        self.assertEqual(self.inner.calls, [["那覇", "札幌市"]])
+        self.assertEqual(first[0], first[1])
+        self.assertEqual(second[0], first[0])
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 3))
+
+    def test_miss_and_hit_return_the_same_float32_vector(self):
+        miss = self.cache.embed_query("沖縄の海")
+        hit = self.cache.embed_query("沖縄の海")
+        self.assertEqual(miss, hit)
+        self.assertEqual(miss[1], float(np.float32(1 / 3)))
+
+    def test_evicts_least_recently_used(self):
+        self.cache.embed_documents(["a"])
+        time.sleep(0.01)
+        self.cache.embed_documents(["b"])
+        time.sleep(0.01)
+        self.cache.embed_documents(["a"])  # a を使い直したので b が一番古い
+        time.sleep(0.01)
+        self.cache.embed_documents(["c"])
+
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+        self.inner.calls.clear()
+        self.cache.embed_documents(["a", "b", "c"])
+        self.assertEqual(self.inner.calls, [["b"]])
+
+
+def _api_error(cls, status, retry_after=None):
+    headers = {"retry-after": retry_after} if retry_after else {}
+    response = httpx.Response(status, headers=headers, request=httpx.Request("POST", "https://example.invalid"))
+    return cls("error", response=response, body=None)
+
+
+class RateLimitedEmbeddingsTests(SimpleTestCase):
+    def setUp(self):
+        # time.sleep だけ記録して待たない
+        self.fake_time = mock.Mock(wraps=time)
+        self.fake_time.sleep = mock.Mock()
+        patcher = mock.patch.object(embedding_pipeline, "time", self.fake_time)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _embeddings(self, errors):
+        inner = _FakeEmbeddings()
+        original = inner.embed_documents
+
+        def flaky(texts):
+            if errors:
+                raise errors.pop(0)
+            return original(texts)
+
+        inner.embed_documents = flaky
+        limiter = RateLimiter(rpm=10_000, tpm=1_000_000)
+        return inner, RateLimitedEmbeddings(inner, limiter, request_size=2, base_delay=0.01)
+
+    def test_retries_429_and_5xx_honoring_retry_after(self):
+        errors = [_api_error(openai.RateLimitError, 429, "3"), _api_error(openai.InternalServerError, 503)]
+        inner, embeddings = self._embeddings(errors)
+
+        vectors = embeddings.embed_documents(["a", "bb", "ccc"])
+
+        self.assertEqual(len(vectors), 3)
+        self.assertEqual(inner.calls, [["a", "bb"], ["ccc"]])
+        delays = [c.args[0] for c in self.fake_time.sleep.call_args_list]
+        self.assertEqual(len(delays), 2)
+        self.assertGreaterEqual(delays[0], 3.0)
+        self.assertLess(delays[1], 1.0)
+
+    def test_client_errors_are_not_retried(self):
+        _, embeddings = self._embeddings([_api_error(openai.BadRequestError, 400)])
+        with self.assertRaises(openai.BadRequestError):
+            embeddings.embed_documents(["a"])
+        self.fake_time.sleep.assert_not_called()
+
+    def test_gives_up_after_max_retries(self):
+        errors = [_api_error(openai.InternalServerError, 500) for _ in range(10)]
+        _, embeddings = self._embeddings(errors)
+        embeddings.max_retries = 2
+        with self.assertRaises(openai.InternalServerError):
+            embeddings.embed_documents(["a"])
+        self.assertEqual(self.fake_time.sleep.call_count, 2)
+
+
+class RateLimiterTests(SimpleTestCase):
+    def test_waits_when_the_token_budget_is_spent(self):
+        limiter = RateLimiter(rpm=10_000, tpm=6000)
+        limiter.acquire(6000)
+        start = time.monotonic()
+        limiter.acquire(30)  # 30トークン分の回復に 0.3 秒
+        self.assertGreaterEqual(time.monotonic() - start, 0.25)
+
+
+class EmbedBatchesConcurrentlyTests(SimpleTestCase):
+    def test_vectors_match_their_batch_and_in_flight_is_bounded(self):
+        pulled = []
+
+        def batches():
+            for i in range(20):
+                pulled.append(i)
+                yield [Document(page_content="x" * (i + 1))]
+
+        results = []
+        for batch, vectors in embed_batches_concurrently(batches(), _FakeEmbeddings(), max_workers=2):
+            if not results:
+                self.assertLessEqual(len(pulled), 4)
+            results.append((batch, vectors))
+
+        self.assertEqual(len(results), 20)
+        for batch, vectors in results:
+            self.assertEqual(vectors[0][0], len(batch[0].page_content) + 0.1)
+
+
+class WriteBatchTests(SimpleTestCase):
+    def test_chroma_writes_precomputed_vectors_through_the_public_api(self):
+        from langchain_chroma import Chroma
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        inner = _FakeEmbeddings()
+        store = Chroma(persist_directory=tmp.name, embedding_function=PrecomputedEmbeddings(inner))
+        batch = [Document(page_content="那覇市", metadata={"source": "a.csv", "chunk_id": "a.csv:1-1:0"})]
+
+        write_batch(store, batch, [[1.0, 0.0]])
+        write_batch(store, batch, [[0.0, 1.0]])  # 同じ chunk_id は上書き
+
+        self.assertEqual(inner.calls, [])
+        stored = store.get(ids=["a.csv:1-1:0"], include=["embeddings"])
+        self.assertEqual(len(stored["ids"]), 1)
+        self.assertEqual(list(stored["embeddings"][0]), [0.0, 1.0])
+        self.assertEqual(store.similarity_search_by_vector([0.0, 1.0], k=1)[0].page_content, "那覇市")
+
+    def test_chroma_without_precomputed_embeddings_is_rejected(self):
+        from langchain_chroma import Chroma
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        store = Chroma(persist_directory=tmp.name, embedding_function=_FakeEmbeddings())
+        with self.assertRaises(TypeError):
+            write_batch(store, [Document(page_content="a")], [[1.0, 0.0]])
+
+
+class CheckpointTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        db_dir = Path(tmp.name) / "db"
+        for name, value in (("DB_DIR", db_dir), ("CHECKPOINT_PATH", db_dir / "_checkpoint.json")):
+            patcher = mock.patch.object(rag_service, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_round_trip_and_clear(self):
+        self.assertIsNone(rag_service.load_checkpoint())
+        checkpoint = {"target": "abc", "purged": True, "batches": ["a.csv:1-2:0..a.csv:3-4:0"]}
+        rag_service.save_checkpoint(checkpoint)
+        self.assertEqual(rag_service.load_checkpoint(), checkpoint)
+        rag_service.clear_checkpoint()
+        self.assertIsNone(rag_service.load_checkpoint())
+        rag_service.clear_checkpoint()  # 無くてもエラーにしない
+
+    def test_broken_checkpoint_is_ignored(self):
+        rag_service.CHECKPOINT_PATH.parent.mkdir(parents=True)
+        rag_service.CHECKPOINT_PATH.write_text("{", encoding="utf-8")
+        self.assertIsNone(rag_service.load_checkpoint())
+
+
+class StreamingIngestTests(SimpleTestCase):
+    def test_csv_documents_are_yielded_before_the_whole_file_is_read(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "big.csv"
+            body = "a,b\n" + "".join(f"{i},x\n" for i in range(100_000))
+            path.write_bytes(body.encode("utf-8") + b"1,\xff\n")  # 末尾だけ UTF-8 として読めない
+
+            docs = iter_csv_grouped_docs(path, group_rows=100, row_format="table")
+            first = next(docs)
+            self.assertIn("行: 1-100\n", first.page_content)
+            with self.assertRaises(UnicodeDecodeError):
+                list(docs)
+
+    def test_feature_table_is_sliced_at_prefecture_boundaries(self):
+        store = _municipalities()
+        slices = list(store.iter_source_frames("2024人口.csv", rows=2))
+
+        prefs = [sorted(set(df["市区町村コード"].str[:2])) for _, df in slices]
+        # 区切りは rows 行以上で、都道府県の途中では切らない
+        self.assertEqual(prefs, [["01"], ["13"], ["34", "47"]])
+        self.assertEqual([offset for offset, _ in slices], [0, 3, 5])
+        joined = pd.concat([df for _, df in slices], ignore_index=True)
+        pd.testing.assert_frame_equal(joined, store.source_frame("2024人口.csv"))
+
+    def test_municipality_documents_cite_feature_table_rows(self):
+        store = _municipalities()
+        with mock.patch.object(ingest, "get_feature_store", return_value=store):
+            docs = list(iter_chunk_ids(ingest.iter_source_documents(Path("data/2024人口.csv"))))
+
+        md = docs[0].metadata
+        self.assertNotIn("row_from", md)
+        self.assertEqual((md["table_row_from"], md["table_row_to"]), (1, 3))
+        self.assertIn("\n市区町村テーブルの行: 1-3\n", docs[0].page_content)
+        self.assertEqual(md["chunk_id"], "2024人口.csv:1-3:0")
+
+    def test_background_batcher_reads_ahead_only_up_to_the_queue_size(self):
+        pulled = []
+
+        def items():
+            for i in range(50):
+                pulled.append(i)
+                yield i
+
+        batcher = BackgroundBatcher(items(), batch_size=2, maxsize=2)
+        time.sleep(0.2)
+        # キューの2バッチと、入れる順番を待っている1バッチまで
+        self.assertLessEqual(len(pulled), 6)
+        self.assertEqual([i for batch in batcher for i in batch], list(range(50)))
+        self.assertEqual((batcher.produced, batcher.finished), (50, True))
+
+    def test_background_batcher_raises_producer_errors(self):
+        def items():
+            yield 1
+            raise ValueError("壊れたCSV")
+
+        with self.assertRaises(ValueError):
+            list(BackgroundBatcher(items(), batch_size=10))
+
+
+class ParseSourceFileTests(SimpleTestCase):
+    def test_chunks_are_spilled_and_read_back_in_order(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            csv = Path(tmp) / "sample.csv"
+            rows = "\n".join(f"{i},地域{i}" for i in range(2000))
+            csv.write_text("id,name\n" + rows + "\n", encoding="cp932")
+            spill = Path(tmp) / "sample.jsonl"
+
+            result = parse_source_file(str(csv), str(spill))
+            chunks = list(read_spill(spill))
+
+        self.assertEqual(result["encoding"], "cp932")
+        self.assertEqual(result["rows"], 2000)
+        self.assertEqual(result["chunks"], len(chunks))
+        self.assertNotIn("docs", result)
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(chunks[0].metadata["chunk_id"].startswith("sample.csv:1-"))
+        self.assertEqual(len({c.metadata["chunk_id"] for c in chunks}), len(chunks))
+        self.assertEqual(chunks[-1].metadata["row_to"], 2000)
+        self.assertIn("地域1999", chunks[-1].page_content)
+
+
+    def test_rows_are_counted_from_the_frame_not_the_last_chunk(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            csv = Path(tmp) / "tenpo2511.csv"
+            lines = ["スーパー店舗数", "単位: 店", "年,時期,集計日,合計,北海道,沖縄県"]
+            lines += [f"2025,{m}月,2025-{m:02d}-01,300,200,100" for m in range(1, 4)]
+            csv.write_text("\n".join(lines) + "\n", encoding="utf-8")
+            spill = Path(tmp) / "tenpo.jsonl"
+
+            result = parse_source_file(str(csv), str(spill))
+            chunks = list(read_spill(spill))
+
+        # 3か月 × 2都道府県。都道府県ごとのチャンクなので最後のチャンクの row_to とは一致しない
+        self.assertEqual(result["rows"], 6)
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual(chunks[-1].metadata["row_to"], 6)
+        self.assertEqual(chunks[0].metadata["row_to"], 3)
+
+
+class TenpoDocsTests(SimpleTestCase):
+    def test_column_version_matches_iterrows(self):
+        long_df = pd.DataFrame({
+            "year": ["2025", "2025", "2025", "2025", "2025"],
+            "timing": ["1月", "1月", "2月", "2月", "3月"],
+            "date": ["2025-01-31", "2025-01-31", "2025-02-28", "2025-02-28", "2025-03-31"],
+            "prefecture": ["北海道", "沖縄県", "北海道", "沖縄県", "北海道"],
+            "store_count": [200.0, 100.0, np.nan, 101.0, 202.0],
+        })
+        for group_rows in (2, 1200):
+            fast = tenpo_long_df_to_docs(long_df, "tenpo2511.csv", group_rows=group_rows)
+            slow = tenpo_long_df_to_docs_iterrows(long_df, "tenpo2511.csv", group_rows=group_rows)
+            self.assertEqual([d.page_content for d in fast], [d.page_content for d in slow])
+            self.assertEqual([d.metadata for d in fast], [d.metadata for d in slow])
+        self.assertIn("北海道の店舗数はnan。", fast[0].page_content)
+        self.assertIn("沖縄県の店舗数は100。", fast[0].page_content)
+
+
+class SerializeRowsTests(SimpleTestCase):
+    def setUp(self):
+        self.df = pd.DataFrame({
+            "市区町村コード": ["47", "47201"],
+            "都道府県": ["沖縄県", "沖縄県"],
+            "市区町村": ["沖縄県", "那覇市"],
+            "Municipalities": ["Okinawa-ken", "Naha-shi"],
+            "一般病院数": [89, 20],
+            "備考": [None, "a|b"],
+        })
+        self.df.attrs["columns"] = {"一般病院数": {"unit": "施設:number of hospitals"}}
+
+    def test_json(self):
+        header, lines = serialize_rows(self.df, "json")
+        self.assertEqual(header, "")
+        self.assertEqual(len(lines), 2)
+        self.assertIn('"市区町村":"那覇市"', lines[1])
+        self.assertIn('"備考":null', lines[0])
+
+    def test_table(self):
+        header, lines = serialize_rows(self.df, "table")
+        self.assertEqual(header, "市区町村コード|都道府県|市区町村|Municipalities|一般病院数|備考")
+        # 欠損は空欄、区切り文字は「/」に置き換える
+        self.assertEqual(lines, ["47|沖縄県|沖縄県|Okinawa-ken|89|", "47201|沖縄県|那覇市|Naha-shi|20|a/b"])
+
+    def test_sentence(self):
+        header, lines = serialize_rows(self.df, "sentence")
+        self.assertEqual(header, "")
+        self.assertEqual(lines, [
+            "沖縄県（47）: 一般病院数 89施設。",
+            "沖縄県那覇市（47201）: 一般病院数 20施設、備考 a/b。",
+        ])
+
+    def test_unknown_format_is_an_error(self):
+        with self.assertRaises(ValueError):
+            serialize_rows(self.df, "csv")
+
+
+class PackRowRangesTests(SimpleTestCase):
+    def test_splits_by_row_count(self):
+        self.assertEqual(pack_row_ranges([1] * 5, None, group_rows=2), [(0, 2), (2, 4), (4, 5)])
+
+    def test_respects_token_budget_including_newlines_and_header(self):
+        # 見出し 4 + 各行 (3 + 改行1) → 予算 12 には2行まで
+        self.assertEqual(pack_row_ranges([3, 3, 3, 3], 12, group_rows=100, reserved=4), [(0, 2), (2, 4)])
+
+    def test_oversized_row_gets_its_own_range(self):
+        self.assertEqual(pack_row_ranges([1, 50, 1], 10, group_rows=100), [(0, 1), (1, 2), (2, 3)])
+
+    def test_breaks_when_key_changes(self):
+        self.assertEqual(pack_row_ranges([1] * 4, None, group_rows=100, keys=[1, 1, 2, 2]), [(0, 2), (2, 4)])
+
+    def test_empty(self):
+        self.assertEqual(pack_row_ranges([], 10, group_rows=10), [])
+
+
+ESTAT_SAMPLE = [
+    ",,,,,,",
+    ",,,,Ｉ　健康・医療,,",
+    ',,市区町村,Municipalities,一般病院数,"一般\n診療所数","市区\n町村\nｺｰﾄﾞ"',
+    ",,,,Number of general hospitals,Number of general clinics,",
+    ",,,,I510120,I5102,",
+    ",,,,施設:number of hospitals,施設:number of clinics,",
+    ",,,,2021,2021,",
+    "305,01000,北海道　　　,Hokkaido,471,\"3,400\",01",
+    "305,01100,札幌市　　　,Sapporo-shi,177,-,01100",
+    "305,01101,  中央区　　,  Chuo-ku,35,398,01101",
+]
+
+
+class EstatTableTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = Path(tmp.name) / "2024医療.csv"
+        self.path.write_text("\n".join(ESTAT_SAMPLE) + "\n", encoding="cp932")
+
+    def test_finds_the_header_and_normalizes_cells(self):
+        df = load_estat_table(self.path, encoding="cp932")
+
+        self.assertEqual(
+            list(df.columns),
+            ["市区町村コード", "都道府県", "市区町村", "Municipalities", "一般病院数", "一般診療所数"],
+        )
+        self.assertEqual(df["市区町村コード"].tolist(), ["01", "01100", "01101"])
+        self.assertEqual(df["市区町村"].tolist(), ["北海道", "札幌市", "中央区"])
+        self.assertEqual(df["Municipalities"].tolist(), ["Hokkaido", "Sapporo-shi", "Chuo-ku"])
+        self.assertEqual(df["都道府県"].astype(str).tolist(), ["北海道"] * 3)
+        # 桁区切りは外し、「-」は欠損
+        self.assertEqual(df["一般診療所数"].iloc[0], 3400)
+        self.assertTrue(pd.isna(df["一般診療所数"].iloc[1]))
+
+    def test_keeps_unit_code_and_year_per_column(self):
+        df = load_estat_table(self.path, encoding="cp932")
+        self.assertEqual(
+            df.attrs["columns"]["一般病院数"],
+            {"en": "Number of general hospitals", "code": "I510120", "unit": "施設:number of hospitals", "year": "2021"},
+        )
+
+    def test_missing_header_is_an_error(self):
+        self.path.write_text("a,b\n1,2\n", encoding="utf-8")
+        with self.assertRaises(ValueError):
+            load_estat_table(self.path)
+
+
+class FeatureTableTests(SimpleTestCase):
+    def test_joined_csv_changes_reindex_dependent_files(self):
+        self.assertIn("2024人口.csv", joined_sources("2024医療.csv"))
+        self.assertEqual(joined_sources("tenpo2511.csv"), [])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            data_dir = Path(tmp)
+            for name in ("2024人口.csv", "2024医療.csv", "tenpo2511.csv"):
+                (data_dir / name).write_text("a\n1\n", encoding="utf-8")
+            with mock.patch.object(rag_service, "DATA_DIR", data_dir):
+                before = rag_service.compute_data_fingerprint()
+                population = data_dir / "2024人口.csv"
+                mtime = population.stat().st_mtime + 100
+                os.utime(population, (mtime, mtime))
+                changed, removed = rag_service.diff_fingerprints(before, rag_service.compute_data_fingerprint())
+
+        self.assertEqual(changed, {"2024人口.csv", "2024医療.csv"})
+        self.assertEqual(removed, set())
+
+    def test_save_and_read_keep_column_metadata(self):
+        table = pd.DataFrame({"市区町村コード": ["01100", "47201"], "人口": [1.0, None]})
+        table.attrs["columns"] = {"人口": {"source": "2024人口.csv", "unit": "人"}}
+        table.attrs["encodings"] = {"2024人口.csv": "cp932"}
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "municipalities.arrow"
+            save_feature_table(table, path)
+            loaded = read_feature_table(path)
+
+        self.assertEqual(loaded["市区町村コード"].tolist(), ["01100", "47201"])
+        self.assertTrue(pd.isna(loaded["人口"].iloc[1]))
+        self.assertEqual(loaded.attrs["columns"], table.attrs["columns"])
+        self.assertEqual(loaded.attrs["encodings"], table.attrs["encodings"])
+
+
+class RankMunicipalitiesTests(SimpleTestCase):
+    def setUp(self):
+        self.store = _municipalities()
+        # テスト用のテーブルには医療・教育などの列が無く、全欠損の列の中央値で警告が出る
+        catcher = warnings.catch_warnings()
+        catcher.__enter__()
+        self.addCleanup(catcher.__exit__, None, None, None)
+        warnings.simplefilter("ignore", RuntimeWarning)
+        self.answers = {"age": 35, "style": "自然", "climate": "暖かい", "family": "子どものいる世帯", "else": ""}
+
+    def test_ranks_municipalities_only(self):
+        ranked = rank_municipalities(self.store, self.answers, top_n=20)
+        codes = ranked["市区町村コード"].tolist()
+        self.assertTrue(all(len(code) == 5 for code in codes))
+        # 人口の少なすぎる地域は対象外
+        self.assertNotIn("47361", codes)
+        # 暖かい地域を選ぶと沖縄が上位
+        self.assertTrue(codes[0].startswith("47"))
+
+    def test_place_restricts_candidates(self):
+        ranked = rank_municipalities(self.store, dict(self.answers, climate="涼しい"), top_n=5, place=PlaceMatch(prefs={47}))
+        self.assertEqual(set(ranked["市区町村コード"]), {"47201", "47211", "47348"})
+
+        ranked = rank_municipalities(self.store, self.answers, top_n=5, place=PlaceMatch(munis={1202}))
+        self.assertEqual(ranked["市区町村コード"].tolist(), ["01202"])
+
+    def test_place_without_eligible_rows_is_empty(self):
+        ranked = rank_municipalities(self.store, self.answers, top_n=5, place=PlaceMatch(munis={47361}))
+        self.assertTrue(ranked.empty)
+
+    def test_place_mask(self):
+        mask = place_mask(self.store, PlaceMatch(prefs={1}, munis={47201}))
+        selected = self.store.frame["市区町村コード"][mask].tolist()
+        self.assertEqual(selected, ["01", "01100", "01202", "47201"])
+
+
+class LexicalIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.index = LexicalIndex.build(
+            ["naha", "sapporo", "okinawa-shops"],
+            ["沖縄県那覇市 医師数 850人", "北海道札幌市 医師数 9000人", "沖縄県 小売店 飲食店"],
+            [
+                {"pref_code": 47, "muni_code_from": 47201, "muni_code_to": 47201},
+                {"pref_code": 1, "muni_code_from": 1100, "muni_code_to": 1100},
+                {"pref_code": 47, "muni_code_from": 47000, "muni_code_to": 47382},
+            ],
+            fingerprint="fp",
+        )
+
+    def test_search_ranks_exact_place_names_first(self):
+        ids, scores, coverage = self.index.search("那覇市の医師数", k=3)
+        self.assertEqual(ids[0], "naha")
+        self.assertEqual(len(ids), len(scores))
+        self.assertTrue(all(a >= b for a, b in zip(scores, scores[1:])))
+        self.assertGreater(coverage, 0.5)
+
+    def test_search_without_known_terms(self):
+        self.assertEqual(self.index.search("ZZZ", k=3)[0], [])
+
+    def test_area_mask_limits_results(self):
+        mask = self.index.area_mask(prefs=[1])
+        ids, _, _ = self.index.search("医師数", k=3, mask=mask)
+        self.assertEqual(ids, ["sapporo"])
+        self.assertEqual(self.index.area_mask(munis=[47201]).tolist(), [True, False, True])
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "lexical.npz"
+            self.index.save(path)
+            loaded = LexicalIndex.load(path)
+        self.assertEqual(loaded.fingerprint, "fp")
+        self.assertEqual(loaded.search("那覇市", k=1)[0], ["naha"])
+
+    def test_broken_file_loads_as_none(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "lexical.npz"
+            path.write_bytes(b"broken")
+            self.assertIsNone(LexicalIndex.load(path))
+
+
+class ReciprocalRankFusionTests(SimpleTestCase):
+    def test_documents_found_by_both_rankings_come_first(self):
+        fused = reciprocal_rank_fusion([["a", "b", "c"], ["c", "d", "b"]])
+        self.assertEqual(fused[:2], ["c", "b"])
+        self.assertEqual(set(fused), {"a", "b", "c", "d"})
+
+    def test_single_ranking_keeps_order(self):
+        self.assertEqual(reciprocal_rank_fusion([["x", "y", "z"]]), ["x", "y", "z"])
+
+
+class PlaceMatcherTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.matcher = PlaceMatcher(_municipalities())
+
+    def test_prefecture_and_municipality_narrow_to_the_municipality(self):
+        match = self.matcher.extract("沖縄県那覇市に住みたい")
+        self.assertEqual((match.prefs, match.munis), (set(), {47201}))
+
+    def test_prefecture_without_suffix(self):
+        match = self.matcher.extract("沖縄がいい")
+        self.assertEqual((match.prefs, match.munis), ({47}, set()))
+
+    def test_town_without_district_name(self):
+        self.assertEqual(self.matcher.extract("恩納村の海").munis, {47348})
+
+    def test_ambiguous_name_is_resolved_by_prefecture(self):
+        self.assertEqual(self.matcher.extract("府中市").munis, {13206, 34207})
+        self.assertEqual(self.matcher.extract("東京都府中市").munis, {13206})
+
+    def test_no_place(self):
+        self.assertFalse(self.matcher.extract("自然が多いところ"))
+
+    def test_chroma_where(self):
+        self.assertIsNone(chroma_where(PlaceMatch()))
+        self.assertEqual(chroma_where(PlaceMatch(prefs={47})), {"pref_code": {"$in": [47]}})
+        where = chroma_where(PlaceMatch(prefs={1}, munis={47201}))
+        self.assertEqual(where["$or"][0], {"pref_code": {"$in": [1]}})
+        self.assertEqual(
+            where["$or"][1], {"$and": [{"muni_code_from": {"$lte": 47201}}, {"muni_code_to": {"$gte": 47201}}]}
+        )
+
+
+class NumpyVectorStoreTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = Path(tmp.name) / "store"
+        self.vectors = np.random.default_rng(0).normal(size=(30, 8)).astype(np.float32)
+
+    def _fill(self, store):
+        for start in range(0, 30, 10):
+            rows = range(start, start + 10)
+            store.upsert(
+                [f"id{i}" for i in rows],
+                self.vectors[start:start + 10],
+                [f"text{i}" for i in rows],
+                [{"source": "a.csv" if i < 20 else "b.csv", "n": i} for i in rows],
+            )
+
+    def test_batches_survive_reopen_before_compaction(self):
+        store = NumpyVectorStore(self.path)
+        self._fill(store)
+        store.delete(["id3"])
+        store.upsert(["id5"], self.vectors[:1], ["updated"], [{"source": "a.csv", "n": 5}])
+
+        reopened = NumpyVectorStore(self.path)
+        self.assertEqual(len(reopened), 29)
+        self.assertEqual(reopened.get(ids=["id5"])["documents"], ["updated"])
+        self.assertEqual(reopened.get(ids=["id3"])["ids"], [])
+        self.assertEqual(reopened.similarity_search_by_vector(self.vectors[12], k=1)[0].id, "id12")
+
+    def test_compact_switches_to_a_single_generation(self):
+        store = NumpyVectorStore(self.path, quantization="int8")
+        self._fill(store)
+        store.compact()
+
+        generations = [p.name for p in self.path.iterdir() if p.name.startswith("gen-")]
+        self.assertEqual(len(generations), 1)
+        self.assertEqual(list((self.path / "segments").iterdir()), [])
+
+        reopened = NumpyVectorStore(self.path, quantization="int8")
+        self.assertEqual(len(reopened), 30)
+        self.assertEqual(reopened.similarity_search_by_vector(self.vectors[25], k=1)[0].id, "id25")
+        self.assertEqual(len(reopened.get(where={"source": "b.csv"})["ids"]), 10)
+        self.assertEqual(reopened.get(where={"n": {"$lt": 2}})["ids"], ["id0", "id1"])
+
+        # 2回目の compact で古い世代は消える
+        reopened.delete(reopened.get(where={"source": "b.csv"}, include=[])["ids"])
+        reopened.compact()
+        self.assertEqual(len([p for p in self.path.iterdir() if p.name.startswith("gen-")]), 1)
+        self.assertEqual(len(NumpyVectorStore(self.path)), 20)
+
+    def test_unfinished_segment_is_ignored(self):
+        store = NumpyVectorStore(self.path)
+        self._fill(store)
+        # 書き込み途中で止まった差分（名前を付ける前の一時ファイル）
+        (self.path / "segments" / "00000004.npz.tmp").write_bytes(b"partial")
+        self.assertEqual(len(NumpyVectorStore(self.path)), 30)
+
+    def test_mmr_returns_distinct_documents(self):
+        store = NumpyVectorStore(self.path)
+        self._fill(store)
+        docs = store.max_marginal_relevance_search_by_vector(self.vectors[7], k=4, fetch_k=10)
+        self.assertEqual(docs[0].id, "id7")
+        self.assertEqual(len({d.id for d in docs}), 4)
+
+
+class EmbeddingSpaceTests(SimpleTestCase):
+    def _fp(self, embedding, backend="chroma"):
+        return {"files": [{"name": "a.csv", "hash": "1", "backend": backend, "embedding": embedding}]}
+
+    def test_same_model_and_dimensions_can_be_updated_incrementally(self):
+        fp = self._fp("text-embedding-3-small:512")
+        self.assertTrue(rag_service.same_embedding_space(fp, fp))
+
+    def test_changed_dimensions_or_backend_need_a_rebuild(self):
+        saved = self._fp("text-embedding-3-small:512")
+        self.assertFalse(rag_service.same_embedding_space(saved, self._fp("text-embedding-3-small:256")))
+        self.assertFalse(rag_service.same_embedding_space(saved, self._fp("text-embedding-3-small:512", "numpy")))
+
+    def test_manifest_without_embedding_key_needs_a_rebuild(self):
+        saved = {"files": [{"name": "a.csv", "hash": "1"}]}
+        self.assertFalse(rag_service.same_embedding_space(saved, self._fp("text-embedding-3-small")))
+
+    def test_int8_quantization_round_trip(self):
+        vectors = np.random.default_rng(1).normal(size=(5, 16)).astype(np.float32)
+        q, scales = quantize_int8(vectors)
+        self.assertEqual(q.dtype, np.int8)
+        np.testing.assert_allclose(q * scales[:, None], vectors, atol=float(scales.max()))
+
+
+ANSWERS = {"age": 35, "style": "自然", "climate": "暖かい", "family": "単身", "else": "海の近く"}
+
+
+class ResponseCacheTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache = ResponseCache(Path(tmp.name) / "responses.sqlite3", max_entries=2)
+        self.addCleanup(self.cache._conn.close)
+
+    def test_key_ignores_age_within_decade_and_spacing(self):
+        key = cache_key(ANSWERS, "fp")
+        spaced = cache_key(dict(ANSWERS, age=38, **{"else": " 海の　近く "}), "fp")
+        self.assertEqual(spaced, cache_key(dict(ANSWERS, **{"else": "海の 近く"}), "fp"))
+        self.assertEqual(cache_key(dict(ANSWERS, age="39歳"), "fp"), key)
+        self.assertNotEqual(cache_key(dict(ANSWERS, age=41), "fp"), key)
+
+    def test_key_is_scoped_by_answers_data_and_settings(self):
+        key = cache_key(ANSWERS, "fp", {"model": "a"})
+        self.assertNotEqual(cache_key(dict(ANSWERS, style="都市"), "fp", {"model": "a"}), key)
+        self.assertNotEqual(cache_key(ANSWERS, "fp2", {"model": "a"}), key)
+        self.assertNotEqual(cache_key(ANSWERS, "fp", {"model": "b"}), key)
+
+    def test_get_put_and_fingerprint_invalidation(self):
+        self.assertIsNone(self.cache.get("k", "fp"))
+        self.cache.put("k", "fp", {"headline": "那覇市"})
+        self.assertEqual(self.cache.get("k", "fp"), {"headline": "那覇市"})
+        # CSVが変わったら前のエントリは使わない
+        self.assertIsNone(self.cache.get("k", "fp2"))
+        self.assertEqual(self.cache.stats()["entries"], 0)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        self.cache.put("a", "fp", {"n": 1})
+        self.cache.put("b", "fp", {"n": 2})
+        self.cache.get("a", "fp")
+        self.cache.put("c", "fp", {"n": 3})
+        self.assertIsNotNone(self.cache.get("a", "fp"))
+        self.assertIsNone(self.cache.get("b", "fp"))
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+
+class SemanticCacheTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache = SemanticCache(Path(tmp.name) / "semantic.sqlite3", threshold=0.95)
+        self.addCleanup(self.cache._conn.close)
+        self.scope = semantic_scope(ANSWERS, {"k": 4}, model="m")
+
+    def test_scope_ignores_free_text_but_not_other_answers_settings_or_model(self):
+        self.assertEqual(semantic_scope(dict(ANSWERS, **{"else": "山の近く"}), {"k": 4}, model="m"), self.scope)
+        self.assertEqual(semantic_scope(dict(ANSWERS, age=31), {"k": 4}, model="m"), self.scope)
+        self.assertNotEqual(semantic_scope(dict(ANSWERS, family="二世帯"), {"k": 4}, model="m"), self.scope)
+        self.assertNotEqual(semantic_scope(ANSWERS, {"k": 8}, model="m"), self.scope)
+        self.assertNotEqual(semantic_scope(ANSWERS, {"k": 4}, model="m:256"), self.scope)
+
+    def test_lookup_returns_close_prompts_in_the_same_scope_only(self):
+        self.cache.put(self.scope, "海の近く", [1.0, 0.0, 0.0], {"headline": "那覇市"}, ["2024人口.csv"], 3.0)
+        self.assertEqual(self.cache.lookup(self.scope, [0.99, 0.05, 0.0]), {"headline": "那覇市"})
+        self.assertIsNone(self.cache.lookup(self.scope, [0.5, 0.5, 0.5]))
+        self.assertIsNone(self.cache.lookup("other", [1.0, 0.0, 0.0]))
+
+    def test_invalidate_sources_drops_entries_built_from_reindexed_csvs(self):
+        self.cache.put(self.scope, "a", [1.0, 0.0], {"n": 1}, ["2024人口.csv"], 1.0)
+        self.cache.put(self.scope, "b", [0.0, 1.0], {"n": 2}, ["tenpo2511.csv"], 1.0)
+        self.assertEqual(self.cache.invalidate_sources({"2024人口.csv"}), 1)
+        self.assertIsNone(self.cache.lookup(self.scope, [1.0, 0.0]))
+        self.assertEqual(self.cache.lookup(self.scope, [0.0, 1.0]), {"n": 2})
+        self.assertEqual(self.cache.invalidate_sources(None), 1)
+
+    def test_scope_separates_places_named_in_the_free_text(self):
+        matcher = PlaceMatcher(_municipalities())
+        okinawa = dict(ANSWERS, **{"else": "沖縄の海の近く"})
+        hokkaido = dict(ANSWERS, **{"else": "北海道の雪国"})
+        self.assertNotEqual(
+            semantic_scope(okinawa, place=matcher.extract(okinawa["else"])),
+            semantic_scope(hokkaido, place=matcher.extract(hokkaido["else"])),
+        )
+        self.assertEqual(semantic_text(dict(ANSWERS, **{"else": "  特になし。"})), "")
+
+    def test_other_regions_do_not_hit_each_other(self):
+        # 埋め込みがすべて同じでも、地名が違えば別の scope になる
+        embeddings = mock.Mock()
+        embeddings.embed_query.return_value = [1.0, 0.0]
+        patches = (
+            mock.patch.object(rag_service, "RESPONSE_CACHE", False),
+            mock.patch.object(rag_service, "SEMANTIC_CACHE", True),
+            mock.patch.object(rag_service, "PLACE_FILTER", True),
+            mock.patch.object(rag_service, "get_place_matcher", return_value=PlaceMatcher(_municipalities())),
+            mock.patch.object(rag_service, "get_embeddings", return_value=embeddings),
+            mock.patch.object(rag_service, "get_semantic_cache", return_value=self.cache),
+        )
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        okinawa = dict(ANSWERS, **{"else": "沖縄の海の近く"})
+        cached, lookup = rag_service._find_cached_recommendation(okinawa)
+        self.assertIsNone(cached)
+        rag_service._remember_recommendation(lookup, {"headline": "那覇市"}, [], True, 1.0)
+
+        self.assertIsNone(rag_service._find_cached_recommendation(dict(ANSWERS, **{"else": "北海道の雪国"}))[0])
+        self.assertEqual(
+            rag_service._find_cached_recommendation(dict(ANSWERS, **{"else": "沖縄の海のそば"}))[0],
+            {"headline": "那覇市"},
+        )
+        embeddings.embed_query.assert_called_with("沖縄の海のそば")
+
+
+class PrecomputedTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.store = PrecomputedStore(Path(tmp.name) / "precomputed.json")
+        for target, name, value in (
+            (rag_service, "get_precomputed_store", lambda: self.store),
+            (rag_service, "load_saved_fingerprint", lambda: {"hash": "fp"}),
+            # ジョブはテストの中で実行する
+            (views, "_ensure_job_worker", lambda: None),
+        ):
+            patcher = mock.patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_no_preference_answers_share_the_blank_key(self):
+        for text in ("", "なし", "特になし。", " 特に無し ", "ありません"):
+            self.assertEqual(normalize_else(text), "", text)
+        self.assertEqual(normalize_else("なしの実がなる町"), "なしの実がなる町")
+        self.assertEqual(cache_key(dict(ANSWERS, **{"else": "特になし"}), "fp"), cache_key(dict(ANSWERS, **{"else": ""}), "fp"))
+
+    def test_grid_covers_every_choice_and_decade(self):
+        grid = answer_grid(views.QUESTIONS)
+        self.assertEqual(len(grid), 8 * 3 * 3 * 4)
+        self.assertTrue(all(answers["else"] == "" for answers in grid))
+        self.assertIn({"age": 45, "style": "都市", "climate": "涼しい", "family": "夫婦のみ", "else": ""}, grid)
+
+    def test_chat_with_blank_last_answer_serves_the_precomputed_result(self):
+        grid_answers = {"age": 45, "style": "都市", "climate": "涼しい", "family": "夫婦のみ", "else": ""}
+        key, fingerprint = rag_service.recommendation_key(grid_answers)
+        self.store.put(key, fingerprint, grid_answers, {"headline": "■結論：「札幌市（北海道）」", "spots": []})
+
+        self.client.post("/", {"action": "start"})
+        for answer in ("41", "都市", "涼しい", "夫婦のみ", ""):
+            self.client.post("/", {"action": "send", "message": answer})
+
+        # JS なしの送信は提案ジョブになり、結果画面は完了するまで再読み込みする
+        session = self.client.session
+        self.assertEqual(session["answers"]["else"], "特になし")
+        self.assertIsNone(session["result"])
+        self.assertContains(self.client.get("/"), 'http-equiv="refresh"')
+
+        async_to_sync(jobs.JobWorker(views._aget_rag_recommendation).run)(once=True)
+        response = self.client.get("/")
+        self.assertContains(response, "札幌市（北海道）")
+        self.assertEqual(self.client.session["result"]["headline"], "■結論：「札幌市（北海道）」")
+        self.assertNotIn("job_id", self.client.session)
+
+    def test_precompute_resumes_and_leaves_failures_for_the_next_run(self):
+        grid = answer_grid(views.QUESTIONS, [20])[:3]
+        key, fingerprint = rag_service.recommendation_key(grid[0])
+        self.store.put(key, fingerprint, grid[0], {"headline": "作成済み"})
+        calls = []
+
+        def generate(answers):
+            calls.append(answers)
+            if answers is grid[1]:
+                return {"headline": "【システムエラー】timeout"}
+            return {"headline": "■結論：「那覇市（沖縄県）」"}
+
+        counts = precompute(self.store, grid, rag_service.recommendation_key, generate, concurrency=2, log=lambda m: None)
+
+        self.assertEqual(counts, {"total": 3, "already": 1, "saved": 1, "failed": 1})
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self.store.keys(fingerprint), {key, rag_service.recommendation_key(grid[2])[0]})
+
+    def test_rebuild_starts_one_background_precompute(self):
+        release = threading.Event()
+        runs = []
+
+        def fake_precompute(store, grid, key_fn, generate, concurrency, log):
+            runs.append((len(grid), concurrency))
+            release.wait(5)
+            return {"total": len(grid), "already": 0, "saved": 0, "failed": 0}
+
+        with mock.patch.object(rag_service, "precompute", fake_precompute):
+            self.assertTrue(rag_service.start_precompute())
+            # 実行中はもう1つ始めない
+            self.assertFalse(rag_service.start_precompute())
+            release.set()
+            rag_service.precompute_thread.join(5)
+
+        self.assertEqual(runs, [(len(answer_grid(views.QUESTIONS)), rag_service.PRECOMPUTE_CONCURRENCY)])
+
+
+class RagStreamTests(TestCase):
+    async def _stream(self):
+        session = await self.async_client.asession()
+        await session.aset("answers", dict(ANSWERS))
+        await session.asave()
+        response = await self.async_client.get("/rag/stream/")
+        self.assertEqual(response["Content-Type"], "text/event-stream; charset=utf-8")
+        self.assertTrue(response.is_async)
+        return [chunk.decode() if isinstance(chunk, bytes) else chunk async for chunk in response.streaming_content]
+
+    async def test_tokens_are_sent_before_the_result(self):
+        async def fake_stream(prompt, answers=None):
+            for text in ("那覇", "市"):
+                yield {"type": "token", "text": text}
+            yield {"type": "result", "result": {"headline": "■結論：「那覇市（沖縄県）」", "spots": []}}
+
+        with mock.patch.object(rag_service, "precomputed_recommendation", return_value=None), \
+                mock.patch.object(rag_service, "astream_recommendation", fake_stream):
+            chunks = await self._stream()
+
+        self.assertEqual(chunks[0], ": start\n\n")
+        self.assertTrue(chunks[1].startswith("event: token"))
+        # 所要時間はヘッダーに載せられないので、result の直前のイベントで送る
+        self.assertTrue(chunks[-2].startswith("event: timing"))
+        self.assertTrue(chunks[-1].startswith("event: result"))
+        self.assertIn("那覇市（沖縄県）", chunks[-1])
+        session = await self.async_client.asession()
+        self.assertEqual((await session.aget("result"))["headline"], "■結論：「那覇市（沖縄県）」")
+
+    async def test_busy_is_reported_without_saving_a_result(self):
+        async def busy_stream(prompt, answers=None):
+            raise rag_service.Busy(7)
+            yield
+
+        with mock.patch.object(rag_service, "precomputed_recommendation", return_value=None), \
+                mock.patch.object(rag_service, "astream_recommendation", busy_stream):
+            chunks = await self._stream()
+
+        self.assertTrue(chunks[-2].startswith("event: timing"))
+        self.assertTrue(chunks[-1].startswith("event: busy"))
+        self.assertIn('"retry_after": 7', chunks[-1])
+        session = await self.async_client.asession()
+        self.assertIsNone(await session.aget("result"))
+
+    async def test_timing_event_has_the_spans_recorded_while_streaming(self):
+        async def fake_stream(prompt, answers=None):
+            timing.record("llm", 0.25)
+            yield {"type": "result", "result": {"headline": "■結論：「那覇市（沖縄県）」", "spots": []}}
+
+        with mock.patch.object(rag_service, "precomputed_recommendation", return_value=None), \
+                mock.patch.object(rag_service, "astream_recommendation", fake_stream):
+            chunks = await self._stream()
+
+        self.assertIn('"llm": 250.0', chunks[-2])
+
+    async def test_precomputed_answers_are_sent_without_calling_the_llm(self):
+        async def no_stream(prompt, answers=None):
+            raise AssertionError("LLMを呼んだ")
+            yield
+
+        precomputed = {"headline": "■結論：「那覇市（沖縄県）」", "spots": []}
+        with mock.patch.object(rag_service, "precomputed_recommendation", return_value=precomputed), \
+                mock.patch.object(rag_service, "astream_recommendation", no_stream):
+            chunks = await self._stream()
+
+        self.assertFalse(any(chunk.startswith("event: token") for chunk in chunks))
+        # 地図用の住所は見出しから作って最後のイベントに入れる
+        self.assertIn('"map_address": "沖縄県那覇市"', chunks[-1])
+
+    def test_final_answer_with_stream_flag_leaves_generation_to_the_stream(self):
+        session = self.client.session
+        session.update({"chat_active": True, "step": len(views.QUESTIONS) - 1, "answers": dict(ANSWERS), "messages": []})
+        session.save()
+
+        self.client.post("/", {"action": "send", "message": "海の近く", "stream": "1"})
+
+        self.assertNotIn("job_id", self.client.session)
+        self.assertFalse(RecommendationJob.objects.exists())
+        self.assertContains(self.client.get("/"), 'data-stream-url="/rag/stream/"')
+
+
+class AstreamRecommendationTests(TestCase):
+    def setUp(self):
+        answer = "■結論：「那覇市（沖縄県）」\n海が近く、冬も暖かい街です。"
+        llm = GenericFakeChatModel(messages=iter([AIMessage(content=answer)]))
+        combine = SimpleNamespace(
+            document_separator="\n\n",
+            document_prompt=PromptTemplate.from_template("{page_content}"),
+            document_variable_name="context",
+            llm_chain=SimpleNamespace(
+                prompt=ChatPromptTemplate.from_template("{context}\n{question}"),
+                llm=llm,
+            ),
+        )
+        self.answer = answer
+        self.remember = mock.Mock()
+        docs = [Document(page_content="那覇市の人口", metadata={"source": "data/2024人口.csv"})]
+        for name, value in (
+            ("qa_chain", SimpleNamespace(combine_documents_chain=combine)),
+            ("_find_cached_recommendation", lambda answers: (None, {})),
+            ("_answer_documents", lambda prompt, answers: (docs, False)),
+            ("_remember_recommendation", self.remember),
+        ):
+            patcher = mock.patch.object(rag_service, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_tokens_arrive_before_the_parsed_result(self):
+        events = [event async for event in rag_service.astream_recommendation("質問", answers=dict(ANSWERS))]
+
+        tokens = [e["text"] for e in events if e["type"] == "token"]
+        self.assertGreater(len(tokens), 1)
+        self.assertEqual("".join(tokens), self.answer)
+        self.assertEqual(events[-1]["type"], "result")
+        result = events[-1]["result"]
+        self.assertEqual(result["headline"], "■結論：「那覇市（沖縄県）」")
+        self.assertEqual(result["sources"], ["2024人口.csv"])
+        self.remember.assert_called_once()
+
+
+class _FakeMmrStore:
+    """クエリの埋め込みと MMR 検索を別々に呼ばれることを確かめるためのベクトルDB"""
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+        self.searches = []
+
+    def max_marginal_relevance_search_by_vector(self, embedding, **kwargs):
+        self.searches.append(kwargs)
+        return [Document(page_content="那覇市")]
+
+
+class TimingTests(SimpleTestCase):
+    def test_span_is_recorded_when_the_block_raises(self):
+        with timing.collect() as spans:
+            with self.assertRaises(RuntimeError):
+                with timing.span("test_failed_stage"):
+                    raise RuntimeError("boom")
+        self.addCleanup(timing._samples.pop, "test_failed_stage", None)
+
+        self.assertEqual([name for name, _ in spans], ["test_failed_stage"])
+
+    def test_stage_stats_percentiles(self):
+        self.addCleanup(timing._samples.pop, "test_stage", None)
+        for ms in range(1, 101):
+            timing.record("test_stage", ms / 1000)
+
+        stats = timing.stage_stats()["test_stage"]
+        self.assertEqual(stats["count"], 100)
+        self.assertEqual((stats["p50_ms"], stats["p95_ms"], stats["p99_ms"]), (50.5, 95.0, 99.0))
+        self.assertEqual(stats["histogram"]["<10ms"], 9)
+        self.assertEqual(sum(stats["histogram"].values()), 100)
+
+    def test_middleware_sets_server_timing_header(self):
+        self.addCleanup(timing._samples.pop, "test_view", None)
+
+        def view(request):
+            timing.record("test_view", 0.012)
+            timing.record("test_view", 0.003)
+            return HttpResponse("ok")
+
+        response = ServerTimingMiddleware(view)(RequestFactory().get("/rag/chat/"))
+        self.assertEqual(response["Server-Timing"], "test_view;dur=15.0")
+
+    def test_middleware_adds_nothing_without_spans(self):
+        response = ServerTimingMiddleware(lambda request: HttpResponse("ok"))(RequestFactory().get("/"))
+        self.assertFalse(response.has_header("Server-Timing"))
+
+    def test_mmr_search_is_timed_separately_from_the_query_embedding(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        embeddings = CachedEmbeddings(_FakeEmbeddings(), "model", Path(tmp.name) / "emb.sqlite3")
+        self.addCleanup(embeddings._conn.close)
+        store = _FakeMmrStore(embeddings)
+        retriever = MmrRetriever(vectorstore=store, k=2, fetch_k=5)
+
+        with timing.collect() as spans:
+            docs = retriever.invoke("那覇", filter={"pref_code": "47"})
+
+        self.assertEqual([d.page_content for d in docs], ["那覇市"])
+        self.assertEqual([name for name, _ in spans], ["embed_query", "mmr_search"])
+        self.assertEqual(store.searches, [{"k": 2, "fetch_k": 5, "lambda_mult": 0.5, "filter": {"pref_code": "47"}}])
+
+
+def _wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.01)
+
+
+class SingleFlightTests(SimpleTestCase):
+    def test_concurrent_calls_share_one_execution(self):
+        flight = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls, results = [], []
+
+        def work():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return {"headline": "那覇市"}
+
+        def call():
+            results.append(flight.do("key", work))
+
+        threads = [threading.Thread(target=call) for _ in range(5)]
+        threads[0].start()
+        started.wait(5)
+        for t in threads[1:]:
+            t.start()
+        _wait_until(lambda: flight.stats()["shared"] == 4)
+        release.set()
+        for t in threads:
+            t.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"headline": "那覇市"}] * 5)
+        self.assertEqual(flight.stats()["in_flight"], 0)
+
+    def test_errors_are_shared_and_not_cached(self):
+        flight = SingleFlight()
+        with self.assertRaises(ValueError):
+            flight.do("key", lambda: (_ for _ in ()).throw(ValueError("boom")))
+        self.assertEqual(flight.do("key", lambda: 1), 1)
+
+    def test_recheck_under_the_file_lock_skips_the_work(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            flight = SingleFlight(lock_dir=Path(tmp))
+            value = flight.do("key", lambda: self.fail("should not run"), recheck=lambda: {"cached": True})
+        self.assertEqual(value, {"cached": True})
+        self.assertEqual(flight.stats()["rechecked"], 1)
+
+    def test_async_calls_share_one_execution(self):
+        flight = SingleFlight()
+        calls = []
+
+        async def work():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return len(calls)
+
+        async def main():
+            same = await asyncio.gather(*(flight.ado("a", work) for _ in range(5)))
+            other = await flight.ado("b", work)
+            return same, other
+
+        same, other = asyncio.run(main())
+        self.assertEqual(same, [1] * 5)
+        self.assertEqual(other, 2)
+        self.assertEqual(flight.stats()["leaders"], 2)
+
+    def test_cancelled_waiter_does_not_cancel_the_leader(self):
+        flight = SingleFlight()
+
+        async def work():
+            await asyncio.sleep(0.05)
+            return "done"
+
+        async def main():
+            first = asyncio.ensure_future(flight.ado("key", work))
+            second = asyncio.ensure_future(flight.ado("key", work))
+            await asyncio.sleep(0)
+            first.cancel()
+            return await second
+
+        self.assertEqual(asyncio.run(main()), "done")
+
+
+class AdmissionControllerTests(SimpleTestCase):
+    def test_rejects_when_the_queue_is_full(self):
+        admission = AdmissionController(limit=1, max_queue=0, max_wait=1)
+        with admission.slot():
+            with self.assertRaises(Busy) as ctx:
+                with admission.slot():
+                    pass
+        self.assertGreaterEqual(ctx.exception.retry_after, 1)
+        self.assertEqual(admission.stats()["rejected"], 1)
+        self.assertEqual(admission.stats()["active"], 0)
+
+    def test_times_out_after_max_wait(self):
+        admission = AdmissionController(limit=1, max_queue=1, max_wait=0.05)
+        with admission.slot():
+            with self.assertRaises(Busy):
+                with admission.slot():
+                    pass
+        stats = admission.stats()
+        self.assertEqual((stats["timeouts"], stats["queued"], stats["active"]), (1, 0, 0))
+
+    def test_waiters_run_in_order_when_a_slot_frees(self):
+        admission = AdmissionController(limit=1, max_queue=4, max_wait=5)
+        order = []
+
+        async def job(name, seconds):
+            async with admission.aslot():
+                order.append(name)
+                await asyncio.sleep(seconds)
+
+        async def main():
+            await asyncio.gather(job("a", 0.05), job("b", 0), job("c", 0))
+
+        asyncio.run(main())
+        self.assertEqual(order, ["a", "b", "c"])
+        stats = admission.stats()
+        self.assertEqual((stats["admitted"], stats["active"], stats["queued"]), (3, 0, 0))
+
+    def test_async_waiter_times_out(self):
+        admission = AdmissionController(limit=1, max_queue=1, max_wait=0.05)
+
+        async def main():
+            async with admission.aslot():
+                async with admission.aslot():
+                    pass
+
+        with self.assertRaises(Busy):
+            asyncio.run(main())
+        self.assertEqual(admission.stats()["timeouts"], 1)
+
+
+class RecommendationJobTests(TestCase):
+    async def test_claims_the_oldest_queued_job(self):
+        first = await RecommendationJob.objects.acreate(answers={"n": 1})
+        await RecommendationJob.objects.acreate(answers={"n": 2})
+
+        job = await jobs.claim_next()
+        self.assertEqual(job.pk, first.pk)
+        self.assertEqual((job.status, job.attempts), (RecommendationJob.RUNNING, 1))
+        self.assertEqual((await jobs.claim_next()).answers, {"n": 2})
+        self.assertIsNone(await jobs.claim_next())
+
+    async def test_error_results_are_retried_until_max_attempts(self):
+        await RecommendationJob.objects.acreate(answers=dict(ANSWERS))
+
+        async def failing(answers):
+            return {"headline": "【システムエラー】失敗", "spots": []}
+
+        for attempt in range(1, jobs.JOB_MAX_ATTEMPTS + 1):
+            job = await jobs.claim_next()
+            self.assertEqual(job.attempts, attempt)
+            await jobs.run_job(job, failing)
+        job = await RecommendationJob.objects.aget(pk=job.pk)
+        self.assertEqual(job.status, RecommendationJob.FAILED)
+        self.assertEqual(job.error, "【システムエラー】失敗")
+        self.assertIsNone(await jobs.claim_next())
+
+    async def test_busy_requeues_without_using_an_attempt(self):
+        await RecommendationJob.objects.acreate(answers=dict(ANSWERS))
+
+        async def busy(answers):
+            raise Busy(0)
+
+        await jobs.run_job(await jobs.claim_next(), busy)
+        job = await RecommendationJob.objects.aget()
+        self.assertEqual((job.status, job.attempts), (RecommendationJob.QUEUED, 0))
+
+        async def ok(answers):
+            return {"headline": "■結論：「那覇市（沖縄県）」", "spots": []}
+
+        await jobs.run_job(await jobs.claim_next(), ok)
+        job = await RecommendationJob.objects.aget()
+        self.assertEqual((job.status, job.attempts), (RecommendationJob.DONE, 1))
+        self.assertEqual(job.result["headline"], "■結論：「那覇市（沖縄県）」")
+
+    def test_stale_running_jobs_are_requeued(self):
+        job = RecommendationJob.objects.create(answers={}, status=RecommendationJob.RUNNING, attempts=1)
+        RecommendationJob.objects.filter(pk=job.pk).update(started_at=job.created_at - timedelta(hours=1))
+
+        self.assertEqual(jobs.requeue_stale(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, RecommendationJob.QUEUED)
+
+    def test_idle_poll_backs_off_up_to_the_maximum(self):
+        worker = jobs.JobWorker(None, poll=0.5)
+        with mock.patch.object(jobs, "JOB_IDLE_POLL_MAX_SECONDS", 5.0):
+            self.assertEqual([worker.idle_delay(n) for n in range(1, 7)], [0.5, 1.0, 2.0, 4.0, 5.0, 5.0])
+
+    async def test_worker_exits_after_idle_exit_seconds(self):
+        worker = jobs.JobWorker(None, concurrency=2, poll=0.01, idle_exit=0.05)
+        await asyncio.wait_for(worker.run(), timeout=5)
+
+    async def test_init_job_runs_initialize_once(self):
+        first = await sync_to_async(jobs.enqueue_init)()
+        self.assertEqual((await sync_to_async(jobs.enqueue_init)()).pk, first.pk)
+        calls = []
+
+        async def initialize():
+            calls.append(1)
+            return True
+
+        await jobs.JobWorker(None, initialize=initialize).run(once=True)
+        job = await RecommendationJob.objects.aget(pk=first.pk)
+        self.assertEqual((job.status, job.result), (RecommendationJob.DONE, {"ok": True}))
+        self.assertEqual(calls, [1])
+
+
+class RecommendationJobViewsTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(views, "_ensure_job_worker", lambda: None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        session = self.client.session
+        session["answers"] = dict(ANSWERS)
+        session["step"] = 100
+        session.save()
+
+    def test_rag_recommend_returns_a_job_and_status_returns_the_result(self):
+        response = self.client.post("/rag/recommend/")
+        self.assertEqual(response.status_code, 202)
+        data = response.json()
+        self.assertEqual(self.client.get(data["status_url"]).json()["status"], RecommendationJob.QUEUED)
+
+        async def recommend(answers):
+            return {"headline": "■結論：「那覇市（沖縄県）」", "spots": []}
+
+        async_to_sync(jobs.JobWorker(recommend).run)(once=True)
+        status = self.client.get(data["status_url"]).json()
+        self.assertEqual(status["status"], RecommendationJob.DONE)
+        self.assertEqual(status["redirect_url"], "/")
+        self.assertEqual(self.client.session["result"]["headline"], "■結論：「那覇市（沖縄県）」")
+
+    def test_rag_init_is_a_job_and_progress_follows_it(self):
+        idle = {"state": "idle", "total": 0, "current": 0, "percent": 0, "message": "", "error": ""}
+        with mock.patch.object(rag_service, "get_rag_status", lambda: dict(idle)):
+            job_id = self.client.post("/rag/init/").json()["job_id"]
+            self.assertEqual(self.client.post("/rag/init/").json()["job_id"], job_id)
+            self.assertEqual(self.client.get("/rag/progress/").json()["state"], "building")
+
+            async def initialize():
+                return False
+
+            async_to_sync(jobs.JobWorker(None, initialize=initialize).run)(once=True)
+            progress = self.client.get("/rag/progress/").json()
+        self.assertEqual(progress["state"], "error")
+        self.assertEqual(progress["error"], "RAGの初期化に失敗しました")
 
-# Create your tests here.
@@ -0,0 +1,101 @@
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import numpy as np
+
+# 提案の生成の段階ごと（埋め込み・検索・LLMなど）の所要時間。
+# span("llm") で囲んだ区間を段階ごとに集計し（/rag/metrics/ の stages）、
+# リクエストの中で記録した区間は ServerTimingMiddleware が Server-Timing ヘッダーとログ1行にする
+# （SSE はヘッダーを返した後に生成するので、rag_stream が最後の timing イベントとログ1行にする）。
+# 区間は入れ子になることがある（retrieval の中に embed_query・bm25_search・mmr_search）。
+
+# 段階ごとに保持する直近の件数
+SAMPLES_PER_STAGE = 1000
+# 所要時間の分布（metrics）の区切り（ミリ秒）
+LATENCY_BINS_MS = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+# リクエストごとの記録先（collect() の中でだけ list になる）。sync_to_async で別スレッドに渡っても同じ list を指す
+_spans: ContextVar[list | None] = ContextVar("timing_spans", default=None)
+_lock = threading.Lock()
+_samples = {}  # 段階名 -> 直近の所要時間（秒）
+
+
+@contextmanager
+def span(name: str):
+    """name の段階としてブロックの所要時間を記録する（例外で抜けても記録する）"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started)
+
+
+def record(name: str, seconds: float) -> None:
+    with _lock:
+        samples = _samples.get(name)
+        if samples is None:
+            samples = _samples[name] = deque(maxlen=SAMPLES_PER_STAGE)
+        samples.append(seconds)
+    spans = _spans.get()
+    if spans is not None:
+        spans.append((name, seconds))
+
+
+@contextmanager
+def collect():
+    """ブロックの中で記録した区間を [(段階名, 秒), ...] で受け取る"""
+    spans = []
+    token = _spans.set(spans)
+    try:
+        yield spans
+    finally:
+        try:
+            _spans.reset(token)
+        except ValueError:
+            # ストリーミングの途中で切断され、別のコンテキストから閉じられた
+            _spans.set(None)
+
+
+def summarize(spans) -> dict:
+    """段階名ごとの合計（ミリ秒）。記録した順に並べる"""
+    totals = {}
+    for name, seconds in spans:
+        totals[name] = totals.get(name, 0.0) + seconds * 1000
+    return {name: round(ms, 1) for name, ms in totals.items()}
+
+
+def server_timing_header(spans) -> str:
+    return ", ".join(f"{name};dur={ms}" for name, ms in summarize(spans).items())
+
+
+def stage_stats() -> dict:
+    """段階ごとの件数・平均・p50/p95/p99（ミリ秒）と分布"""
+    with _lock:
+        snapshot = {name: np.asarray(samples, dtype=np.float64) * 1000 for name, samples in _samples.items()}
+    labels = [f"<{LATENCY_BINS_MS[0]}ms"] + [
+        f"{lo}-{hi}ms" for lo, hi in zip(LATENCY_BINS_MS, LATENCY_BINS_MS[1:])
+    ] + [f">={LATENCY_BINS_MS[-1]}ms"]
+
+    stats = {}
+    for name, ms in sorted(snapshot.items()):
+        p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+        counts = np.bincount(np.searchsorted(LATENCY_BINS_MS, ms, side="right"), minlength=len(LATENCY_BINS_MS) + 1)
+        stats[name] = {
+            "count": int(len(ms)),
+            "mean_ms": round(float(ms.mean()), 1),
+            "p50_ms": round(float(p50), 1),
+            "p95_ms": round(float(p95), 1),
+            "p99_ms": round(float(p99), 1),
+            "histogram": dict(zip(labels, counts.tolist())),
+        }
+    return stats
+
+
+def log_spans(path: str, spans, status: int | None = None) -> None:
+    """リクエスト1件の区間をJSONで1行に出す"""
+    line = {"path": path, "status": status, "spans_ms": summarize(spans)}
+    print("RAG: timing " + json.dumps(line, ensure_ascii=False))
@@ -5,13 +5,19 @@ from django.http import Http404
 from django.utils import timezone
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
+import json
 import re
-import threading
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.urls import reverse
+from django.views.decorators.http import require_POST
+from asgiref.sync import sync_to_async
 
 # 🚨 RAGサービスから回答生成関数をインポート
 from . import rag_service 
+from . import jobs
+from . import timing
+from .timing import span
+from .models import RecommendationJob
 
 # accountsアプリからProfileFormをインポート（mainブランチ側の追加）
 from accounts.forms import ProfileForm
@@ -29,7 +35,7 @@ QUESTIONS = [
     {"key": "style", "ask": "どんな暮らしが理想？", "choices": ["自然", "都市", "バランス"]},
     {"key": "climate", "ask": "好きな気候は？", "choices": ["暖かい", "涼しい", "こだわらない"]},
     {"key": "family", "ask": "家族構成は？", "choices": ["単身", "夫婦のみ", "子どものいる世帯", "二世帯"]},
-    {"key": "else", "ask": "その他の条件を入力してください", "choices": []},
+    {"key": "else", "ask": "その他の条件を入力してください（特に無ければ空欄のまま送信）", "choices": []},
 ]
 
 
@@ -40,10 +46,8 @@ def _int_from_text(s: str):
     digits = "".join(c for c in s if c.isdigit())
     return int(digits) if digits else None
 
-def _get_rag_recommendation(answers):
-    """
-    RAGサービスを呼び出し、ユーザーの回答に基づいて移住先を提案する。
-    """
+def build_recommendation_prompt(answers):
+    """チャットの回答から RAG に渡す質問文を作る"""
     age = answers.get("age")
     style = answers.get("style", "")
     climate = answers.get("climate", "")
@@ -59,34 +63,105 @@ def _get_rag_recommendation(answers):
     回答をそのまま出力するため、特殊文字は使用しないで下さい。
     内容の種類ごとに改行をするようにしてください。
     """
+    return prompt
 
+def _with_map_address(recommendation_result):
+    # headline から住所を抽出して map_address に格納
+    with span("address"):
+        headline = recommendation_result.get("headline", "")
+        recommendation_result["map_address"] = extract_address_from_headline(headline)
+    return recommendation_result
+
+def _recommendation_error(e):
+    print(f"RAGサービス呼び出しエラー: {e}")
+    headline = "【エラー】情報取得に失敗しました"
+    return {
+        "headline": headline,
+        "spots": ["システムエラーが発生しました。詳細はサーバーログを確認してください。"],
+        "map_address": extract_address_from_headline(headline),
+    }
+
+async def _aget_rag_recommendation(answers):
+    """
+    RAGサービスを呼び出し、ユーザーの回答に基づいて移住先を提案する。
+    LLMの応答は ainvoke で待つので、その間イベントループ（ワーカー）を塞がない。
+    """
     try:
-        # RAG実行
-        recommendation_result = rag_service.generate_recommendation(prompt)
+        with span("recommendation"):
+            # 選択肢だけの回答は事前計算の結果を使う（無ければRAG実行）
+            with span("precomputed"):
+                recommendation_result = await sync_to_async(
+                    rag_service.precomputed_recommendation, thread_sensitive=False
+                )(answers)
+            if recommendation_result is None:
+                prompt = build_recommendation_prompt(answers)
+                recommendation_result = await rag_service.agenerate_recommendation(prompt, answers=answers)
+            return _with_map_address(recommendation_result)
+
+    except rag_service.Busy:
+        raise
+    except Exception as e:
+        return _recommendation_error(e)
 
-        # headline から住所を抽出して map_address に格納
-        headline = recommendation_result.get("headline", "")
-        map_address = extract_address_from_headline(headline)
-        recommendation_result["map_address"] = map_address
+async def _ainitialize_rag():
+    """初期化ジョブから呼ぶ。ベクトルDBの作成は長く掛かるので別スレッドで実行する"""
+    return await sync_to_async(rag_service.initialize_rag, thread_sensitive=False)() is not None
+
+def _save_result(request, result):
+    request.session["result"] = result
+    request.session["step"] = 100
+    request.session.modified = True
 
-        return recommendation_result
+def _ensure_job_worker():
+    """プロセス内のワーカーを使う設定なら、動いていなければ起動する（再起動後に残っていたジョブもこれで進む）"""
+    if jobs.JOB_INPROCESS_WORKER:
+        jobs.start_background_worker(_aget_rag_recommendation, initialize=_ainitialize_rag)
+
+def _enqueue_recommendation(request, answers):
+    """回答で提案ジョブを登録し、セッションに job_id を残す（結果はポーリングか chat_view で受け取る）"""
+    if request.session.session_key is None:
+        request.session.save()
+    job = jobs.enqueue(answers, session_key=request.session.session_key, user=request.user)
+    request.session["job_id"] = str(job.pk)
+    _ensure_job_worker()
+    return job
+
+def _take_job_result(request, job):
+    """
+    ジョブが終わっていれば結果を返し、このセッションのジョブならセッションにも入れる。
+    終わっていなければ None（サーバーの再起動やアイドル終了でワーカーが止まっていても、問い合わせの度に起動し直す）。
+    """
+    if job.status not in (RecommendationJob.DONE, RecommendationJob.FAILED):
+        _ensure_job_worker()
+        return None
+    result = job.result or _recommendation_error(job.error or "ジョブが失敗しました")
+    if request.session.get("job_id") == str(job.pk):
+        _save_result(request, result)
+        request.session.pop("job_id", None)
+    return result
 
-    except Exception as e:
-        print(f"RAGサービス呼び出しエラー: {e}")
-        headline = "【エラー】情報取得に失敗しました"
-        return {
-            "headline": headline,
-            "spots": ["システムエラーが発生しました。詳細はサーバーログを確認してください。"],
-            "map_address": extract_address_from_headline(headline),
-        }
-    
 # --- chat_view ---
 def chat_view(request):
+    """
+    最後の回答は、JS が使える場合（stream=1）は結果画面の rag_stream（SSE）で生成しながら表示する。
+    それ以外は提案ジョブを登録し、結果画面で完了を待つ（chat_stream.js のポーリングか再読み込み）。
+    """
     chat_active = request.session.get("chat_active", False)
     messages = request.session.get("messages", [])
     step = request.session.get("step", -1)  # -1:未開始, 0..質問index, 100:結果表示
     answers = request.session.get("answers", {})
     result = request.session.get("result")
+    job_status_url = None
+
+    job_id = request.session.get("job_id")
+    if step == 100 and result is None and job_id:
+        job = RecommendationJob.objects.filter(pk=job_id).first()
+        if job is None:
+            request.session.pop("job_id", None)
+        else:
+            result = _take_job_result(request, job)
+            if result is None:
+                job_status_url = reverse("rag_job_status", args=[job.pk])
 
     if 0 <= step < len(QUESTIONS):
         question_data = QUESTIONS[step]
@@ -112,11 +187,15 @@ def chat_view(request):
                 "answers": answers,
                 "result": result,
             })
+            request.session.pop("job_id", None)
             return redirect("chat")
 
         # 送信ロジック
         elif action == "send" and chat_active and 0 <= step < len(QUESTIONS):
             user_msg = _normalize(request.POST.get("choice") or request.POST.get("message"))
+            if not user_msg and QUESTIONS[step]["key"] == "else":
+                # 最後の自由記述は空欄で送ってもよい（条件なし。事前計算の結果が使える）
+                user_msg = "特になし"
 
             if user_msg:
                 messages.append({"role": "user", "text": user_msg})
@@ -138,7 +217,9 @@ def chat_view(request):
                 if step < len(QUESTIONS):
                     messages.append({"role": "bot", "text": QUESTIONS[step]["ask"]})
                 else:
-                    result = _get_rag_recommendation(answers)
+                    result = None
+                    if request.POST.get("stream") != "1":
+                        _enqueue_recommendation(request, answers)
                     messages.append({
                         "role": "bot",
                         "text": "ありがとうございます。条件に合う候補を用意しました。"
@@ -154,9 +235,14 @@ def chat_view(request):
 
             return redirect("chat")
 
+        # 結果の生成（JS が使えない場合の結果画面のボタン）
+        elif action == "generate" and step == 100 and result is None and answers and job_status_url is None:
+            _enqueue_recommendation(request, answers)
+            return redirect("chat")
+
         # リセットロジック
         elif action == "reset":
-            for k in ("chat_active", "messages", "step", "answers", "result"):
+            for k in ("chat_active", "messages", "step", "answers", "result", "job_id"):
                 request.session.pop(k, None)
             return redirect("chat")
 
@@ -167,6 +253,8 @@ def chat_view(request):
         "step": step,
         "answers": answers,
         "result": result,
+        "job_status_url": job_status_url,
+        "last_step": len(QUESTIONS) - 1,
     })
 
 
@@ -327,34 +415,135 @@ def bookmark_detail(request, index):
         "spots": data.get("spots", []),
     })
 
-_rag_thread = None
-
 def rag_init(request):
-    global _rag_thread
-
+    """RAGの初期化をジョブとして登録する（実行中・待機中のものがあればそれを使う）。進捗は rag_progress で見る"""
     st = rag_service.get_rag_status()
     if st.get("state") in ("building", "ready"):
         return JsonResponse(st)
 
-    def runner():
-        try:
-            rag_service.initialize_rag()
-        except Exception:
-            pass
+    job = jobs.enqueue_init()
+    request.session["init_job_id"] = str(job.pk)
+    _ensure_job_worker()
+    return JsonResponse({**st, "job_id": str(job.pk)})
 
-    _rag_thread = threading.Thread(target=runner, daemon=True)
-    _rag_thread.start()
+def rag_progress(request):
+    """
+    RAG_STATUS（このプロセスの初期化の進捗）。このプロセスではまだ始まっていなければ、
+    rag_init で登録した初期化ジョブの状態を返す（待機中、または別プロセスのワーカーが実行した場合）。
+    """
+    st = rag_service.get_rag_status()
+    job_id = request.session.get("init_job_id")
+    if st.get("state") != "idle" or not job_id:
+        return JsonResponse(st)
 
-    return JsonResponse(rag_service.get_rag_status())
+    job = RecommendationJob.objects.filter(pk=job_id).first()
+    if job is None:
+        return JsonResponse(st)
+    if job.status == RecommendationJob.DONE:
+        st.update(state="ready", percent=100, message="RAGの初期化が完了しました。")
+    elif job.status == RecommendationJob.FAILED:
+        st.update(state="error", message="RAGの初期化に失敗しました。", error=job.error)
+    else:
+        _ensure_job_worker()
+        st.update(state="building", message="初期化の順番を待っています..." if job.status == RecommendationJob.QUEUED else "初期化中...")
+    return JsonResponse(st)
 
-def rag_progress(request):
-    return JsonResponse(rag_service.get_rag_status())
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
-def rag_recommend(request):
+async def rag_stream(request):
+    """
+    提案を Server-Sent Events で返す。
+    token: LLMの出力（届いたそばから）/ result: 見出し・地図用の住所・本文と参照元（セッションにも保存）
+    busy: 混雑のため生成できなかった（retry_after 秒後に繋ぎ直す）
+    timing: 段階ごとの所要時間（ミリ秒）。ヘッダーを返した後なので Server-Timing の代わりに result / busy の直前に送る
+    async ジェネレーターなので、トークンが届いたそばから送れるのは ASGI（uvicorn など）で動かしたとき。
+    WSGI（runserver）では Django が最後までまとめてから返す。
+    """
+    session = request.session
+    answers = await session.aget("answers", {})
+
+    def timing_event(spans) -> str:
+        timing.log_spans(request.path, spans, 200)
+        return _sse("timing", timing.summarize(spans))
+
+    async def events():
+        # 検索・LLMの応答を待たずに最初のバイトを返す
+        yield ": start\n\n"
+        with timing.collect() as spans:
+            try:
+                result = await sync_to_async(rag_service.precomputed_recommendation, thread_sensitive=False)(answers)
+                if result is None:
+                    prompt = build_recommendation_prompt(answers)
+                    async for event in rag_service.astream_recommendation(prompt, answers=answers):
+                        if event["type"] == "token":
+                            yield _sse("token", {"text": event["text"]})
+                        else:
+                            result = event["result"]
+                result = _with_map_address(result)
+            except rag_service.Busy as e:
+                # 結果は保存せず、retry_after 秒後に画面から繋ぎ直してもらう
+                yield timing_event(spans)
+                yield _sse("busy", {"retry_after": e.retry_after, "message": e.message})
+                return
+            except Exception as e:
+                result = _recommendation_error(e)
+
+            # レスポンスを返した後なので、セッションは明示的に保存する
+            await session.aset("result", result)
+            await session.aset("step", 100)
+            await session.asave()
+            yield timing_event(spans)
+        yield _sse("result", result)
+
+    response = StreamingHttpResponse(events(), content_type="text/event-stream; charset=utf-8")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+def _job_response(request):
+    """セッションの回答で提案ジョブを登録し、job_id と status_url を返す（202）"""
     answers = request.session.get("answers", {})
-    result = _get_rag_recommendation(answers)
-    request.session["result"] = result
-    request.session["step"] = 100
-    request.session.modified = True
-    return JsonResponse({"ok": True, "redirect_url": reverse("chat")})
+    if not answers:
+        return JsonResponse({"ok": False, "error": "回答がありません。"}, status=400)
+
+    job = _enqueue_recommendation(request, answers)
+    return JsonResponse({
+        "ok": True,
+        "job_id": str(job.pk),
+        "status": job.status,
+        "status_url": reverse("rag_job_status", args=[job.pk]),
+    }, status=202)
+
+@require_POST
+def rag_job_enqueue(request):
+    """
+    セッションの回答で提案ジョブを登録し、すぐに job_id を返す（202）。
+    結果は status_url をポーリングして受け取る。
+    """
+    return _job_response(request)
+
+def rag_job_status(request, job_id):
+    """ジョブの状態。完了したら結果をセッションにも入れ、チャット画面に結果が出るようにする"""
+    job = RecommendationJob.objects.filter(pk=job_id).first()
+    owner = job is not None and (
+        (job.session_key and job.session_key == request.session.session_key)
+        or (request.user.is_authenticated and job.user_id == request.user.pk)
+    )
+    if not owner:
+        raise Http404("ジョブが存在しません")
+
+    data = {"ok": True, "job_id": str(job.pk), "status": job.status, "attempts": job.attempts}
+    result = _take_job_result(request, job)
+    if result is not None:
+        data["result"] = result
+        data["redirect_url"] = reverse("chat")
+    return JsonResponse(data)
+
+def rag_metrics(request):
+    return JsonResponse(rag_service.get_cache_metrics())
+
+def rag_recommend(request):
+    """rag_job_enqueue と同じ（以前の URL）。生成はリクエストの中ではせず、ジョブの job_id を返す"""
+    return _job_response(request)
 